@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Module to compute the per-day statistics of the dashboard
+map-reduce style: the respondent rows are sharded by date
+across a process pool, each worker counts its shards into
+partial statistics and the reduce step sums them
+Every dashboard table is grouped by date, so the partial
+counts of disjoint dates merge by plain concatenation and
+a sum over the statistics keys
+---------------------
+@Author: Gabriel Yin
+"""
+import heapq
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from aggregate_store import STATS_COLS, daily_stats
+from ingest import pa, frame_to_ipc, frame_from_ipc
+
+# shards per worker, so a worker that gets busy days
+# does not hold up the others
+SHARDS_PER_WORKER = 4
+
+
+def _pool_context():
+    """
+    Function to get the multiprocessing context of the workers,
+    a fork server with the aggregation modules preloaded where
+    available, as stages run in threads
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['aggregate_store', 'ingest'])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+def shard_dates(frames, shards):
+    """
+    Function to spread the dates of frames over shards,
+    balancing the number of rows of each shard
+    Returns a dict of date to shard number
+    """
+    rows = pd.concat([frame['date'] for frame in frames], ignore_index=True).value_counts()
+    heap = [(0, shard) for shard in range(min(shards, len(rows)))]
+    assignment = {}
+    # largest dates first, each to the shard with the fewest rows so far
+    for date, count in rows.items():
+        total, shard = heapq.heappop(heap)
+        assignment[date] = shard
+        heapq.heappush(heap, (total + count, shard))
+    return assignment
+
+
+def _pack(df):
+    """
+    Function to get a frame ready to be sent to a worker,
+    as an arrow ipc stream where arrow can hold it
+    """
+    if pa is not None:
+        try:
+            return frame_to_ipc(df), True
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass
+    return df, False
+
+
+def _unpack(packed):
+    df, ipc = packed
+    return frame_from_ipc(df) if ipc else df
+
+
+def _map_shard(compute, packed):
+    """
+    Function to compute the partial statistics of one shard,
+    run in the worker processes
+    """
+    return compute(*[_unpack(frame) for frame in packed])
+
+
+def reduce_stats(partials):
+    """
+    Function to merge partial statistics into one table,
+    summing the counts of keys found in several partials
+    """
+    stats = pd.concat(partials, ignore_index=True)
+    return stats.groupby(STATS_COLS[:-1], sort=False)['count'].sum().reset_index()[STATS_COLS]
+
+
+def sharded_daily_stats(survey_monkey, bluelabs, bluelabs_phone, workers=4, compute=daily_stats,
+                        shards_per_worker=SHARDS_PER_WORKER):
+    """
+    Function to compute the same statistics as compute (e.g.
+    aggregate_store.daily_stats) with the rows sharded by date
+    over a pool of worker processes
+    """
+    frames = [survey_monkey, bluelabs, bluelabs_phone]
+    assignment = shard_dates(frames, workers * shards_per_worker)
+    n_shards = len(set(assignment.values()))
+    if workers <= 1 or n_shards <= 1:
+        return compute(*frames)
+    # rows without a date are in no statistics and no shard
+    shard_ids = [frame['date'].map(assignment).values for frame in frames]
+    payloads = [[_pack(frame[ids == shard]) for frame, ids in zip(frames, shard_ids)]
+                for shard in range(n_shards)]
+    print("Counting {} dates in {} shards over {} workers".format(len(assignment), n_shards, workers))
+    with ProcessPoolExecutor(max_workers=min(workers, n_shards), mp_context=_pool_context()) as pool:
+        partials = list(pool.map(_map_shard, [compute] * n_shards, payloads))
+    return reduce_stats(partials)
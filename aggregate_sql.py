@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Module computing the dashboard aggregations as SQL on an
+embedded duckdb database: the per-day statistics of the
+aggregate store and the dashboard tables derived from them,
+with the same results as the pandas functions of
+aggregate_store, run by the engine's multi-threaded
+columnar executor over the frames it is given
+---------------------
+@Author: Gabriel Yin
+"""
+import numpy as np
+import pandas as pd
+from shares import MISSING
+from aggregate_store import STATS_COLS, KEYS, candidate_order
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# columns of the respondent frames the statistics are computed from
+RESPONSE_COLS = KEYS + ['candidates', 'turnout', 'response_status']
+PHONE_COLS = KEYS + ['candidates', 'phone_type']
+
+
+def connect(threads=None):
+    """
+    Function to open an in-memory duckdb database
+    threads: threads of the engine, defaults to one per core
+    """
+    if duckdb is None:
+        raise ImportError("The duckdb aggregation backend requires duckdb")
+    con = duckdb.connect()
+    if threads:
+        con.execute("SET threads = {}".format(int(threads)))
+    return con
+
+
+def _literal(value):
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def _identifier(name):
+    return '"{}"'.format(str(name).replace('"', '""'))
+
+
+def _text(column, missing):
+    """
+    SQL expression of a column as text, missing values replaced
+    """
+    return "COALESCE(CAST({} AS VARCHAR), {})".format(_identifier(column), _literal(missing))
+
+
+def _counts_sql(table, dimension, value, group="''"):
+    """
+    Function to build the query counting the value expression per
+    date, source and group expression, as aggregate_store._counts;
+    rows without a date or source are left out like groupby does
+    """
+    return """
+        SELECT "date", source_id, {dimension} AS dimension, {group} AS "group",
+               {value} AS value, COUNT(*) AS "count"
+        FROM {table}
+        WHERE "date" IS NOT NULL AND source_id IS NOT NULL
+        GROUP BY 1, 2, 3, 4, 5""".format(table=table, dimension=_literal(dimension),
+                                         group=group, value=value)
+
+
+def _first_seen_sql(table, rank):
+    """
+    Function to build the query getting the position of the first
+    row of every candidate among the rows of its date, as
+    aggregate_store._first_seen; row_id holds the row order
+    """
+    return """
+        SELECT "date", source_id, 'first_seen' AS dimension, {rank} AS "group",
+               CAST(candidates AS VARCHAR) AS value, MIN(position) AS "count"
+        FROM (SELECT "date", source_id, candidates,
+                     ROW_NUMBER() OVER (PARTITION BY "date" ORDER BY row_id) - 1 AS position
+              FROM {table}
+              WHERE "date" IS NOT NULL AND source_id IS NOT NULL AND candidates IS NOT NULL)
+        GROUP BY 1, 2, 3, 4, 5""".format(table=table, rank=_literal(rank))
+
+
+def daily_stats(survey_monkey, bluelabs, bluelabs_phone, con=None, threads=None):
+    """
+    Function to compute the same statistics as
+    aggregate_store.daily_stats with one SQL query
+    threads: threads of the engine when no connection is given
+    """
+    con = con or connect(threads)
+    queries = []
+    for rank, (table, df) in enumerate((('survey_monkey', survey_monkey), ('bluelabs', bluelabs))):
+        con.register(table, df[RESPONSE_COLS].assign(row_id=np.arange(len(df))))
+        queries.append(_first_seen_sql(table, rank))
+        queries.append(_counts_sql(table, 'candidates', _text('candidates', MISSING)))
+        queries.append(_counts_sql(table, 'turnout', _text('turnout', 'No answer')))
+        queries.append(_counts_sql(table, 'response', "CASE WHEN CAST(response_status AS VARCHAR) = "
+                                                      "'completed' THEN 'completed' ELSE 'other' END"))
+    con.register('bluelabs_phone', bluelabs_phone[PHONE_COLS])
+    queries.append(_counts_sql('bluelabs_phone', 'candidates_phone', _text('candidates', MISSING),
+                               group=_text('phone_type', MISSING)))
+    stats = con.execute('\nUNION ALL'.join(queries)).df()
+    for table in ('survey_monkey', 'bluelabs', 'bluelabs_phone'):
+        con.unregister(table)
+    return stats[STATS_COLS]
+
+
+def _shares(con, where, keys, candidates, names=None):
+    """
+    Function to compute the share of every candidate within each
+    group of keys, as shares.shares_from_counts: MISSING values keep
+    their group but are left out of the denominator, absent
+    candidates are NaN
+    names: output names of the keys, defaults to the keys
+    """
+    keys = [_identifier(key) for key in keys]
+    names = [_identifier(name) for name in (names or [])] or keys
+    denominator = "NULLIF(SUM(\"count\") FILTER (WHERE value <> {}), 0)".format(_literal(MISSING))
+    shares = ''.join(
+        ",\n               CAST(SUM(\"count\") FILTER (WHERE value = {}) AS DOUBLE) / {} AS {}".format(
+            _literal(candidate), denominator, _identifier(candidate)) for candidate in candidates)
+    return con.execute("""
+        SELECT {keys}{shares}
+        FROM stats
+        WHERE {where}
+        GROUP BY {group}
+        ORDER BY {group}""".format(
+        keys=', '.join('{} AS {}'.format(key, name) for key, name in zip(keys, names)),
+        shares=shares, where=where, group=', '.join(keys))).df()
+
+
+def _survey_counts(con, keys, source_id=None):
+    """
+    Function to count the completed and answered responses
+    per group of keys
+    """
+    keys = [_identifier(key) for key in keys]
+    return con.execute("""
+        SELECT {keys}{source_id},
+               CAST(SUM("count") FILTER (WHERE value = 'completed') AS BIGINT) AS completed_counts,
+               CAST(SUM("count") AS BIGINT) AS answered_counts
+        FROM stats
+        WHERE dimension = 'response'
+        GROUP BY {keys}
+        ORDER BY {keys}""".format(keys=', '.join(keys),
+                                  source_id='' if source_id is None else
+                                  ', {} AS source_id'.format(_literal(source_id)))).df()
+
+
+def _turnout(con, keys, source_id=None):
+    """
+    Function to compute the share of every turnout answer
+    within each group of keys
+    """
+    keys = [_identifier(key) for key in keys]
+    return con.execute("""
+        SELECT {keys}, value AS turnout,
+               CAST(SUM("count") AS DOUBLE) /
+               CAST(SUM(SUM("count")) OVER (PARTITION BY {keys}) AS DOUBLE) AS turnout_percentage{source_id}
+        FROM stats
+        WHERE dimension = 'turnout'
+        GROUP BY {keys}, value
+        ORDER BY {keys}, value""".format(keys=', '.join(keys),
+                                         source_id='' if source_id is None else
+                                         ', {} AS source_id'.format(_literal(source_id)))).df()
+
+
+def dashboard_tables(stats, con=None):
+    """
+    Function to derive the same dashboard tables as
+    aggregate_store.dashboard_tables with SQL queries
+    """
+    con = con or connect()
+    con.register('stats', stats.astype({'count': 'int64'}))
+    candidates = candidate_order(stats)
+
+    support = "dimension = 'candidates' AND value <> {}".format(_literal(MISSING))
+    phone = "dimension = 'candidates_phone' AND value <> {}".format(_literal(MISSING))
+    tables = {'candidates': candidates}
+    tables['support'] = _shares(con, support, KEYS, candidates)
+    tables['support_totals'] = _shares(con, support, ['date'], candidates)
+    tables['survey_counts'] = pd.concat([_survey_counts(con, KEYS),
+                                         _survey_counts(con, ['date'], 'totals')],
+                                        ignore_index=True, sort=False)
+    tables['turnout'] = pd.concat([_turnout(con, ['date'], 'totals'), _turnout(con, KEYS)],
+                                  ignore_index=True, sort=False)
+    tables['bl_support'] = _shares(con, phone, KEYS, candidates)
+    tables['bl_phone'] = _shares(con, '{} AND "group" <> {}'.format(phone, _literal(MISSING)),
+                                 ['date', 'group'], candidates, names=['date', 'phone_type'])
+    tables['sm_support'] = _shares(con, "dimension = 'candidates' AND source_id = 'survey_monkey'",
+                                   KEYS, candidates)
+    con.unregister('stats')
+    return tables
+
+
+def _normalized(df):
+    """
+    Function to put a table in a canonical row order and index,
+    so tables built in different orders can be compared
+    """
+    keys = [col for col in KEYS + ['phone_type', 'turnout'] if col in df.columns]
+    return df.sort_values(keys).reset_index(drop=True)
+
+
+def parity(tables, expected, rtol=1e-9):
+    """
+    Function to compare dashboard tables with the tables
+    of the pandas path, ignoring row order and integer vs
+    float columns
+    Returns a list describing the differences, empty if none
+    """
+    differences = []
+    for name in expected:
+        if name not in tables:
+            differences.append("{}: missing".format(name))
+        elif name == 'candidates':
+            if list(tables[name]) != list(expected[name]):
+                differences.append("candidates: {} != {}".format(tables[name], expected[name]))
+        else:
+            try:
+                pd.testing.assert_frame_equal(_normalized(tables[name]), _normalized(expected[name]),
+                                              check_dtype=False, check_exact=False, rtol=rtol)
+            except AssertionError as e:
+                differences.append("{}: {}".format(name, e))
+    return differences
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Module with a persisted store of per-day sufficient
+statistics (counts, not percentages) for the dashboard
+tables, so that each run only reads and folds in the
+survey dates whose rows changed upstream
+---------------------
+@Author: Gabriel Yin
+"""
+import os
+import numpy as np
+import pandas as pd
+import config
+from datasets import partition_keys
+from shares import MISSING, shares_from_counts
+
+# bump whenever daily_stats changes, so old stores get rebuilt
+STORE_VERSION = 3
+
+STATS_COLS = ['date', 'source_id', 'dimension', 'group', 'value', 'count']
+KEYS = ['date', 'source_id']
+
+
+def _counts(df, dimension, column, group=None):
+    """
+    Function to count the values of one column per date, source
+    and optional group column, keeping missing values as MISSING
+    """
+    values = df[column].astype(object)
+    frame = pd.DataFrame({
+        'date': df['date'].values,
+        'source_id': df['source_id'].values,
+        'group': df[group].astype(object).where(df[group].notna(), MISSING).values
+                 if group else '',
+        'value': values.where(values.notna(), MISSING).values
+    })
+    counts = frame.groupby(['date', 'source_id', 'group', 'value']).size()
+    counts = counts.rename('count').reset_index()
+    counts['dimension'] = dimension
+    return counts[STATS_COLS]
+
+
+def _first_seen(df, rank):
+    """
+    Function to get the position of the first row of every candidate
+    among the rows of its date, so the candidate order can be rebuilt
+    from the statistics of any set of dates
+    rank: position of df among the frames, kept as the group
+    """
+    frame = pd.DataFrame({
+        'date': df['date'].values,
+        'source_id': df['source_id'].values,
+        'value': df['candidates'].astype(object).values
+    }).dropna()
+    frame['count'] = frame.groupby('date', sort=False).cumcount()
+    first = frame.groupby(['date', 'source_id', 'value'])['count'].min().reset_index()
+    first['dimension'] = 'first_seen'
+    first['group'] = str(rank)
+    return first[STATS_COLS]
+
+
+def candidate_order(stats):
+    """
+    Function to list the candidates in the order they first appear
+    in the survey monkey rows and then the bluelabs rows, date by
+    date, the column order of the dashboard tables
+    """
+    first = stats[(stats.dimension == 'first_seen') & (stats.value != MISSING)]
+    first = first.assign(key=partition_keys(first['date']).values)
+    first = first.sort_values(['group', 'key', 'count'], kind='mergesort')
+    return list(first['value'].drop_duplicates())
+
+
+def daily_stats(survey_monkey, bluelabs, bluelabs_phone):
+    """
+    Function to compute the sufficient statistics of all dashboard
+    tables for the given rows
+    bluelabs_phone: bluelabs rows joined with their phone type
+    """
+    stats = []
+    for rank, df in enumerate((survey_monkey, bluelabs)):
+        stats.append(_first_seen(df, rank))
+        stats.append(_counts(df, 'candidates', 'candidates'))
+        stats.append(_counts(df.assign(turnout=df['turnout'].astype(object).fillna('No answer')),
+                             'turnout', 'turnout'))
+        stats.append(_counts(df.assign(response=np.where(df['response_status'] == 'completed',
+                                                         'completed', 'other')),
+                             'response', 'response'))
+    stats.append(_counts(bluelabs_phone, 'candidates_phone', 'candidates', group='phone_type'))
+    return pd.concat(stats, ignore_index=True)
+
+
+def dashboard_tables(stats):
+    """
+    Function to derive the dashboard tables from the statistics
+    Returns a dict with the support shares by (date, source) and
+    by date, the answered/completed counts, the turnout shares,
+    the bluelabs support by source and by phone type, the survey
+    monkey support and the list of candidates, in the order they
+    first appear
+    """
+    tables = {}
+    support = stats[(stats.dimension == 'candidates') & (stats.value != MISSING)]
+    candidates = candidate_order(stats)
+    tables['candidates'] = candidates
+    tables['support'] = shares_from_counts(support, KEYS, 'value', candidates)
+    tables['support_totals'] = shares_from_counts(support, ['date'], 'value', candidates)
+
+    response = stats[stats.dimension == 'response']
+    completed = response[response.value == 'completed']
+    survey_counts = pd.concat([
+        completed.groupby(KEYS)['count'].sum().rename('completed_counts'),
+        response.groupby(KEYS)['count'].sum().rename('answered_counts')], axis=1).reset_index()
+    totals_counts = pd.concat([
+        completed.groupby('date')['count'].sum().rename('completed_counts'),
+        response.groupby('date')['count'].sum().rename('answered_counts')], axis=1).reset_index()
+    totals_counts['source_id'] = 'totals'
+    tables['survey_counts'] = pd.concat([survey_counts, totals_counts], ignore_index=True, sort=False)
+
+    turnout = stats[stats.dimension == 'turnout']
+    turnout_tables = []
+    for keys, source_id in ((['date'], 'totals'), (KEYS, None)):
+        counts = turnout.groupby(keys + ['value'])['count'].sum()
+        shares = counts / counts.groupby(level=list(range(len(keys)))).transform('sum')
+        shares = shares.rename('turnout_percentage').reset_index()
+        shares = shares.rename(columns={'value': 'turnout'})
+        if source_id is not None:
+            shares['source_id'] = source_id
+        turnout_tables.append(shares)
+    tables['turnout'] = pd.concat(turnout_tables, ignore_index=True, sort=False)
+
+    phone = stats[(stats.dimension == 'candidates_phone') & (stats.value != MISSING)]
+    tables['bl_support'] = shares_from_counts(phone, KEYS, 'value', candidates)
+    tables['bl_phone'] = shares_from_counts(phone[phone.group != MISSING], ['date', 'group'],
+                                            'value', candidates).rename(columns={'group': 'phone_type'})
+
+    sm = stats[(stats.dimension == 'candidates') & (stats.source_id == 'survey_monkey')]
+    tables['sm_support'] = shares_from_counts(sm, KEYS, 'value', candidates)
+    return tables
+
+
+class DailyAggregateStore():
+    """
+    Class for the persisted per (date, source) statistics, with
+    the date indexes of the datasets they were computed from
+    """
+    def __init__(self, path=None):
+        """
+        class initialization
+        """
+        self.path = path or os.path.join(config.CACHE_DIR, 'daily_aggregates.pkl')
+        self.stats = pd.DataFrame(columns=STATS_COLS)
+        self.new_stats = self.stats
+        self.indexes = {}
+        self.versions = {}
+        if os.path.exists(self.path):
+            stored = pd.read_pickle(self.path)
+            if stored.get('version') == STORE_VERSION:
+                self.stats = stored['stats']
+                self.indexes = stored['indexes']
+                self.versions = stored['versions']
+
+    def changed_dates(self, indexes, versions=None):
+        """
+        Function to get the survey dates (partition keys) whose rows
+        changed in any dataset since the statistics were computed,
+        including dates added or removed
+        indexes: dict of dataset name to its datasets.date_index
+        versions: versions of other inputs every date depends on,
+                  e.g. the phone type lookup
+        Returns None when every date has to be recomputed
+        """
+        if (versions or {}) != self.versions:
+            return None
+        dates = set()
+        for name, current in indexes.items():
+            previous = self.indexes.get(name)
+            if current is None or previous is None:
+                return None
+            dates.update(key for key in set(previous) | set(current)
+                         if previous.get(key) != current.get(key))
+        return sorted(dates)
+
+    def update(self, survey_monkey, bluelabs, bluelabs_phone, dates=None, indexes=None, versions=None,
+               compute=daily_stats):
+        """
+        Function to fold rows into the store
+        dates: survey dates the rows were read for, whose statistics
+               are replaced; None if the rows cover every date
+        indexes, versions: what the rows were read from, see changed_dates
+        compute: function computing the statistics of rows, e.g. the
+                 duckdb aggregate_sql.daily_stats
+        """
+        print('-' * 20)
+        if dates is None:
+            print("Recomputing the aggregate store from every survey date")
+        else:
+            print("Folding {} changed survey dates into the aggregate store".format(len(dates)))
+        self.new_stats = compute(survey_monkey, bluelabs, bluelabs_phone)
+        if dates is None:
+            self.stats = self.new_stats
+        else:
+            # dates that changed or disappeared are dropped from the stored statistics
+            kept = self.stats[~partition_keys(self.stats['date']).isin(dates).values]
+            self.stats = pd.concat([kept, self.new_stats], ignore_index=True)
+        self.indexes = indexes or {}
+        self.versions = versions or {}
+        return self.save()
+
+    def save(self):
+        """
+        Function to persist the store
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        pd.to_pickle({'version': STORE_VERSION, 'stats': self.stats, 'indexes': self.indexes,
+                      'versions': self.versions}, self.path)
+        return self
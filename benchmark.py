@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Module to benchmark the pipeline stages on synthetic data,
+against a local storage directory and a local big query
+stand-in; every stage is measured through instrument, like
+pipeline runs, and its metrics are appended as json lines
+for comparing versions
+Usage: python benchmark.py --rows 1000000 --label my-change
+---------------------
+@Author: Gabriel Yin
+"""
+import os
+import gc
+import sys
+import json
+import time
+import uuid
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import config
+import datasets
+import instrument
+from storage_io import set_storage, set_bigquery_client
+from bq_reader import BigQueryReader
+from voter_cache import VoterAttributeCache
+from bluelabs import BluelabsDataLoader, BluelabsDataAggregator
+from survey_monkey import SurveyMonkeyDataLoader
+from combine_survey_data import SurveyDataCombiner
+from synthetic import build_environment
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+def code_commit():
+    """
+    Function to get the git commit of the code being benchmarked
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def versions():
+    return {'python': platform.python_version(), 'pandas': pd.__version__,
+            'numpy': np.__version__, 'pyarrow': pa.__version__ if pa is not None else None}
+
+
+class BenchmarkRun():
+    """
+    Class recording the stages of a benchmark through one
+    instrument.RunMetrics per pipeline pass
+    """
+    def __init__(self, trace_memory=True):
+        """
+        class initialization
+        trace_memory: set to also record the peak memory allocated by
+                      each stage with tracemalloc, which slows stages down
+        """
+        self.trace_memory = trace_memory
+        self.passes = []
+        self.records = []
+
+    def start_pass(self, run_pass):
+        """
+        Function to start recording the stages of a pass
+        """
+        metrics = instrument.RunMetrics(run_id='{}_pass{}'.format(uuid.uuid4().hex[:6], run_pass))
+        self.passes.append((run_pass, metrics))
+        return self
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager recording a stage of the current pass
+        The yielded StageMetrics can be given extra fields, e.g. rows
+        """
+        run_pass, metrics = self.passes[-1]
+        if self.trace_memory:
+            metrics.profile(name, instrument.TracemallocHook(top=0))
+        gc.collect()
+        with metrics.stage(name) as record:
+            yield record
+        print('-' * 20)
+        print("Benchmark {}: {:.2f}s".format(name, record.wall_seconds))
+
+    def close(self):
+        """
+        Function to stop the metrics of every pass and collect the
+        stage records, as in the per run metrics without the list
+        of I/O calls
+        """
+        for run_pass, metrics in self.passes:
+            metrics.close()
+            for stage in metrics.record()['stages']:
+                stage.pop('io')
+                self.records.append(dict(stage, run_pass=run_pass, metrics_run_id=metrics.run_id))
+        self.passes = []
+        return self.records
+
+
+def run_pipeline(profiler, reader):
+    """
+    Function to run every stage once, in pipeline order
+    """
+    loader = BluelabsDataLoader()
+    with profiler.stage('bl_download'):
+        loader.download()
+    with profiler.stage('clean_agg') as record:
+        loader.clean_agg()
+        record.fields['rows'] = len(loader.agg_df)
+    with profiler.stage('bl_loader_save'):
+        loader.save()
+
+    with profiler.stage('bl_read'):
+        aggregator = BluelabsDataAggregator(voter_cache=VoterAttributeCache(reader=reader))
+    with profiler.stage('bl_clean') as record:
+        aggregator.clean()
+        record.fields['rows'] = len(aggregator.bluelabs_data)
+    with profiler.stage('voter_age_zip') as record:
+        aggregator.voter_age_zip()
+        record.fields['rows'] = len(aggregator.bluelabs_data)
+    with profiler.stage('decode_cols'):
+        aggregator.decode_cols()
+    with profiler.stage('bl_save'):
+        aggregator.save()
+    # frames are dropped where the pipeline releases their datasets
+    loader = aggregator = None
+    datasets.release(['agg_bluelabs_data'])
+
+    sm = SurveyMonkeyDataLoader()
+    with profiler.stage('sm_download') as record:
+        sm.download_from_big_query(reader=reader)
+        record.fields['rows'] = len(sm.survey_monkey)
+    with profiler.stage('sm_clean') as record:
+        sm.clean()
+        record.fields['rows'] = len(sm.survey_monkey)
+    with profiler.stage('sm_decode'):
+        sm.decode()
+    with profiler.stage('sm_save'):
+        sm.save()
+
+    with profiler.stage('combine') as record:
+        combiner = SurveyDataCombiner()
+        record.fields['rows'] = len(combiner.combined_data)
+    combiner = None
+    datasets.release(['bluelabs_surveymonkey_agg'])
+    with profiler.stage('update_misc_graphs'):
+        SurveyDataCombiner(combine=False).update_misc_graphs()
+    with profiler.stage('persist'):
+        datasets.flush()
+    datasets.release()
+
+
+def run_benchmark(rows=100000, sm_rows=None, rows_per_file=50000, days=60, seed=0,
+                  passes=1, workdir=None, trace_memory=True):
+    """
+    Function to generate a synthetic environment and run the
+    pipeline on it; later passes run on the caches of the first
+    Returns the stage records
+    """
+    workdir = workdir or tempfile.mkdtemp(prefix='survey_benchmark_')
+    config.RAW_DATA_DIR = os.path.join(workdir, 'raw_data')
+    config.CACHE_DIR = os.path.join(workdir, 'cache')
+    profiler = BenchmarkRun(trace_memory)
+
+    print('-' * 20)
+    print("Generating {} bluelabs and {} survey monkey rows in {}..".format(
+        rows, rows if sm_rows is None else sm_rows, workdir))
+    profiler.start_pass(0)
+    with profiler.stage('generate'):
+        storage, client = build_environment(os.path.join(workdir, 'storage'), rows=rows,
+                                            sm_rows=sm_rows, rows_per_file=rows_per_file,
+                                            days=days, seed=seed)
+    set_storage(storage)
+    set_bigquery_client(client)
+    reader = BigQueryReader(client=client)
+    for run_pass in range(1, passes + 1):
+        profiler.start_pass(run_pass)
+        run_pipeline(profiler, reader)
+    return profiler.close()
+
+
+def save_results(records, path, label=None, scale=None):
+    """
+    Function to append the stage records of a run as json lines
+    """
+    run = {'run_id': uuid.uuid4().hex[:12], 'label': label, 'commit': code_commit(),
+           'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'scale': scale or {},
+           'versions': versions()}
+    with open(path, 'a') as f:
+        for record in records:
+            f.write(json.dumps(dict(run, **record), sort_keys=True) + '\n')
+    return run['run_id']
+
+
+def load_results(path):
+    with open(path) as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+
+def compare(path, baseline, current):
+    """
+    Function to print the stage timings of two runs side by side;
+    baseline and current are run ids, labels or commits, the latest
+    matching run is used
+    """
+    results = load_results(path)
+    tables = []
+    for key in (baseline, current):
+        match = results[(results.run_id == key) | (results.label == key) | (results.commit == key)]
+        if match.empty:
+            raise ValueError("No benchmark run matches {}".format(key))
+        run = match[match.run_id == match.run_id.iloc[-1]]
+        # runs recorded before the instrument metrics have 'seconds'
+        seconds = run['wall_seconds'] if 'wall_seconds' in run else run['seconds']
+        if 'seconds' in run:
+            seconds = seconds.fillna(run['seconds'])
+        tables.append(seconds.groupby([run['run_pass'], run['stage']], sort=False).sum())
+    table = pd.concat(tables, axis=1, keys=[baseline, current])
+    table['ratio'] = table[current] / table[baseline]
+    print(table.round(3).to_string())
+    return table
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the survey pipeline on synthetic data')
+    parser.add_argument('--rows', type=int, default=100000, help='bluelabs respondents')
+    parser.add_argument('--sm-rows', type=int, default=None, help='survey monkey responses (default: --rows)')
+    parser.add_argument('--rows-per-file', type=int, default=50000, help='rows per raw bluelabs file')
+    parser.add_argument('--days', type=int, default=60, help='number of survey days')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--passes', type=int, default=1,
+                        help='pipeline runs; later runs measure the incremental paths')
+    parser.add_argument('--workdir', default=None, help='directory for the synthetic data (default: temporary)')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+    parser.add_argument('--no-trace-memory', action='store_true', help='skip tracemalloc peak memory')
+    parser.add_argument('--results', default='benchmark_results.jsonl', help='json lines file to append to')
+    parser.add_argument('--label', default=None, help='label of this run in the results')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+                        help='only compare two recorded runs (run id, label or commit)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.compare:
+        compare(args.results, *args.compare)
+        sys.exit(0)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='survey_benchmark_')
+    try:
+        records = run_benchmark(rows=args.rows, sm_rows=args.sm_rows, rows_per_file=args.rows_per_file,
+                                days=args.days, seed=args.seed, passes=args.passes, workdir=workdir,
+                                trace_memory=not args.no_trace_memory)
+    finally:
+        if not args.keep and args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    run_id = save_results(records, args.results, label=args.label, scale={
+        'rows': args.rows, 'sm_rows': args.sm_rows or args.rows, 'rows_per_file': args.rows_per_file,
+        'days': args.days, 'seed': args.seed, 'trace_memory': not args.no_trace_memory})
+    print('-' * 20)
+    print("Benchmark run {} appended to {}".format(run_id, args.results))
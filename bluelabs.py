@@ -7,70 +7,414 @@ to gcs in order to upload the dashboard
 @Author: Gabriel Yin 
 """
 import os
+import time
+import base64
+import hashlib
+import multiprocessing
 import pandas as pd
 import numpy as np
-from google.cloud import storage, bigquery
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import config
+import instrument
+from storage_io import get_storage
+from manifest import IngestManifest
+from ingest import BLUELABS_LAYOUTS, IngestReport, concat_unified, parse_raw_file, frame_from_ipc
+from datasets import read_dataset, write_dataset, iter_dataset, flush, release, DatasetWriter
+from codebook import Codebook, Variable, RatingScale
+from compact import compact_stage, merge_category_sets
+from bq_reader import BigQueryReader
+from voter_cache import VoterAttributeCache, VOTER_ATTRIBUTES
 import warnings
 warnings.filterwarnings("ignore")
 
+# candidates in code order, starting at 1
+BLUELABS_CANDIDATES = ['Joe Biden',
+                       'Bernie Sanders',
+                       'Elizabeth Warren',
+                       'Michael Bloomberg',
+                       '[LEAVE BLANK]',
+                       'Cory Booker',
+                       'Pete Buttigieg',
+                       '[LEAVE BLANK]',
+                       '[LEAVE BLANK]',
+                       'Steve Bullock',
+                       'Kamala Harris',
+                       '[LEAVE BLANK]',
+                       'Julian Castro',
+                       'Amy Klobuchar',
+                       'Andrew Yang',
+                       'Tulsi Gabbard',
+                       '[LEAVE BLANK]',
+                       '[LEAVE BLANK]',
+                       '[LEAVE BLANK]',
+                       'Other',
+                       'Undecided',
+                       'Tom Steyer',
+                       'Michael Bennet']
+
+BLUELABS_CODEBOOK = Codebook('bluelabs', {
+    'qsupport': Variable('qsupport', dict(zip(range(1, len(BLUELABS_CANDIDATES) + 1),
+                                              BLUELABS_CANDIDATES))),
+    'race': Variable('qrace', {
+        1: 'White',
+        2: 'Black or African American',
+        3: 'Hispanic, Latino or Latin-American',
+        4: 'Asian, Asian-American or Pacific Islander',
+        5: 'Other',
+        6: 'Other',
+        7: 'Other',
+        8: 'Other',
+        9: 'No answer'
+    }),
+    'education': Variable('qeducation', {
+        1: 'Did Not Complete High School',
+        2: 'Graduated High School',
+        3: 'Attended college no degree',
+        4: 'Associates degree',
+        5: 'Bachelors degree',
+        6: 'Masters, PhD',
+        7: 'No answer',
+        8: 'No answer'
+    }),
+    'turnout_response': Variable('qturnoutprimary', {
+        1: 'Definitely Vote',
+        2: 'Probably Vote',
+        3: '50/50 to vote',
+        4: 'Probably not vote',
+        5: 'Definitely Not Vote',
+        6: 'Don’t know/not sure',
+        7: 'Refused'
+    }, fill=''),
+    'qturnout': Variable('qturnoutprimary', {
+        1: 'Very likely I will vote',
+        2: 'Very likely I will vote',
+        3: '50-50 chance I will vote',
+        4: 'Very likely I will NOT vote',
+        5: 'Very likely I will NOT vote',
+        6: '50-50 chance I will vote',
+        7: 'No answer'
+    }, fill=''),
+    'past_vote': Variable('qpastvote', {
+        1: "Bernie Sanders",
+        2: "Hillary Clinton",
+        3: "Other",
+        4: "Not vote",
+        5: "Don't know",
+        6: "Refused"
+    }),
+    'employement': Variable('qemployed', {
+        1: "Full-time",
+        2: "Part-time",
+        3: "Self-employed",
+        4: "Retired",
+        5: "A student",
+        6: "Disabled",
+        7: "Unemployed",
+        8: "Other",
+        9: "Refused"
+    }),
+    'religion': Variable('qreligion', {
+        1: "Protestant",
+        2: "Roman Catholic",
+        3: "Mormon",
+        4: "Orthodox",
+        5: "Jewish",
+        6: "Muslim",
+        7: "Buddhist",
+        8: "Hindu",
+        9: "Atheist",
+        10: "Agnostic",
+        11: "Nothing in particular",
+        12: "Just Christian",
+        13: "Unitarian",
+        14: "Something else",
+        15: "Dont't know"
+    }),
+    'income': Variable('qincome', {
+        1: "Less than $30,000",
+        2: "$30,000 to less than $40,000",
+        3: "$40,000 to less than $50,000",
+        4: "$50,000 to less than $75,000",
+        5: "$75,000 to less than $100,000",
+        6: "$100,000 to less than $150,000",
+        7: "$150,000 or more",
+        8: "Refused",
+        12: "Other"
+    }),
+    'racehisp': Variable('qracehisp', {
+        1: "Yes",
+        2: "No",
+        3: "Refused"
+    }),
+    'disp': Variable('disp', {1: 'completed'}, fill='partial'),
+})
+
+# rating columns recoded in BluelabsDataAggregator.recode
+BLUELABS_RATE_COLUMNS = ['qrate_ak', 'qrate_ay', 'qrate_bs', 'qrate_cb', 'qrate_dp', 'qrate_ew',
+                         'qrate_jb', 'qrate_jc', 'qrate_kh', 'qrate_mb', 'qrate_mb2', 'qrate_pb',
+                         'qrate_sb', 'qrate_tg', 'qrate_ts', 'qratepost']
+
+# the 10 point ratings (98/99: don't know/refused) collapsed into the
+# 5 point scale survey monkey asks, plus 6 for no answer
+BLUELABS_RATING_SCALE = RatingScale('bluelabs rating', {
+    1: [1, 2],
+    2: [3, 4],
+    3: [5, 6],
+    4: [7, 8],
+    5: [9, 10],
+    6: [98, 99],
+})
+
+# all_survey_results columns used by the aggregator or passed through to the combined data
+BLUELABS_COLUMNS = ['voterbase_id', 'date_called', 'duration_call'] + \
+                   sorted(BLUELABS_CODEBOOK.sources()) + BLUELABS_RATE_COLUMNS
+
+# rows per chunk of the aggregator's out of core mode, unset
+# to process the whole dataset in memory: SURVEY_CHUNK_ROWS=500000
+CHUNK_ROWS = int(os.environ.get('SURVEY_CHUNK_ROWS') or 0) or None
+
+# worker processes parsing the raw return files, 1 parses them
+# in the loader's process: SURVEY_PARSE_WORKERS=4
+PARSE_WORKERS = int(os.environ.get('SURVEY_PARSE_WORKERS') or 1)
+
+# category sets under both the decoded and the saved column names
+BLUELABS_CATEGORIES = merge_category_sets(
+    BLUELABS_CODEBOOK.category_sets(),
+    BLUELABS_CODEBOOK.category_sets({'qturnout': 'turnout',
+                                     'qsupport': 'name_first_choice_candidates',
+                                     'racehisp': 'hispanic',
+                                     'disp': 'response_status'}))
+
+def _parse_context():
+    """
+    Function to get the multiprocessing context of the parse workers:
+    not plain fork, as the pipeline runs stages and writes in threads,
+    but a fork server with the parsing modules preloaded where available
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['ingest'])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
 class BluelabsDataLoader():
     """
     Class to download all bluelabs data
     with functions to clean column and 
     aggregate data
     """
-    def __init__(self):
+    RAW_PREFIXES = ('bluelabs_raw_survey_returns/12',
+                    'bluelabs_raw_survey_returns/2019')
+
+    def __init__(self, workers=8, page_size=1000, parse_workers=None):
         """
         class initialization
+        workers: number of concurrent downloads used by download()
+        page_size: number of blobs fetched per listing page
+        parse_workers: number of processes parsing the raw files in
+                       clean_agg(), defaults to PARSE_WORKERS
         """
-        self.PROJECT_ID = 'hawkfish-prod-0c4ce6d0'
-        client = storage.Client()
-        self.bucket = client.get_bucket('user_ground_truth')
-        self.file_names = list(key.name for key in self.bucket.list_blobs() 
-                               if key.name.startswith('bluelabs_raw_survey_returns/12')
-                               or key.name.startswith('bluelabs_raw_survey_returns/2019'))
+        self.workers = workers
+        self.page_size = page_size
+        self.parse_workers = parse_workers or PARSE_WORKERS
+        self.raw_path = config.RAW_DATA_DIR + '/'
+        self.agg_cache_path = self.raw_path + 'agg_bluelabs_data.pkl'
+        self.storage = get_storage()
+        self.bucket_name = config.RAW_BUCKET
+        self.manifest = IngestManifest(self.raw_path + 'manifest.json')
+        self.layouts = BLUELABS_LAYOUTS
+        self.ingest_report = None
+        self._blobs = None
 
-    def download(self):
+    def iter_blobs(self):
+        """
+        Generator over the raw return blobs, listed server side
+        by prefix and fetched lazily page by page
+        """
+        for prefix in self.RAW_PREFIXES:
+            for blob in self.storage.list(self.bucket_name, prefix=prefix, page_size=self.page_size):
+                yield blob
+
+    @property
+    def blobs(self):
+        """
+        All raw return blobs, listed on first use only
+        """
+        if self._blobs is None:
+            self._blobs = list(self.iter_blobs())
+        return self._blobs
+
+    @property
+    def file_names(self):
+        return list(blob.name for blob in self.blobs)
+
+    @property
+    def changed_blobs(self):
+        """
+        Raw return blobs that are new or changed
+        since they were last ingested
+        """
+        return list(blob for blob in self.blobs if not self.manifest.is_current(blob))
+
+    @staticmethod
+    def _local_md5(local_path):
+        """
+        Function to compute the base64 md5 of a local file,
+        in the same encoding gcs uses for blob.md5_hash
+        """
+        digest = hashlib.md5()
+        with open(local_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return base64.b64encode(digest.digest()).decode('utf-8')
+
+    def _is_current(self, blob, local_path):
+        """
+        Function to check whether the local copy of a blob
+        is already up to date (same size and md5)
+        """
+        if not os.path.exists(local_path) or blob.md5_hash is None:
+            return False
+        if blob.size is not None and os.path.getsize(local_path) != blob.size:
+            return False
+        return self._local_md5(local_path) == blob.md5_hash
+
+    def _download_one(self, blob, local_path):
+        """
+        Function to download a single blob through a temporary
+        file, so an interrupted download never leaves a partial
+        file behind under the final name
+        """
+        tmp_path = local_path + '.part'
+        start = time.time()
+        self.storage.download(self.bucket_name, blob.name, tmp_path)
+        os.replace(tmp_path, local_path)
+        elapsed = time.time() - start
+        return os.path.getsize(local_path), elapsed
+
+    def download(self, workers=None):
         """
         Function to download all files up to date 
         from google bucket
+        Only files that are new or changed since the last ingestion
+        are considered, and files whose local copy already matches
+        the blob md5 are skipped, so re-running after a failure
+        only fetches the missing files
         """
-        path = 'survey_raw_data/'
+        path = self.raw_path
+        workers = workers or self.workers
+        os.makedirs(path, exist_ok=True)
         print('-' * 20)
         print("Stage 1/3: Start downloading all bluelabs data..")
-        for file_name in self.file_names:
-            blob = storage.Blob(file_name, self.bucket)
-            blob.download_to_filename(path + file_name.split('/')[1])
+
+        changed = self.changed_blobs
+        pending = []
+        for blob in changed:
+            local_path = path + blob.name.split('/')[1]
+            if self._is_current(blob, local_path):
+                continue
+            pending.append((blob, local_path))
+        print("{} of {} files are new or changed, {} need downloading ({} workers)".format(
+            len(changed), len(self.blobs), len(pending), workers))
+
+        total_bytes = 0
+        failed = []
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(instrument.bind(self._download_one), blob, local_path): blob.name
+                       for blob, local_path in pending}
+            for future in as_completed(futures):
+                file_name = futures[future]
+                try:
+                    size, elapsed = future.result()
+                except Exception as e:
+                    failed.append(file_name)
+                    print("Failed to download {}: {}".format(file_name, e))
+                    continue
+                total_bytes += size
+                print("{}: {:.2f} MB in {:.2f}s ({:.2f} MB/s)".format(
+                    file_name, size / 1e6, elapsed, size / 1e6 / max(elapsed, 1e-6)))
+        elapsed = time.time() - start
 
         print('-' * 20)
+        print("Downloaded {:.2f} MB in {:.2f}s ({:.2f} MB/s)".format(
+            total_bytes / 1e6, elapsed, total_bytes / 1e6 / max(elapsed, 1e-6)))
+        if failed:
+            raise RuntimeError("{} file(s) failed to download, re-run to resume: {}".format(
+                len(failed), ', '.join(sorted(failed))))
         print("All data has been downloaded.")
         
         return self
     
+    def _parse_files(self, paths, workers):
+        """
+        Generator over the parsed and normalized raw files, in the
+        order of paths; with several workers the files are parsed in
+        a process pool and the frames come back as arrow ipc streams
+        """
+        if workers <= 1 or len(paths) <= 1:
+            for path in paths:
+                yield parse_raw_file(path, self.layouts)
+            return
+        context = _parse_context()
+        with ProcessPoolExecutor(max_workers=min(workers, len(paths)), mp_context=context) as pool:
+            for result in pool.map(parse_raw_file, paths, [self.layouts] * len(paths),
+                                   [True] * len(paths)):
+                if result['ipc']:
+                    result['frame'] = frame_from_ipc(result['frame'])
+                yield result
+
     def clean_agg(self):
         """
         Function to read in file and do some cleaning and write to bucket
+        Only new or changed files are parsed; rows from files that were
+        already ingested come from the local aggregate cache
         """
         print('-' * 20)
         print("Stage 2/3: generating agg data..")
-        raw_path = 'survey_raw_data/'
+        raw_path = self.raw_path
+        if os.path.exists(self.agg_cache_path):
+            cached = pd.read_pickle(self.agg_cache_path)
+        else:
+            # without the cached rows the manifest is meaningless
+            cached = None
+            self.manifest.clear()
+
+        changed = self.changed_blobs
+        removed = set(self.manifest.names()) - set(self.file_names)
+        stale = set(blob.name for blob in changed) | removed
+        print("{} new or changed files, {} removed files".format(len(changed), len(removed)))
+
+        report = IngestReport()
         filtered_dfs = []
-        for file_name in self.file_names:
-            raw_data = pd.read_csv(raw_path + file_name.split('/')[1])
-            if raw_data.shape[1] == 45 or raw_data.shape[1] == 47 or raw_data.shape[1] == 46:
-                raw_data.columns = [col.lower() for col in raw_data.columns]
-                raw_data = raw_data.rename(
-                    columns={'qrate_mbpost':'qratepost',
-                             'qturnout':'qturnoutprimary',
-                             'qpostrate_text':'qratepost_text'
-                            })
-                filtered_dfs.append(raw_data)
-            else:
-                print(file_name)
-
-        self.agg_df = filtered_dfs[0].append(filtered_dfs[1])
-        for filtered_df in filtered_dfs[2:]:
-            self.agg_df = self.agg_df.append(filtered_df)
+        if cached is not None:
+            filtered_dfs.append(cached[~cached['_source_file'].isin(stale)])
+        paths = [raw_path + blob.name.split('/')[1] for blob in changed]
+        if self.parse_workers > 1 and len(paths) > 1:
+            print("Parsing {} files in {} processes..".format(len(paths), min(self.parse_workers, len(paths))))
+        for blob, path, parsed in zip(changed, paths, self._parse_files(paths, self.parse_workers)):
+            file_name = blob.name
+            instrument.record_io('read_raw_csv', path, parsed['seconds'], rows=parsed['rows'],
+                                 nbytes=parsed['bytes'])
+            raw_data, layout, reason, rows = parsed['frame'], parsed['layout'], parsed['reason'], parsed['rows']
+            if reason is not None:
+                report.reject(file_name, reason)
+                self.manifest.record(blob, rows=rows, rejected=True)
+                continue
+            raw_data['_source_file'] = file_name
+            filtered_dfs.append(raw_data)
+            report.accept(file_name, layout, rows)
+            self.manifest.record(blob, rows=rows)
+        self.ingest_report = report.summary()
+
+        if not filtered_dfs:
+            raise ValueError("No bluelabs survey files to aggregate")
+        agg_df = concat_unified(filtered_dfs)
+
+        agg_df.to_pickle(self.agg_cache_path)
+        self.manifest.forget(removed).save()
+        self.agg_df = compact_stage('bluelabs agg data', agg_df.drop(columns=['_source_file']))
             
         print('-' * 20)
         print("Agg data has been generated.")
@@ -83,48 +427,45 @@ class BluelabsDataLoader():
         """
         print('-' * 20)
         print("Stage 3/3: Saving agg data to hdfs..")
-        storage_client = storage.Client(project=self.PROJECT_ID)
-        bucket = storage_client.get_bucket("gabriel_bucket_test")
-        blob = bucket.blob("agg_bluelabs_data.csv")
-        blob.upload_from_string(self.agg_df.to_csv(index=False)) 
+        write_dataset(self.agg_df, 'agg_bluelabs_data')
+        # the frame is handed over to the dataset, which the
+        # pipeline releases once no stage needs it
+        self.agg_df = None
         
         print('-' * 20)
         print("agg_survey_data.csv has been successfully saved.")
         
         return self
     
-    def download_from_gcs(self):
+    def download_from_gcs(self, force=False):
         """
         Driver function to download all data from gcs 
+        force: set to re-ingest every file, not only new or changed ones
         """
+        if force:
+            self.manifest.clear()
         self.download().clean_agg().save()
+        return self
     
-    def download_from_big_query(self):
+    def download_from_big_query(self, reader=None, all_columns=False):
         """
         Driver function to download all data from 
         big query table
+        Only the columns used downstream are requested and the
+        result is streamed as arrow record batches
+        reader: BigQueryReader to use, e.g. with a local stand-in client
+        all_columns: set to request every column of the table
         """
         print('-' * 20)
         print("Start downloading from big query table...")
-        client = bigquery.Client()
-        query = """
-        SELECT 
-         *
-        FROM bluelabs_survey_results.all_survey_results;
-        """
-        query_job = client.query(
-            query,
-            location="US"
-         )
-        bluelabs_agg = query_job.to_dataframe()
+        reader = reader or BigQueryReader()
+        bluelabs_agg = reader.read_table('bluelabs_survey_results.all_survey_results',
+                                         columns=None if all_columns else BLUELABS_COLUMNS)
         
         print("-" * 20)
         print("Downloading finished.")
         
-        storage_client = storage.Client(project=self.PROJECT_ID)
-        bucket = storage_client.get_bucket("gabriel_bucket_test")
-        blob = bucket.blob("agg_bluelabs_data.csv")
-        blob.upload_from_string(bluelabs_agg.to_csv(index=False)) 
+        write_dataset(bluelabs_agg, 'agg_bluelabs_data')
         
         print('-' * 20)
         print("Bluelabs data has been saved.")
@@ -134,17 +475,23 @@ class BluelabsDataAggregator():
     Class to clean/aggregate bluelabs 
     data to update dashboard
     """
-    def __init__(self):
+    def __init__(self, voter_cache=None, chunk_rows=None):
         """
         Class initiator
+        voter_cache: VoterAttributeCache used by voter_age_zip
+        chunk_rows: rows per chunk to stream the dataset through the
+                    steps instead of loading it whole, defaults to CHUNK_ROWS
         """
-        self.PROJECT_ID = 'hawkfish-prod-0c4ce6d0'
-        self.BUCKET_NAME = 'gabriel_bucket_test'
-        storage_client = storage.Client(project=self.PROJECT_ID)
-        bucket = storage_client.get_bucket(self.BUCKET_NAME)
+        self.voter_cache = voter_cache
+        self.chunk_rows = chunk_rows or CHUNK_ROWS
+        self.bluelabs_data = None
+        if self.chunk_rows:
+            # chunks are read by run()
+            return
         print('-' * 20)
         print("Reading raw bluelabs data..")
-        self.bluelabs_data = pd.read_csv("gcs://gabriel_bucket_test/agg_bluelabs_data.csv")
+        self.bluelabs_data = compact_stage('bluelabs raw data', read_dataset('agg_bluelabs_data'),
+                                           BLUELABS_CATEGORIES)
         print('-' * 20)
         print("Reading complete..")
         print(self.bluelabs_data.shape)
@@ -158,38 +505,9 @@ class BluelabsDataAggregator():
             (self.bluelabs_data.duration_call > 0) & (self.bluelabs_data.qturnoutprimary.notna())
         ]
         # states 
-        split_df = self.bluelabs_data['voterbase_id'].str.split('-', expand=True)
-        self.bluelabs_data['state'] = split_df[0]
+        self.bluelabs_data['state'] = self.bluelabs_data['voterbase_id'].str.split('-').str[0]
         # candidates
-        candidates = ['Joe Biden',
-                     'Bernie Sanders',
-                     'Elizabeth Warren',
-                     'Michael Bloomberg',
-                     '[LEAVE BLANK]',
-                     'Cory Booker',
-                     'Pete Buttigieg',
-                     '[LEAVE BLANK]',
-                     '[LEAVE BLANK]',
-                     'Steve Bullock',
-                     'Kamala Harris',
-                     '[LEAVE BLANK]',
-                     'Julian Castro',
-                     'Amy Klobuchar',
-                     'Andrew Yang',
-                     'Tulsi Gabbard',
-                     '[LEAVE BLANK]',
-                     '[LEAVE BLANK]',
-                     '[LEAVE BLANK]',
-                     'Other',
-                     'Undecided',
-                     'Tom Steyer',
-                     'Michael Bennet']
-
-        order = [i for i in range(1, len(candidates)+1)]
-        candidate_dict = dict(zip(order, candidates))
-        
-        self.bluelabs_data['qsupport'] = self.bluelabs_data['qsupport'].apply(
-                lambda x : candidate_dict[x] if not np.isnan(x) else np.nan)
+        BLUELABS_CODEBOOK.decode(self.bluelabs_data, ['qsupport'])
         
         return self
     
@@ -197,43 +515,19 @@ class BluelabsDataAggregator():
         """
         Function to query voter_base_id file to 
         get zipcode and year born for each voter 
+        Attributes come from the local voter cache, only
+        respondents not cached yet are looked up in big query
         """
         print('-' * 20)
-        print("Start downloading voter_id file")
+        print("Start looking up voter attributes")
         
-        query = """
-        SELECT 
-         bl.voterbase_id,
-         bl.qbyear, 
-         bl.qbyearbucket, 
-         bl.qsex, 
-         pii.vb_vf_reg_zip AS zipcode,
-         pii.vb_voterbase_gender, 
-         pii.vb_voterbase_dob
-        FROM bluelabs_survey_results.all_survey_results AS bl
-        INNER JOIN civis_national_raw.ts_analytics_trimmed AS pii
-        ON bl.voterbase_id = pii.vb_voterbase_id
-      """
-        client = bigquery.Client(location="US")
-        query_job = client.query(
-            query,
-            location="US",
-        )  
-
-        df = query_job.to_dataframe()
+        cache = self.voter_cache or VoterAttributeCache()
+        voters = cache.lookup(self.bluelabs_data['voterbase_id'])
         
         print('-' * 20)
-        print("Voter file has been successfully downloaded. ")
-        df['year'] = [str(x)[:4] for x in df.vb_voterbase_dob]
-        
-        non_zero = df[df.qbyear.notna()]
-        non_zero.qbyear = non_zero.qbyear.astype(int)
-        non_zero.qbyear = non_zero.qbyear.astype(str)
-        non_zero['match'] = np.where(non_zero.qbyear==non_zero.year, 1, 0)
+        print("Voter attributes have been successfully looked up. ")
         
-        self.bluelabs_data = self.bluelabs_data.merge(df[
-            ['voterbase_id','vb_voterbase_gender', 'year', 'zipcode']], 
-            on=['voterbase_id'], how='left')
+        self.bluelabs_data = self.bluelabs_data.join(voters[VOTER_ATTRIBUTES], on='voterbase_id')
         
         self.bluelabs_data['age'] = 2019 - self.bluelabs_data['year'].astype(float)
         
@@ -257,141 +551,32 @@ class BluelabsDataAggregator():
     def decode_cols(self):
         """
         Function to decode columns into real values 
-        NOTE: Probably this code can be further modualized 
-        """
-        # race 
-        self.bluelabs_data.loc[self.bluelabs_data.qrace==1,'race']='White'
-        self.bluelabs_data.loc[self.bluelabs_data.qrace==2,'race']='Black or African American'
-        self.bluelabs_data.loc[self.bluelabs_data.qrace==3,'race']='Hispanic, Latino or Latin-American'
-        self.bluelabs_data.loc[self.bluelabs_data.qrace==4,'race']='Asian, Asian-American or Pacific Islander'
-        self.bluelabs_data.loc[self.bluelabs_data.qrace==5,'race']='Other'
-        self.bluelabs_data.loc[self.bluelabs_data.qrace==6,'race']='Other'
-        self.bluelabs_data.loc[self.bluelabs_data.qrace==7,'race']='Other'
-        self.bluelabs_data.loc[self.bluelabs_data.qrace==8,'race']='Other'
-        self.bluelabs_data.loc[self.bluelabs_data.qrace==9,'race']='No answer'
-        # education 
-        self.bluelabs_data.loc[self.bluelabs_data.qeducation==1, 'education']= 'Did Not Complete High School'
-        self.bluelabs_data.loc[self.bluelabs_data.qeducation==2, 'education']= 'Graduated High School'
-        self.bluelabs_data.loc[self.bluelabs_data.qeducation==3, 'education']= 'Attended college no degree'
-        self.bluelabs_data.loc[self.bluelabs_data.qeducation==4, 'education']= 'Associates degree'
-        self.bluelabs_data.loc[self.bluelabs_data.qeducation==5, 'education']= 'Bachelors degree'
-        self.bluelabs_data.loc[self.bluelabs_data.qeducation==6, 'education']= 'Masters, PhD'
-        self.bluelabs_data.loc[self.bluelabs_data.qeducation==7, 'education']= 'No answer'
-        self.bluelabs_data.loc[self.bluelabs_data.qeducation==8, 'education']= 'No answer'
-        # turnout 
-        self.bluelabs_data['turnout_response'] = ''
-        self.bluelabs_data.loc[self.bluelabs_data['qturnoutprimary']==1,'turnout_response'] = 'Definitely Vote'
-        self.bluelabs_data.loc[self.bluelabs_data['qturnoutprimary']==2,'turnout_response'] = 'Probably Vote'
-        self.bluelabs_data.loc[self.bluelabs_data['qturnoutprimary']==3,'turnout_response'] = '50/50 to vote'
-        self.bluelabs_data.loc[self.bluelabs_data['qturnoutprimary']==4,'turnout_response'] = 'Probably not vote'
-        self.bluelabs_data.loc[self.bluelabs_data['qturnoutprimary']==5,'turnout_response'] = 'Definitely Not Vote'
-        self.bluelabs_data.loc[self.bluelabs_data['qturnoutprimary']==6,'turnout_response'] = 'Don’t know/not sure'
-        self.bluelabs_data.loc[self.bluelabs_data['qturnoutprimary']==7,'turnout_response'] = 'Refused'
-
-        self.bluelabs_data['qturnout'] = ''
-        self.bluelabs_data.loc[self.bluelabs_data.turnout_response.isin(['Definitely Vote', 'Probably Vote' ]), 
-             'qturnout']= 'Very likely I will vote'
-
-        self.bluelabs_data.loc[self.bluelabs_data.turnout_response.isin(['50/50 to vote', 'Don’t know/not sure']), 
-             'qturnout']= '50-50 chance I will vote'
-
-        self.bluelabs_data.loc[self.bluelabs_data.turnout_response.isin(['Definitely Not Vote', 'Probably not vote']), 
-             'qturnout']= 'Very likely I will NOT vote' 
-
-        self.bluelabs_data.loc[self.bluelabs_data.turnout_response.isin(['Refused']), 
-             'qturnout']= 'No answer'
-        # qratepast
-        past_rate = {
-            1: "Bernie Sanders",
-            2: "Hillary Clinton",
-            3: "Other",
-            4: "Not vote",
-            5: "Don't know",
-            6: "Refused"
-        }
-        
-        emp_dict = {
-            1: "Full-time",
-            2: "Part-time",
-            3: "Self-employed",
-            4: "Retired",
-            5: "A student",
-            6: "Disabled",
-            7: "Unemployed",
-            8: "Other",
-            9: "Refused"
-        }
-        
-        religion_dict = {
-            1: "Protestant",
-            2: "Roman Catholic",
-            3: "Mormon",
-            4: "Orthodox",
-            5: "Jewish",
-            6: "Muslim",
-            7: "Buddhist",
-            8: "Hindu",
-            9: "Atheist",
-            10: "Agnostic",
-            11: "Nothing in particular",
-            12: "Just Christian",
-            13: "Unitarian",
-            14: "Something else",
-            15: "Dont't know"
-        }
-        
-        income_dict = {
-            1: "Less than $30,000",
-            2: "$30,000 to less than $40,000",
-            3: "$40,000 to less than $50,000",
-            4: "$50,000 to less than $75,000",
-            5: "$75,000 to less than $100,000",
-            6: "$100,000 to less than $150,000",
-            7: "$150,000 or more",
-            8: "Refused",
-            12: "Other"
-        }
-        
-        race_his = {
-            1: "Yes",
-            2: "No",
-            3: "Refused"
-        }
-
-        self.bluelabs_data['past_vote'] = self.bluelabs_data['qpastvote'].apply(
-                lambda x : past_rate[x] if not np.isnan(x) else np.nan)
-        self.bluelabs_data['employement'] = self.bluelabs_data['qemployed'].apply(
-                lambda x : emp_dict[x] if not np.isnan(x) else np.nan)
-        self.bluelabs_data['religion'] = self.bluelabs_data['qreligion'].apply(
-                lambda x : religion_dict[x] if not np.isnan(x) else np.nan)
-            
-            
-        self.bluelabs_data['income'] = self.bluelabs_data['qincome'].apply(
-                lambda x : income_dict[x] if not np.isnan(x) else np.nan)
-            
-            
-        self.bluelabs_data['racehisp'] = self.bluelabs_data['qracehisp'].apply(
-                lambda x : race_his[x] if not np.isnan(x) else np.nan)
+        using the bluelabs codebook
+        """
+        BLUELABS_CODEBOOK.decode(self.bluelabs_data, [
+            'race', 'education', 'turnout_response', 'qturnout', 'past_vote',
+            'employement', 'religion', 'income', 'racehisp'])
         
         self.bluelabs_data['gender'] = self.bluelabs_data.vb_voterbase_gender
         
-        self.bluelabs_data['disp'] = self.bluelabs_data['disp'].apply(
-                lambda x: 'completed' if x == 1.0 else 'partial')
+        BLUELABS_CODEBOOK.decode(self.bluelabs_data, ['disp'])
         
         return self
         
     
-    def save(self):
+    def recode(self):
         """
-        Function to save the results
+        Function to rename the columns to the combined
+        names and recode the ratings
         """
-
         rate_cols = list(col for col in self.bluelabs_data.columns
                         if col.startswith('qrate') and not col.endswith('text'))
         
+        # gender already holds vb_voterbase_gender (decode_cols); renaming it
+        # as well left two gender columns, which only the csv reader hid
+        self.bluelabs_data = self.bluelabs_data.drop(columns=['vb_voterbase_gender'])
         # change the rate cols 
         self.bluelabs_data = self.bluelabs_data.rename(columns={'voterbase_id':'respondents_id', 
-                            'vb_voterbase_gender':'gender',
                             'qturnout':'turnout',
                             'qrate_ak':'rate_klobuchar',
                             'qrate_ay':'rate_yang', 
@@ -419,31 +604,66 @@ class BluelabsDataAggregator():
        'rate_bloomberg', 'rate_bennet', 'rate_buttigieg', 'rate_bullock',
        'rate_gabbard', 'rate_steyer', 'bloomberg_support']
 
-        for x in cols_to_change: 
-            self.bluelabs_data.loc[(self.bluelabs_data[x]==1)|(self.bluelabs_data[x]==2),x]=1
-            self.bluelabs_data.loc[(self.bluelabs_data[x]==3)|(self.bluelabs_data[x]==4),x]=2
-            self.bluelabs_data.loc[(self.bluelabs_data[x]==5)|(self.bluelabs_data[x]==6),x]=3
-            self.bluelabs_data.loc[(self.bluelabs_data[x]==7)|(self.bluelabs_data[x]==8),x]=4
-            self.bluelabs_data.loc[(self.bluelabs_data[x]==9)|(self.bluelabs_data[x]==10),x]=5
-            self.bluelabs_data.loc[self.bluelabs_data[x]==99,x]=6
-            self.bluelabs_data.loc[self.bluelabs_data[x]==98,x]=6
+        BLUELABS_RATING_SCALE.recode(self.bluelabs_data, cols_to_change)
             
         self.bluelabs_data['evangelical'] = np.nan
-        storage_client = storage.Client(project=self.PROJECT_ID)
-        bucket = storage_client.get_bucket(self.BUCKET_NAME)
-        blob = bucket.blob("bluelabs_superset.csv")
-        blob.upload_from_string(self.bluelabs_data.to_csv(index=False))
+        self.bluelabs_data = compact_stage('bluelabs superset', self.bluelabs_data,
+                                           BLUELABS_CATEGORIES)
+        return self
+
+    def save(self):
+        """
+        Function to save the results
+        """
+        self.recode()
+        write_dataset(self.bluelabs_data, 'bluelabs_superset')
         
         print('-' * 20)
         print("Bluelabs data has been saved.")
         
         return self
     
+    def run_chunked(self):
+        """
+        Driver function streaming the dataset through the same steps
+        chunk_rows rows at a time, appending each chunk to the saved
+        dataset, so memory is bounded by the chunk size
+        The steps only look at one row at a time, so the output is
+        the same as processing the whole dataset
+        """
+        # one cache for all chunks, new voters are looked up chunk by chunk
+        self.voter_cache = self.voter_cache or VoterAttributeCache()
+        # the chunks are streamed from storage, the whole frame a stage
+        # of this run may still hold in memory is dropped
+        flush(['agg_bluelabs_data'])
+        release(['agg_bluelabs_data'])
+        print('-' * 20)
+        print("Streaming bluelabs data in chunks of {} rows..".format(self.chunk_rows))
+        rows = 0
+        with DatasetWriter('bluelabs_superset') as writer:
+            for chunk in iter_dataset('agg_bluelabs_data', self.chunk_rows):
+                rows += len(chunk)
+                self.bluelabs_data = compact_stage('bluelabs raw data', chunk, BLUELABS_CATEGORIES)
+                self.clean()
+                self.voter_age_zip()
+                self.decode_cols()
+                self.recode()
+                writer.write(self.bluelabs_data)
+                print("{} rows processed".format(rows))
+        self.bluelabs_data = None
+
+        print('-' * 20)
+        print("Bluelabs data has been saved ({} of {} rows kept).".format(writer.rows, rows))
+        return self
+
     def run(self):
         """
         Driver function to run everything 
         """
+        if self.chunk_rows:
+            return self.run_chunked()
         self.clean()
         self.voter_age_zip()
         self.decode_cols()
         self.save()
+        return self
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Module to load a dataframe into a date partitioned big
+query table with an explicit schema, replacing only the
+partitions whose rows changed since the last load
+---------------------
+@Author: Gabriel Yin
+"""
+import os
+import json
+import pandas as pd
+from google.cloud import bigquery
+from google.api_core import exceptions as api_exceptions
+import config
+import instrument
+from storage_io import get_bigquery_client
+
+# partition of the rows without a date
+NULL_PARTITION = '__NULL__'
+
+
+def partition_ids(dates):
+    """
+    Function to get the YYYYMMDD partition id of each date
+    """
+    dates = pd.to_datetime(pd.Series(dates).reset_index(drop=True), errors='coerce')
+    return dates.dt.strftime('%Y%m%d').fillna(NULL_PARTITION)
+
+
+def partition_fingerprints(df, partition_col):
+    """
+    Function to fingerprint the rows of each partition,
+    independently of the row order
+    """
+    hashes = pd.util.hash_pandas_object(df, index=False).values.view('int64')
+    frame = pd.DataFrame({'partition': partition_ids(df[partition_col]).values, 'hash': hashes})
+    grouped = frame.groupby('partition')['hash'].agg(['sum', 'size'])
+    return dict((partition, '{}:{}'.format(total, count)) for partition, total, count in
+                zip(grouped.index, grouped['sum'].values, grouped['size'].values))
+
+
+def conform(df, schema):
+    """
+    Function to cast a frame to the columns and types of a schema
+    """
+    df = df[[field.name for field in schema]].copy()
+    for field in schema:
+        col = df[field.name]
+        if field.field_type == 'DATE':
+            df[field.name] = pd.to_datetime(col, errors='coerce').dt.date
+        elif field.field_type in ('FLOAT', 'FLOAT64', 'NUMERIC'):
+            df[field.name] = pd.to_numeric(col, errors='coerce').astype(float)
+        elif field.field_type == 'STRING':
+            df[field.name] = col.astype(object).where(col.notna(), None)
+            df[field.name] = df[field.name].map(lambda x: x if x is None else str(x))
+    return df
+
+
+class PartitionedTableLoader():
+    """
+    Class to keep a day partitioned big query table in
+    sync with a dataframe; the partition fingerprints of
+    the last load are kept in a local json file
+    """
+    def __init__(self, table_id, schema, partition_col='date', state_path=None, client=None,
+                 max_partition_jobs=50, timeout=600):
+        """
+        class initialization
+        table_id: dataset.table to load into
+        schema: list of bigquery.SchemaField, partition_col must be a DATE field
+        max_partition_jobs: above this many changed partitions the
+                            whole table is replaced in one job instead
+        timeout: seconds to wait for each load job
+        """
+        self.table_id = table_id
+        self.schema = schema
+        self.partition_col = partition_col
+        self.state_path = state_path or os.path.join(
+            config.CACHE_DIR, 'bq_partitions_{}.json'.format(table_id.replace('.', '_')))
+        self._client = client
+        self.max_partition_jobs = max_partition_jobs
+        self.timeout = timeout
+        self.state = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = get_bigquery_client()
+        return self._client
+
+    def _job_config(self):
+        job_config = bigquery.LoadJobConfig(
+            schema=self.schema,
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+            time_partitioning=bigquery.TimePartitioning(
+                type_=bigquery.TimePartitioningType.DAY, field=self.partition_col))
+        return job_config
+
+    def _wait(self, job, destination):
+        """
+        Function to block on a load job and raise with its errors
+        """
+        try:
+            job.result(timeout=self.timeout)
+        except Exception as e:
+            errors = getattr(job, 'errors', None) or []
+            raise RuntimeError("Big query load into {} failed: {}{}".format(
+                destination, e, ''.join('\n  ' + str(error.get('message', error)) for error in errors)))
+        return job
+
+    def _load(self, df, destination):
+        with instrument.io('bq_load', destination, direction='write') as call:
+            job = self.client.load_table_from_dataframe(df, destination, job_config=self._job_config())
+            self._wait(job, destination)
+            call['rows'] = len(df)
+        print("Loaded {} rows into {}".format(len(df), destination))
+
+    def _is_partitioned(self):
+        """
+        Function to check whether the table exists with the expected
+        partitioning; None if it does not exist
+        """
+        try:
+            table = self.client.get_table(self.table_id)
+        except api_exceptions.NotFound:
+            return None
+        partitioning = table.time_partitioning
+        return partitioning is not None and partitioning.field == self.partition_col
+
+    def save_state(self):
+        """
+        Function to persist the partition fingerprints
+        """
+        directory = os.path.dirname(self.state_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+        return self
+
+    def load(self, df, full=False):
+        """
+        Function to load df, replacing only the partitions whose
+        rows changed and deleting the partitions of dates no longer
+        in df; each partition is swapped atomically, so readers
+        never see the table missing or half loaded
+        full: set to replace the whole table in one job
+        """
+        df = conform(df, self.schema)
+        current = partition_fingerprints(df, self.partition_col)
+        partitioned = self._is_partitioned()
+        print('-' * 20)
+        if partitioned is False:
+            # legacy table created by autodetect, partitioning can not be
+            # added in place: this is the only load that drops the table
+            print("{} is not partitioned by {}, recreating it".format(self.table_id, self.partition_col))
+            self.client.delete_table(self.table_id)
+            self.state = {}
+            full = True
+        elif partitioned is None:
+            self.state = {}
+            full = True
+
+        changed = sorted(partition for partition, fingerprint in current.items()
+                         if self.state.get(partition) != fingerprint)
+        removed = sorted(set(self.state) - set(current))
+        print("{}: {} of {} partitions changed, {} removed".format(
+            self.table_id, len(changed), len(current), len(removed)))
+
+        if full or len(changed) + len(removed) > self.max_partition_jobs:
+            self._load(df, self.table_id)
+            self.state = current
+            return self.save_state()
+
+        keys = partition_ids(df[self.partition_col]).values
+        for partition in changed:
+            destination = '{}${}'.format(self.table_id, partition)
+            self._load(df[keys == partition], destination)
+            self.state[partition] = current[partition]
+            self.save_state()
+        for partition in removed:
+            destination = '{}${}'.format(self.table_id, partition)
+            self.client.delete_table(destination, not_found_ok=True)
+            print("Deleted partition {}".format(destination))
+            self.state.pop(partition)
+            self.save_state()
+        return self
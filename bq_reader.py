@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Module to read big query tables as arrow record
+batches, requesting only the columns the pipeline uses
+---------------------
+@Author: Gabriel Yin
+"""
+import re
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+from google.cloud import bigquery
+from google.api_core import exceptions as api_exceptions
+import config
+import instrument
+from storage_io import get_bigquery_client
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+try:
+    from google.cloud import bigquery_storage
+except ImportError:
+    bigquery_storage = None
+
+
+def build_query(table, columns=None, where=None):
+    """
+    Function to build the select statement for a table
+    """
+    select = ',\n         '.join('`{}`'.format(col) for col in columns) if columns else '*'
+    query = """
+        SELECT
+         {}
+        FROM {}""".format(select, table)
+    if where:
+        query += "\n        WHERE {}".format(where)
+    return query + ';'
+
+
+class BigQueryReader():
+    """
+    Class to run queries and stream the results as arrow record
+    batches through the big query storage api when available
+    """
+    def __init__(self, client=None, bqstorage_client=None, location=config.LOCATION):
+        """
+        client: any object with the query() interface of bigquery.Client,
+                e.g. LocalQueryClient to run against local frames
+        bqstorage_client: storage api client used to stream the results,
+                          created on demand when the library is installed
+        """
+        self._client = client
+        self._bqstorage_client = bqstorage_client
+        self.location = location
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = get_bigquery_client(location=self.location)
+        return self._client
+
+    @property
+    def bqstorage_client(self):
+        if self._bqstorage_client is None and bigquery_storage is not None \
+                and isinstance(self.client, bigquery.Client):
+            self._bqstorage_client = bigquery_storage.BigQueryReadClient()
+        return self._bqstorage_client
+
+    def query_batches(self, query, job_config=None):
+        """
+        Generator over the arrow record batches of a query result
+        """
+        if pa is None:
+            raise ImportError("pyarrow is required to read big query results as arrow")
+        kwargs = {'location': self.location}
+        if job_config is not None:
+            kwargs['job_config'] = job_config
+        rows = self.client.query(query, **kwargs).result()
+        if hasattr(rows, 'to_arrow_iterable'):
+            for batch in rows.to_arrow_iterable(bqstorage_client=self.bqstorage_client):
+                yield batch
+        else:
+            for batch in rows.to_arrow(bqstorage_client=self.bqstorage_client).to_batches():
+                yield batch
+
+    def query_arrow(self, query, job_config=None):
+        """
+        Function to collect the result of a query into one arrow table
+        """
+        with instrument.io('bq_query', ' '.join(query.split())[:120]) as call:
+            batches = list(self.query_batches(query, job_config=job_config))
+            table = pa.Table.from_batches(batches) if batches else pa.table({})
+            call['rows'], call['bytes'] = table.num_rows, table.nbytes
+        return table
+
+    def query_dataframe(self, query, job_config=None):
+        """
+        Function to run a query into a dataframe; numeric columns
+        without nulls are converted without copying and the arrow
+        buffers are released column by column
+        """
+        table = self.query_arrow(query, job_config=job_config)
+        return table.to_pandas(split_blocks=True, self_destruct=True)
+
+    def read_table(self, table, columns=None, where=None):
+        """
+        Function to read the given columns of a table into a dataframe
+        """
+        return self.query_dataframe(build_query(table, columns, where))
+
+
+def _partition_ids(dates):
+    dates = pd.to_datetime(pd.Series(dates).reset_index(drop=True), errors='coerce')
+    return dates.dt.strftime('%Y%m%d').fillna('__NULL__')
+
+
+class LocalQueryClient():
+    """
+    Local stand-in for bigquery.Client answering simple
+    "SELECT cols FROM table [WHERE col IN UNNEST(@param)]"
+    queries from in-memory frames, and taking (partition)
+    loads from dataframes
+    """
+    _pattern = re.compile(r'SELECT\s+(?P<cols>.+?)\s+FROM\s+(?P<table>[\w.`-]+)'
+                          r'(?:\s+WHERE\s+(?P<where>.+?))?\s*;?\s*$',
+                          re.IGNORECASE | re.DOTALL)
+    _in_pattern = re.compile(r'`?(?P<col>\w+)`?\s+IN\s+UNNEST\(@(?P<param>\w+)\)$', re.IGNORECASE)
+    _alias_pattern = re.compile(r'`?(?P<col>\w+)`?(?:\s+AS\s+`?(?P<alias>\w+)`?)?$', re.IGNORECASE)
+
+    def __init__(self, tables, batch_size=65536):
+        """
+        tables: mapping of table name to dataframe or arrow table
+        batch_size: number of rows per returned record batch
+        """
+        self.tables = tables
+        self.batch_size = batch_size
+        self.queries = []
+        self.loads = []
+        self._indexes = {}
+        self._partitioning = {}
+        self._modified = dict((name, datetime.now(timezone.utc)) for name in tables)
+
+    def _table(self, name):
+        table = self.tables[name]
+        if pa is not None and not isinstance(table, pa.Table):
+            # converted once, later queries reuse the arrow table
+            table = self.tables[name] = pa.Table.from_pandas(table, preserve_index=False)
+        return table
+
+    def query(self, query, location=None, job_config=None):
+        self.queries.append(query)
+        match = self._pattern.match(query.strip())
+        if match is None:
+            raise ValueError("LocalQueryClient cannot run query: {}".format(query))
+        name = match.group('table').strip('`')
+        table = self._table(name)
+        where = match.group('where')
+        if where:
+            table = self._filter(name, table, where.strip(), job_config)
+        cols = match.group('cols').strip()
+        if cols != '*':
+            selected = [self._alias_pattern.match(col.strip()) for col in cols.split(',')]
+            table = table.select([col.group('col') for col in selected])
+            table = table.rename_columns([col.group('alias') or col.group('col') for col in selected])
+        return _LocalJob(table, self.batch_size)
+
+    def _filter(self, name, table, where, job_config):
+        match = self._in_pattern.match(where)
+        if match is None or job_config is None:
+            raise ValueError("LocalQueryClient cannot run filter: {}".format(where))
+        values = next(param.values for param in job_config.query_parameters
+                      if param.name == match.group('param'))
+        # index the column once, so each lookup costs the size of the batch
+        key = (name, match.group('col'))
+        if key not in self._indexes:
+            self._indexes[key] = pd.Index(table.column(match.group('col')).to_pandas())
+        positions = self._indexes[key].get_indexer_for(pd.Index(values).unique())
+        return table.take(pa.array(np.sort(positions[positions >= 0])))
+
+    def _replaced(self, name, table):
+        self.tables[name] = table
+        self._modified[name] = datetime.now(timezone.utc)
+        for key in [key for key in self._indexes if key[0] == name]:
+            del self._indexes[key]
+
+    def _drop_partition(self, name, partition):
+        field = self._partitioning[name].field
+        df = self._table(name).to_pandas()
+        return df[(_partition_ids(df[field]) != partition).values]
+
+    def load_table_from_dataframe(self, df, destination, job_config=None):
+        """
+        Function to load a frame into a table, or into one
+        partition of it with a table$YYYYMMDD destination
+        """
+        name, _, partition = str(destination).partition('$')
+        self.loads.append((str(destination), len(df)))
+        partitioning = getattr(job_config, 'time_partitioning', None)
+        if partitioning is not None:
+            self._partitioning[name] = partitioning
+        if partition and name in self.tables:
+            df = pd.concat([self._drop_partition(name, partition), df], ignore_index=True)
+        self._replaced(name, pa.Table.from_pandas(df, preserve_index=False))
+        return _LocalJob(None, self.batch_size)
+
+    def get_table(self, table_id):
+        name = str(table_id)
+        if name not in self.tables:
+            raise api_exceptions.NotFound("Table {} not found".format(name))
+        return _LocalTable(name, self._table(name).num_rows, self._partitioning.get(name),
+                           self._modified[name])
+
+    def delete_table(self, table_id, not_found_ok=False):
+        name, _, partition = str(table_id).partition('$')
+        if name not in self.tables:
+            if not_found_ok:
+                return
+            raise api_exceptions.NotFound("Table {} not found".format(name))
+        if partition:
+            self._replaced(name, pa.Table.from_pandas(self._drop_partition(name, partition),
+                                                      preserve_index=False))
+        else:
+            del self.tables[name]
+            self._partitioning.pop(name, None)
+
+
+class _LocalTable():
+    """
+    Table metadata of LocalQueryClient
+    """
+    def __init__(self, table_id, num_rows, time_partitioning, modified):
+        self.table_id = table_id
+        self.num_rows = num_rows
+        self.time_partitioning = time_partitioning
+        self.modified = modified
+
+
+class _LocalJob():
+    """
+    Query job of LocalQueryClient
+    """
+    def __init__(self, table, batch_size):
+        self.table = table
+        self.batch_size = batch_size
+        self.errors = None
+
+    def result(self, timeout=None):
+        return self
+
+    def to_arrow_iterable(self, bqstorage_client=None):
+        return iter(self.table.to_batches(max_chunksize=self.batch_size))
+
+    def to_dataframe(self):
+        return self.table.to_pandas()
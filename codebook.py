@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Module with a vectorized engine to decode numeric
+survey codes into labels from a declarative codebook,
+and to recode rating batteries onto another scale
+---------------------
+@Author: Gabriel Yin
+"""
+import numpy as np
+import pandas as pd
+
+
+class Variable():
+    """
+    Definition of one decoded variable
+    """
+    def __init__(self, source, labels, fill=None):
+        """
+        source: column holding the numeric codes
+        labels: mapping of code to label, several codes
+                may share a label (e.g. 5/6/7 -> "Other")
+        fill: label used for missing and unknown codes,
+              missing/unknown codes stay NaN when None
+        """
+        self.source = source
+        self.labels = dict(labels)
+        self.fill = fill
+        self.categories = []
+        for code in sorted(self.labels):
+            if self.labels[code] not in self.categories:
+                self.categories.append(self.labels[code])
+        if fill is not None and fill not in self.categories:
+            self.categories.append(fill)
+        # lookup array from integer code to category position, -1 if unknown
+        self.max_code = int(max(self.labels))
+        self.lookup = np.full(self.max_code + 1, -1, dtype=np.int64)
+        for code, label in self.labels.items():
+            self.lookup[int(code)] = self.categories.index(label)
+
+    def decode(self, series):
+        """
+        Function to decode a series of codes in one pass
+        Returns the categorical series and the counts of
+        unknown (non-missing but unmapped) codes left missing,
+        none when fill takes them
+        """
+        values = pd.to_numeric(series, errors='coerce').astype('float64').to_numpy()
+        valid = ~np.isnan(values)
+        valid[valid] = (values[valid] >= 0) & (values[valid] <= self.max_code) & \
+                       (values[valid] == np.floor(values[valid]))
+        codes = np.full(len(values), -1, dtype=np.int64)
+        codes[valid] = self.lookup[values[valid].astype(np.int64)]
+
+        unknown = {}
+        if self.fill is not None:
+            codes[codes == -1] = self.categories.index(self.fill)
+        else:
+            unknown_mask = series.notna().to_numpy() & (codes == -1)
+            if unknown_mask.any():
+                unknown = series[unknown_mask].value_counts().to_dict()
+
+        decoded = pd.Categorical.from_codes(codes, categories=self.categories)
+        return pd.Series(decoded, index=series.index), unknown
+
+
+class Codebook():
+    """
+    Declarative codebook for one survey source,
+    mapping each output column to its Variable
+    """
+    def __init__(self, name, variables):
+        self.name = name
+        self.variables = variables
+
+    def categories(self, target):
+        return list(self.variables[target].categories)
+
+    def category_sets(self, renames=None):
+        """
+        Function to get the fixed category set of every variable,
+        keyed by output column (optionally renamed)
+        """
+        renames = renames or {}
+        return {renames.get(target, target): self.categories(target)
+                for target in self.variables}
+
+    def sources(self):
+        return list(set(variable.source for variable in self.variables.values()))
+
+    def decode(self, df, targets=None, unknown='nan'):
+        """
+        Function to decode columns of df into their labels
+        targets: output columns to decode, defaults to all
+        unknown: 'nan' to leave unknown codes missing and report
+                 them, 'raise' to fail on any unknown code
+        Returns the counts of the unknown codes of this call, by column
+        """
+        targets = targets or list(self.variables)
+        unknown_codes = {}
+        for target in targets:
+            variable = self.variables[target]
+            df[target], counts = variable.decode(df[variable.source])
+            if counts:
+                unknown_codes[target] = counts
+                message = "{} {}: unknown codes in {} {}".format(
+                    self.name, target, variable.source, counts)
+                if unknown == 'raise':
+                    raise ValueError(message)
+                print(message)
+        return unknown_codes
+
+
+def _restore_dtype(values, series):
+    """
+    Function to give recoded values the integer dtype of the
+    original column when they fit it, floats otherwise
+    """
+    dtype = series.dtype
+    if pd.api.types.is_integer_dtype(dtype):
+        if pd.api.types.is_extension_array_dtype(dtype):
+            return pd.Series(values, index=series.index).astype(dtype)
+        if not np.isnan(values).any():
+            return pd.Series(values.astype(dtype), index=series.index)
+    return pd.Series(values, index=series.index)
+
+
+class RatingScale():
+    """
+    Declarative mapping of a rating scale onto another one,
+    applied to a whole battery of rating columns at once
+    """
+    def __init__(self, name, mapping):
+        """
+        name: label used when reporting unmapped codes
+        mapping: new code -> list of old codes, e.g. {1: [1, 2], 2: [3, 4]}
+        """
+        self.name = name
+        self.mapping = dict((new, list(old)) for new, old in mapping.items())
+        self.max_code = int(max(code for old in self.mapping.values() for code in old))
+        # lookup array from old integer code to new code, NaN if unmapped
+        self.lookup = np.full(self.max_code + 1, np.nan)
+        for new, old in self.mapping.items():
+            self.lookup[np.asarray(old, dtype=np.int64)] = new
+
+    def recode(self, df, columns, unknown='keep'):
+        """
+        Function to recode the rating columns of df in place as
+        one 2-D lookup over the whole block
+        unknown: 'keep' to keep unmapped codes as they are and report
+                 them, 'nan' to leave them missing and report them,
+                 'raise' to fail on any unmapped code
+        Returns the counts of the unmapped codes of this call, by column
+        """
+        columns = list(columns)
+        values = df[columns].to_numpy(dtype='float64', na_value=np.nan)
+        with np.errstate(invalid='ignore'):
+            # missing codes fail every comparison
+            valid = (values >= 0) & (values <= self.max_code) & (values == np.floor(values))
+        recoded = self.lookup[np.where(valid, values, 0).astype(np.int64)]
+        recoded[~valid] = np.nan
+
+        unmapped = np.isnan(recoded) & ~np.isnan(values)
+        unknown_codes = {}
+        for j in np.flatnonzero(unmapped.any(axis=0)):
+            codes, counts = np.unique(values[unmapped[:, j], j], return_counts=True)
+            unknown_codes[columns[j]] = dict(zip(codes.tolist(), counts.tolist()))
+            message = "{} scale: unmapped codes in {} {}".format(
+                self.name, columns[j], unknown_codes[columns[j]])
+            if unknown == 'raise':
+                raise ValueError(message)
+            print(message)
+        if unknown == 'keep':
+            recoded[unmapped] = values[unmapped]
+
+        df[columns] = pd.DataFrame(dict((col, _restore_dtype(recoded[:, j], df[col]))
+                                        for j, col in enumerate(columns)), index=df.index)
+        return unknown_codes
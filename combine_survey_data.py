@@ -1,19 +1,78 @@
 # -*- coding: utf-8 -*-
 import os
+from functools import partial
 import pandas as pd
 import numpy as np
-from google.cloud import storage, bigquery
+from google.cloud import bigquery
+import config
+from storage_io import get_storage
+from bq_load import PartitionedTableLoader
+from phone_lookup import PhoneTypeLookup
 from bluelabs import BluelabsDataLoader, BluelabsDataAggregator
 from survey_monkey import SurveyMonkeyDataLoader
+from datasets import read_dataset, write_dataset, date_index
+from bluelabs import BLUELABS_CATEGORIES
+from survey_monkey import SURVEY_MONKEY_CODEBOOK
+from compact import compact_stage, expand, merge_category_sets
+from dates import normalize_dates
+from aggregate_store import DailyAggregateStore, daily_stats, dashboard_tables
+import aggregate_sql
+from aggregate_shards import sharded_daily_stats
 import warnings
 warnings.filterwarnings("ignore")
 
+# category sets shared by both sources in the combined data
+COMBINED_CATEGORIES = merge_category_sets(
+    BLUELABS_CATEGORIES,
+    SURVEY_MONKEY_CODEBOOK.category_sets({'qturnout': 'turnout',
+                                          'employment_status': 'employement'}))
+
+# engine computing the dashboard aggregations, 'pandas' or
+# 'duckdb' (requires duckdb): SURVEY_AGG_BACKEND=duckdb
+AGG_BACKEND = os.environ.get('SURVEY_AGG_BACKEND', 'pandas')
+# set to recompute the tables with pandas after a duckdb run and
+# fail the stage if they differ: SURVEY_AGG_PARITY=1
+AGG_PARITY = os.environ.get('SURVEY_AGG_PARITY', '0') not in ('', '0')
+# worker processes computing the per-day statistics, with the
+# rows sharded by date; 1 counts them in the stage's process:
+# SURVEY_AGG_WORKERS=8
+AGG_WORKERS = int(os.environ.get('SURVEY_AGG_WORKERS') or 1)
+# backend -> (statistics of rows, dashboard tables of statistics)
+AGG_BACKENDS = {
+    'pandas': (daily_stats, dashboard_tables),
+    'duckdb': (aggregate_sql.daily_stats, aggregate_sql.dashboard_tables),
+}
+
+# big query table with the combined data, partitioned by survey date
+COMBINED_TABLE = 'bluelabs_survey_monkey_combined.bl_sm_support'
+COMBINED_NUMERIC = ['age', 'rate_klobuchar', 'rate_yang', 'rate_sanders', 'rate_booker',
+                    'rate_warren', 'rate_biden', 'rate_castro', 'rate_bloomberg', 'rate_bennet',
+                    'rate_buttigieg', 'rate_gabbard', 'rate_steyer', 'bloomberg_support']
+COMBINED_SCHEMA = [bigquery.SchemaField('date', 'DATE')] + [
+    bigquery.SchemaField(col, 'FLOAT' if col in COMBINED_NUMERIC else 'STRING')
+    for col in ['respondents_id', 'state', 'zipcode', 'gender', 'religion', 'hispanic', 'turnout',
+                'race', 'education', 'age', 'name_first_choice_candidates'] + COMBINED_NUMERIC[1:] +
+    ['age_bin', 'response_status', 'source_id', 'employement', 'income']]
+
 class SurveyDataCombiner():
     """
     Class to combine survey data files
     """
-    def __init__(self):
+    def __init__(self, combine=True, force=False):
+        """
+        class initialization
+        combine: set to build and upload the combined dataset right away
+        force: set to reload the whole big query table
+        """
+        if combine:
+            self.combine(force)
 
+    def combine(self, force=False):
+        """
+        Function to combine bluelabs and survey monkey data
+        and upload it to gcs and big query
+        Only the big query partitions of changed dates are reloaded
+        """
         target_cols = ['date', 'respondents_id', 'state', 'zipcode', 'gender',
        'religion', 'hispanic', 'turnout', 'race',
        'education', 'age', 'name_first_choice_candidates',
@@ -23,136 +82,105 @@ class SurveyDataCombiner():
         'rate_gabbard', 'rate_steyer', 'bloomberg_support', 'age_bin', 'response_status', 'source_id',
                       'employement', 'income']
 
-        self.bl_data = pd.read_csv("gcs://gabriel_bucket_test/bluelabs_superset.csv")
-        self.sm_data = pd.read_csv("gcs://gabriel_bucket_test/agg_surveymonkey_data.csv")
+        # only the target columns are read
+        sm_cols = [col if col != 'employement' else 'employment_status' for col in target_cols]
+        self.bl_data = read_dataset('bluelabs_superset', columns=target_cols)
+        self.sm_data = read_dataset('agg_surveymonkey_data', columns=sm_cols)
         self.sm_data = self.sm_data.rename(columns={'employment_status':'employement'})
+        self.bl_data = compact_stage('bluelabs superset', self.bl_data, COMBINED_CATEGORIES)
+        self.sm_data = compact_stage('survey monkey data', self.sm_data, COMBINED_CATEGORIES)
         self.combined_data = self.bl_data[target_cols].append(self.sm_data[target_cols])
+        self.combined_data = compact_stage('combined data', self.combined_data, COMBINED_CATEGORIES)
         
         self.combined_data.respondents_id = self.combined_data.respondents_id.astype('str')
-        self.combined_data['date'] = self.combined_data['date'].apply(lambda x: '-'.join(['20'+ x.split('/')[2], 
-                                           x.split('/')[0],
-                                           x.split('/')[1]]) if '/' in x else x)
-        self.combined_data['date'] = pd.to_datetime(self.combined_data['date'])
+        self.combined_data['date'] = normalize_dates(self.combined_data['date'])
         
-        PROJECT_ID = 'hawkfish-prod-0c4ce6d0'
-        storage_client = storage.Client(project=PROJECT_ID)
-        bucket = storage_client.get_bucket("gabriel_bucket_test")
         print('-' * 20)
         print('Saving combined dataset..')
-        blob = bucket.blob("bluelabs_surveymonkey_agg.csv")
-        blob.upload_from_string(self.combined_data.to_csv(index=False))
+        write_dataset(self.combined_data, 'bluelabs_surveymonkey_agg')
         print('-' * 20)
         print('Saving complete. Start uploading to big query..')
         
-        bigquery_client = bigquery.Client(project=PROJECT_ID)
-        dataset_ref = bigquery_client.dataset('bluelabs_survey_monkey_combined')
-        trf = bigquery.Table(dataset_ref.table('bl_sm_support'))
-        bigquery_client.delete_table(trf)
-        
-        trf = bigquery.Table(dataset_ref.table('bl_sm_support'))
-        new_table = bigquery_client.create_table(trf)
-        
-        job_config = bigquery.LoadJobConfig()
-        job_config.autodetect = True
-        
-        table_ref = dataset_ref.table('bl_sm_support')
+        PartitionedTableLoader(COMBINED_TABLE, COMBINED_SCHEMA).load(self.combined_data, full=force)
+        print('-' * 20)
+        print('Big query upload complete.')
+        return self
 
-        job = bigquery_client.load_table_from_dataframe(
-        self.combined_data, table_ref, job_config=job_config)
+    def check_parity(self, tables, survey_monkey, bluelabs, bluelabs_phone):
+        """
+        Function to check the dashboard tables of the rows folded
+        in this run against the pandas path, in one process
+        """
+        expected = dashboard_tables(daily_stats(survey_monkey, bluelabs, bluelabs_phone))
+        differences = aggregate_sql.parity(tables, expected)
+        print('-' * 20)
+        if differences:
+            raise RuntimeError("{} dashboard tables with {} workers differ from the pandas path:\n{}".format(
+                AGG_BACKEND, AGG_WORKERS, '\n'.join(differences)))
+        print("{} dashboard tables with {} workers match the pandas path".format(AGG_BACKEND, AGG_WORKERS))
+        return self
 
-    def update_misc_graphs(self):
+    def update_misc_graphs(self, force=False):
         """
         Function to update misc graphs on dashboard
+        force: set to recompute the statistics of every day
+        Only the survey dates whose rows changed since the last
+        run are read and aggregated
         """
         
-        def load_from_gcs(BUCKET_NAME, filename):
-            return pd.read_csv("gcs://" + BUCKET_NAME + '/' + filename)
-        PROJECT_ID = 'hawkfish-prod-0c4ce6d0'
-        bluelabs, survey_monkey = pd.read_csv("gcs://gabriel_bucket_test/bluelabs_superset.csv"), \
-                         pd.read_csv("gcs://gabriel_bucket_test/agg_surveymonkey_data.csv")
-        
-        survey_monkey['candidates'] = survey_monkey['name_first_choice_candidates']
+        storage = get_storage()
+        store = DailyAggregateStore()
+        lookup = PhoneTypeLookup()
+        # only the survey dates whose rows changed upstream are read
+        indexes = dict((name, date_index(name)) for name in ('bluelabs_superset', 'agg_surveymonkey_data'))
+        versions = {'phone_types': lookup.versions()}
+        dates = None if force else store.changed_dates(indexes, versions)
+        graph_cols = ['date', 'source_id', 'respondents_id', 'response_status',
+                      'turnout', 'name_first_choice_candidates']
+        bluelabs, survey_monkey = read_dataset('bluelabs_superset', columns=graph_cols, dates=dates), \
+                         read_dataset('agg_surveymonkey_data', columns=graph_cols, dates=dates)
+        # groupby over categoricals would add unobserved combinations
+        bluelabs, survey_monkey = expand(bluelabs), expand(survey_monkey)
+        
+        # decoded labels may come back as categoricals, relabel as plain strings
+        survey_monkey['candidates'] = survey_monkey['name_first_choice_candidates'].astype(object)
         survey_monkey.loc[survey_monkey.name_first_choice_candidates == 'None of the above',  'candidates'] = 'Other'
         survey_monkey.loc[survey_monkey.name_first_choice_candidates == 'No Answer',  'candidates']= 'Undecided'
         
-        answered = survey_monkey[['date','source_id']].append(bluelabs[['date', 'source_id']])
-        completed = survey_monkey[survey_monkey.response_status=='completed'][['date',
-                    'source_id']].append(bluelabs[bluelabs.response_status=='completed'][['date', 'source_id']])
-
-        temp = answered.groupby(['date'])['source_id'].value_counts().to_frame()
-        temp = temp.rename(columns={'source_id':'answered_counts'}).reset_index()
-
-        survey_counts = completed.groupby(['date'])['source_id'].value_counts().to_frame()
-
-        survey_counts = survey_counts.rename(columns={'source_id':'completed_counts'}).reset_index()
-        survey_counts = survey_counts.merge(temp, on=['date', 'source_id'], how='outer')
-
-
-        # calculate totals for both dashboard
-        temp = answered.date.value_counts().to_frame().reset_index()
-        temp = temp.rename(columns={'date':'answered_counts', 
-                                   'index':'date'})
-        temp_2 = completed.date.value_counts().to_frame().reset_index()
-        temp_2 = temp_2.rename(columns={'date':'completed_counts', 
-                                   'index':'date'})
-        temp_2 = temp_2.merge(temp, on=['date'], how='outer')
-        temp_2['source_id'] = 'totals'
-
-        survey_counts = survey_counts.append(temp_2)
-        
-        bluelabs['candidates'] = bluelabs['name_first_choice_candidates']
-        combo_df = survey_monkey[['candidates', 'date','source_id']].append(bluelabs[['candidates','date', 'source_id']])
-        
-        support_df = combo_df[combo_df.candidates.notna()]
-        candidates = list(support_df.candidates.unique())
-
-        final_dict = {}
-
-        for x in candidates:
-            temp = support_df[support_df.candidates==x]
-            temp_2 = temp.groupby(['date', 
-                                   'source_id'])['candidates'].count()/support_df.groupby(['date', 
-                                                                                   'source_id'])['candidates'].count()
-            final_dict[x] = temp_2
-
-        final_df = pd.DataFrame(final_dict).reset_index()
+        bluelabs['candidates'] = bluelabs['name_first_choice_candidates'].astype(object)
+
+        # join the phone type of each bluelabs respondent from the local lookup
+        bluelabs_phone = lookup.attach(bluelabs, on='respondents_id')
+
+        # fold the changed days into the per-day statistics and derive the tables
+        if AGG_BACKEND not in AGG_BACKENDS:
+            raise ValueError("Unknown aggregation backend {}, expected one of {}".format(
+                AGG_BACKEND, list(AGG_BACKENDS)))
+        compute_stats, compute_tables = AGG_BACKENDS[AGG_BACKEND]
+        if AGG_WORKERS > 1:
+            if AGG_BACKEND == 'duckdb':
+                # each worker's engine gets its share of the cores
+                compute_stats = partial(compute_stats, threads=max(1, (os.cpu_count() or 1) // AGG_WORKERS))
+            compute_stats = partial(sharded_daily_stats, workers=AGG_WORKERS, compute=compute_stats)
+        store.update(survey_monkey, bluelabs, bluelabs_phone, dates=dates, indexes=indexes,
+                     versions=versions, compute=compute_stats)
+        if AGG_PARITY and (AGG_BACKEND != 'pandas' or AGG_WORKERS > 1) and len(store.new_stats):
+            self.check_parity(compute_tables(store.new_stats), survey_monkey, bluelabs, bluelabs_phone)
+        tables = compute_tables(store.stats)
+        candidates = tables['candidates']
+
+        final_df = tables['support']
         final_df = final_df.fillna(0)
         
-        totals_df = pd.DataFrame()
-        for x in candidates:
-            temp = support_df[support_df.candidates==x]
-            temp_2 = temp.groupby(['date'])['source_id'].count()/support_df.groupby(['date'])['source_id'].count()
-            totals_df[x] = temp_2 
+        totals_df = tables['support_totals']
         totals_df = totals_df.fillna(0)
-        totals_df = totals_df.reset_index()
         totals_df['source_id'] ='totals'
         final_df = final_df.append(totals_df)
         
-        final_df = final_df.merge(survey_counts, on=['date', 'source_id'], how='outer')
+        final_df = final_df.merge(tables['survey_counts'], on=['date', 'source_id'], how='outer')
         final_df = final_df.fillna(0)
         
-        turnout_df = survey_monkey[['turnout', 
-                          'date','source_id']].append(bluelabs[['turnout','date', 'source_id']])
-        
-        turnout_df.turnout = turnout_df.turnout.fillna('No answer')
-        responses = list(turnout_df.turnout.unique())
-
-        x = 'No answer'
-        temp = turnout_df.groupby(['date', 
-                             'source_id'])['turnout'].value_counts()/turnout_df.groupby(['date', 
-                             'source_id'])['turnout'].count()
-        temp = temp.to_frame()
-        temp = temp.rename(columns={'turnout':'turnout_percentage'})
-        temp = temp.reset_index()
-
-        totals_turnout = turnout_df.groupby(['date'])['turnout'].value_counts()/\
-                        turnout_df.groupby(['date'])['turnout'].count()
-        totals_turnout = totals_turnout.to_frame()
-        totals_turnout = totals_turnout.rename(columns={'turnout':'turnout_percentage'})
-        totals_turnout = totals_turnout.reset_index()
-        totals_turnout['source_id'] = 'totals'
-
-        totals_turnout = totals_turnout.append(temp)
+        totals_turnout = tables['turnout']
         totals_turnout['turnout_percentage'] = totals_turnout['turnout_percentage'] * 100
 
         final_df = final_df.merge(totals_turnout, on=['date','source_id'], how='outer')
@@ -160,67 +188,25 @@ class SurveyDataCombiner():
         final_df[candidates] = final_df[candidates].astype(float)
         final_df.loc[final_df.source_id=='bluelabs', 'source_id']='BLUELABS'
         final_df.loc[final_df.source_id=='survey_monkey', 'source_id']='SURVEY MONKEY'
-        final_df['date'] = final_df['date'].apply(lambda x: '-'.join(['20'+ x.split('/')[2], 
-                                           x.split('/')[0],
-                                           x.split('/')[1]]) if '/' in x else x)
-        final_df['date'] = pd.to_datetime(final_df['date'])
+        final_df['date'] = normalize_dates(final_df['date'])
 
         final_df['test'] = 'test'
         final_df['qturnout'] = final_df['turnout']
-        tf = pd.read_csv("gcs://togzhan_bucket/survey_dashboard/combined_support_test.csv")
+        tf = storage.read_csv(config.TEMPLATE_BUCKET, 'survey_dashboard/combined_support_test.csv',
+                              nrows=0)
         final_df = final_df[list(tf.columns)]
 
-        storage_client = storage.Client(project=PROJECT_ID)
-        bucket = storage_client.get_bucket("gabriel_bucket_test")
         print('-' * 20)
         print("Saving combined support dataset..")
-        blob = bucket.blob("combined_support_test2.csv")
-        blob.upload_from_string(final_df.to_csv(index=False))
-        
-        phone_types = load_from_gcs('user_ground_truth',
-                         'additional_data/prim_march_20191130_supplement_sample_for_vendor_phonetype.csv')
-
-        phone_types_2 = load_from_gcs('user_ground_truth',
-                                 'additional_data/prim_march_20191130_sample_for_vendor_bilingual_phonetype.csv')
-
-        phone_types_3 = load_from_gcs('user_ground_truth',
-                                 'additional_data/prim_march_20191130_sample_for_vendor_english_phonetype.csv')
-
-
-        phone_types = phone_types.append(phone_types_2).append(phone_types_3)
-
-        # changing the labels, so it's more understandable
-        phone_types.loc[phone_types.phone_type=='L', 'phone_type'] = "Landline"
-        phone_types.loc[phone_types.phone_type=='C', 'phone_type'] = "Cell"
-
-        #merge back with bluelabs data
-        bluelabs = bluelabs.merge(phone_types, left_on='respondents_id', 
-                                  right_on='voterbase_id', how='left')
+        storage.write_csv(final_df, config.WORK_BUCKET, "combined_support_test2.csv")
         
-        
-        # count support for all candidates for all phone types
-        bl_support_df = bluelabs[bluelabs.candidates.notna()]
-        bl_final_dict = {}
-        for x in candidates:
-            # subset for this candidate only
-            temp = bl_support_df[bl_support_df.candidates==x]
-            temp_2 = temp.groupby(['date', 'source_id'])['candidates'].count()/\
-                    bl_support_df.groupby(['date', 'source_id'])['candidates'].count()
-            bl_final_dict[x] = temp_2
-
-        bl_final_df = pd.DataFrame(bl_final_dict).reset_index()
+        # support for all candidates for all phone types
+        bl_final_df = tables['bl_support']
         bl_final_df = bl_final_df.drop(columns=['source_id'])
         bl_final_df['phone_type'] ='totals' 
         
-        # count support by candidates but now for phone type
-        bl_phone_dict = {}
-        for x in candidates:
-            temp = bl_support_df[bl_support_df.candidates==x]
-            temp_2 = temp.groupby(['date', 'phone_type'])['candidates'].count()/\
-                            bl_support_df.groupby(['date', 'phone_type'])['candidates'].count()
-            bl_phone_dict[x] = temp_2
-
-        bl_phone_df = pd.DataFrame(bl_phone_dict).reset_index()
+        # support by candidates but now for phone type
+        bl_phone_df = tables['bl_phone']
         
         bl_final_df = bl_final_df.append(bl_phone_df)
         bl_final_df = bl_final_df.sort_values(by='date')
@@ -228,34 +214,24 @@ class SurveyDataCombiner():
         bl_final_df = bl_final_df.fillna(0)
         
         def saving_to_gcs(filepath, df, bucket_name):
-            bucket = storage_client.get_bucket(bucket_name)
-            blob = bucket.blob(filepath)
-            blob.upload_from_string(df.to_csv(index=False))
+            storage.write_csv(df, bucket_name, filepath)
             
-        bucket_name = 'gabriel_bucket_test'
+        bucket_name = config.WORK_BUCKET
         filepath = "bluelabs_support2.csv"
         print('-' * 20)
         print("Saving bl support dataset..")
         saving_to_gcs(filepath, bl_final_df, bucket_name)
         
-        sm_support_df = survey_monkey
-
-        sm_final_dict = {}
-        for x in candidates:
-            temp = sm_support_df[sm_support_df.candidates==x]
-            temp_2 = temp.groupby(['date', 'source_id'])['candidates'].count()/\
-                    sm_support_df.groupby(['date', 'source_id'])['candidates'].count()
-            sm_final_dict[x]=temp_2
-
-        sm_final_df = pd.DataFrame(sm_final_dict).reset_index()
+        sm_final_df = tables['sm_support']
         sm_final_df = sm_final_df.sort_values(by=['date'])
         sm_final_df = sm_final_df.drop(columns=['source_id'])
         # sm_final_df['qturnout'] = 'totals'
         sm_final_df = sm_final_df.fillna(0)
         
         sm_final_df[candidates] = sm_final_df[candidates]*100
-        bucket_name = 'gabriel_bucket_test'
+        bucket_name = config.WORK_BUCKET
         print('-' * 20)
         print("Saving sm support dataset..")
         filepath = "sm_support2.csv"
         saving_to_gcs(filepath, sm_final_df, bucket_name)
+        return self
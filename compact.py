@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Module to convert survey frames into a compact
+representation: categoricals with fixed category sets
+for low cardinality labels and small nullable integers
+for survey answer codes
+---------------------
+@Author: Gabriel Yin
+"""
+import os
+import numpy as np
+import pandas as pd
+
+# compact mode is opt-in: SURVEY_COMPACT_DTYPES=1
+ENABLED = os.environ.get('SURVEY_COMPACT_DTYPES', '0') == '1'
+
+AGE_BINS = ['Millenials', 'Gen_X', 'Boomer', 'Silent_Generation']
+
+# fixed category sets that do not come from a codebook
+BASE_CATEGORIES = {
+    'age_bin': AGE_BINS,
+    'source_id': ['bluelabs', 'survey_monkey'],
+    'response_status': ['completed', 'partial'],
+}
+
+# low cardinality label columns stored as categoricals
+CATEGORICAL_COLUMNS = ['state', 'race', 'education', 'party', 'turnout', 'qturnout',
+                       'turnout_response', 'age_bin', 'name_first_choice_candidates',
+                       'name_second_choice_candidates', 'qsupport', 'source_id',
+                       'response_status', 'disp', 'gender', 'vb_voterbase_gender',
+                       'religion', 'income', 'employement', 'employment_status',
+                       'hispanic', 'racehisp', 'evangelical', 'past_vote']
+
+_INT_DTYPES = [('Int8', np.iinfo(np.int8)), ('Int16', np.iinfo(np.int16)),
+               ('Int32', np.iinfo(np.int32))]
+
+
+def merge_category_sets(*category_sets):
+    """
+    Function to merge several {column: categories} mappings,
+    keeping the order of first appearance
+    """
+    merged = {}
+    for category_set in category_sets:
+        for col, categories in category_set.items():
+            current = merged.setdefault(col, [])
+            current.extend(cat for cat in categories if cat not in current)
+    return merged
+
+
+def is_code_column(col):
+    """
+    Function to tell whether a column holds survey answer codes
+    """
+    return (col.startswith('q') or col.startswith('rate_') or col == 'bloomberg_support') \
+        and not col.endswith('_text')
+
+
+def to_categorical(series, categories=None):
+    """
+    Function to convert a series to a categorical with a fixed
+    category set; observed values outside the set are appended
+    rather than lost
+    """
+    if pd.api.types.is_categorical_dtype(series):
+        observed = list(series.cat.categories)
+    else:
+        observed = sorted(series.dropna().unique(), key=str)
+    categories = list(categories or [])
+    categories.extend(val for val in observed if val not in categories)
+    if pd.api.types.is_categorical_dtype(series):
+        return series.cat.set_categories(categories)
+    return series.astype(pd.CategoricalDtype(categories))
+
+
+def to_small_int(series):
+    """
+    Function to downcast integral codes to the smallest nullable
+    integer dtype, leaving the series untouched if it is not integral
+    """
+    if not pd.api.types.is_numeric_dtype(series) or pd.api.types.is_bool_dtype(series):
+        return series
+    values = series.dropna()
+    if len(values) and not np.array_equal(values, np.floor(values)):
+        return series
+    low, high = (values.min(), values.max()) if len(values) else (0, 0)
+    for dtype, info in _INT_DTYPES:
+        if info.min <= low and high <= info.max:
+            return series.astype(dtype)
+    return series.astype('Int64')
+
+
+def compact(df, categories=None, codes=()):
+    """
+    Function to convert a frame into the compact representation
+    categories: {column: fixed categories}, e.g. from the codebooks
+    codes: code columns to downcast on top of the survey answer columns
+    """
+    categories = merge_category_sets(BASE_CATEGORIES, categories or {})
+    for col in df.columns:
+        if col in CATEGORICAL_COLUMNS and (df[col].dtype == object or
+                                           pd.api.types.is_categorical_dtype(df[col])):
+            df[col] = to_categorical(df[col], categories.get(col))
+        elif col in codes or is_code_column(col):
+            df[col] = to_small_int(df[col])
+    return df
+
+
+def expand(df):
+    """
+    Function to turn categoricals back into plain object columns,
+    for code that relies on groupby over observed values only
+    """
+    for col in df.columns:
+        if pd.api.types.is_categorical_dtype(df[col]):
+            df[col] = df[col].astype(object)
+    return df
+
+
+def memory_usage_mb(df):
+    return df.memory_usage(deep=True).sum() / 1e6
+
+
+def compact_stage(stage, df, categories=None, codes=()):
+    """
+    Function to compact a frame at a stage boundary when compact
+    mode is enabled, printing the before/after memory footprint
+    """
+    if not ENABLED:
+        return df
+    before = memory_usage_mb(df)
+    df = compact(df, categories=categories, codes=codes)
+    after = memory_usage_mb(df)
+    print("{}: {:.1f} MB -> {:.1f} MB ({:.0%} saved)".format(
+        stage, before, after, 1 - after / before if before else 0))
+    return df
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+Module with the project, bucket and local path
+settings shared by all pipeline stages
+---------------------
+@Author: Gabriel Yin
+"""
+import os
+
+PROJECT_ID = os.environ.get('SURVEY_PROJECT_ID', 'hawkfish-prod-0c4ce6d0')
+LOCATION = 'US'
+
+# bucket with the raw bluelabs returns and the phone type supplements
+RAW_BUCKET = 'user_ground_truth'
+# bucket with the intermediate datasets and the dashboard tables
+WORK_BUCKET = 'gabriel_bucket_test'
+# bucket with the dashboard column template
+TEMPLATE_BUCKET = 'togzhan_bucket'
+
+# storage backend: 'gcs', or 'local:<directory>' to run on local files,
+# where <directory>/<bucket>/<name> stands in for gs://<bucket>/<name>
+STORAGE = os.environ.get('SURVEY_STORAGE', 'gcs')
+
+# local directories for downloaded raw files and persisted caches
+RAW_DATA_DIR = os.environ.get('SURVEY_RAW_DATA_DIR', 'survey_raw_data')
+CACHE_DIR = os.environ.get('SURVEY_CACHE_DIR', 'survey_cache')
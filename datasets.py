@@ -0,0 +1,573 @@
+# -*- coding: utf-8 -*-
+"""
+Module to read and write the intermediate survey datasets
+either as the legacy single csv blobs or as parquet datasets
+partitioned by survey date
+Datasets written in this process are kept in memory and read
+back from there, while persisting happens in the background
+---------------------
+@Author: Gabriel Yin
+"""
+import os
+import json
+import uuid
+import atexit
+import threading
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+import config
+import instrument
+from storage_io import get_storage
+from upload import compressed_name, CsvStream
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.dataset as ds
+    import pyarrow.fs as pafs
+except ImportError:
+    pa = None
+
+# name of the hive partition column added to parquet datasets
+PARTITION_COL = 'survey_date'
+
+# storage format used when a writer is not told otherwise:
+# 'csv' (legacy, what the dashboard reads), 'parquet' or 'both'
+DEFAULT_FORMAT = os.environ.get('SURVEY_DATASET_FORMAT', 'csv')
+
+# compression of the csv copies: unset, 'gzip' or 'zstd'
+CSV_COMPRESSION = os.environ.get('SURVEY_CSV_COMPRESSION') or None
+
+# known intermediate datasets and the column holding their survey date
+DATASETS = {
+    'agg_bluelabs_data': {'bucket': config.WORK_BUCKET, 'date_col': 'date_called'},
+    'bluelabs_superset': {'bucket': config.WORK_BUCKET, 'date_col': 'date'},
+    'agg_surveymonkey_data': {'bucket': config.WORK_BUCKET, 'date_col': 'date'},
+    'bluelabs_surveymonkey_agg': {'bucket': config.WORK_BUCKET, 'date_col': 'date'},
+}
+
+
+# datasets written in this process, by name, their pending writes
+# and the date indexes written with them
+_memory = {}
+_pending = {}
+_indexes = {}
+_lock = threading.Lock()
+_writer = None
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("pyarrow is required for the parquet dataset format")
+
+
+def partition_keys(dates):
+    """
+    Function to turn survey dates (any format pandas can parse)
+    into the ISO strings used as partition values
+    """
+    keys = pd.to_datetime(pd.Series(dates), errors='coerce').dt.strftime('%Y-%m-%d')
+    return keys.fillna('unknown')
+
+
+def date_hashes(df, date_col):
+    """
+    Function to sum the row hashes of every survey date, an order
+    independent digest of the rows of each date
+    Returns a dict of partition key to [hash sum, rows]
+    """
+    frame = pd.DataFrame({'key': partition_keys(df[date_col]).values,
+                          'hash': pd.util.hash_pandas_object(df, index=False).values})
+    grouped = frame.groupby('key')['hash'].agg(['sum', 'size'])
+    return dict((key, [int(total) % 2 ** 64, int(count)]) for key, total, count in
+                zip(grouped.index, grouped['sum'].values, grouped['size'].values))
+
+
+def merge_date_hashes(hashes, other):
+    """
+    Function to add the date hashes of more rows to hashes
+    """
+    for key, (total, count) in other.items():
+        previous = hashes.get(key, [0, 0])
+        hashes[key] = [(previous[0] + total) % 2 ** 64, previous[1] + count]
+    return hashes
+
+
+def _index_name(name):
+    return '{}.dates.json'.format(name)
+
+
+def _save_index(storage, name, hashes):
+    """
+    Function to write the date index of a dataset next to it
+    """
+    index = dict((key, '{}-{}'.format(total, count)) for key, (total, count) in hashes.items())
+    storage.write_bytes(json.dumps(index, sort_keys=True).encode('utf-8'), DATASETS[name]['bucket'],
+                        _index_name(name), content_type='application/json')
+    with _lock:
+        _indexes[name] = index
+
+
+def _drop_index(storage, name):
+    """
+    Function to delete the date index of a dataset about to be
+    replaced, so a failed write never leaves a stale index
+    """
+    with _lock:
+        _indexes.pop(name, None)
+    storage.delete(DATASETS[name]['bucket'], _index_name(name))
+
+
+def date_index(name):
+    """
+    Function to get the fingerprint of every survey date of a stored
+    dataset, a dict of partition key to fingerprint which changes
+    whenever the rows of that date change; None if the dataset was
+    written without one
+    """
+    flush([name])
+    with _lock:
+        index = _indexes.get(name)
+    if index is not None:
+        return index
+    storage = get_storage()
+    if storage.info(DATASETS[name]['bucket'], _index_name(name)) is None:
+        return None
+    return json.loads(storage.read_bytes(DATASETS[name]['bucket'], _index_name(name)).decode('utf-8'))
+
+
+def _files(filesystem, path):
+    """
+    Function to list the files under a directory, relative to it
+    """
+    selector = pafs.FileSelector(path, recursive=True, allow_not_found=True)
+    return [os.path.relpath(info.path, path) for info in filesystem.get_file_info(selector)
+            if info.type == pafs.FileType.File]
+
+
+def _move_files(filesystem, source, target):
+    """
+    Function to move the files under source to target, one by
+    one as object stores have no directory rename
+    """
+    for relpath in _files(filesystem, source):
+        destination = os.path.join(target, relpath)
+        filesystem.create_dir(os.path.dirname(destination))
+        filesystem.move(os.path.join(source, relpath), destination)
+
+
+def _delete_dir(filesystem, path):
+    """
+    Function to delete a directory, if there is one
+    """
+    try:
+        filesystem.delete_dir(path)
+    except FileNotFoundError:
+        pass
+
+
+def _publish_parquet(storage, bucket_name, staged_name, name):
+    """
+    Function to replace a parquet dataset with the files staged
+    under staged_name; writers always write the whole dataset,
+    so partitions of dates no longer present are deleted too
+    The old copy is moved aside first and only deleted once the
+    staged files are in place, or moved back if that fails
+    """
+    filesystem, staged = storage.arrow_filesystem(bucket_name, staged_name)
+    _, path = storage.arrow_filesystem(bucket_name, name)
+    _, retired = storage.arrow_filesystem(bucket_name, '{}.old'.format(staged_name))
+    old_files = set(_files(filesystem, path))
+    try:
+        _move_files(filesystem, path, retired)
+        _move_files(filesystem, staged, path)
+    except Exception:
+        for relpath in _files(filesystem, path):
+            if relpath not in old_files:
+                filesystem.delete_file(os.path.join(path, relpath))
+        _move_files(filesystem, retired, path)
+        _delete_dir(filesystem, retired)
+        raise
+    _delete_dir(filesystem, retired)
+    _delete_dir(filesystem, staged)
+
+
+def _persist(df, name, fmt):
+    spec = DATASETS[name]
+    storage = get_storage()
+    _drop_index(storage, name)
+    if fmt in ('csv', 'both'):
+        storage.write_csv(df, spec['bucket'], compressed_name(name + '.csv', CSV_COMPRESSION),
+                          compression=CSV_COMPRESSION)
+    if fmt in ('parquet', 'both'):
+        _require_pyarrow()
+        table = pa.Table.from_pandas(
+            df.assign(**{PARTITION_COL: partition_keys(df[spec['date_col']]).values}),
+            preserve_index=False)
+        # staged next to the dataset, which is then replaced as a whole
+        staged_name = '{}.{}.staging'.format(name, uuid.uuid4().hex[:8])
+        filesystem, staged = storage.arrow_filesystem(spec['bucket'], staged_name)
+        with instrument.io('write_parquet', name, direction='write') as call:
+            try:
+                ds.write_dataset(table, staged, filesystem=filesystem, format='parquet',
+                                 partitioning=[PARTITION_COL], partitioning_flavor='hive',
+                                 existing_data_behavior='overwrite_or_ignore')
+                _publish_parquet(storage, spec['bucket'], staged_name, name)
+            except Exception:
+                _delete_dir(filesystem, staged)
+                raise
+            call['rows'], call['bytes'] = table.num_rows, table.nbytes
+    _save_index(storage, name, date_hashes(df, spec['date_col']))
+    print("Dataset {} persisted".format(name))
+
+
+def write_dataset(df, name, fmt=None, background=True):
+    """
+    Function to write an intermediate dataset
+    The frame is kept in memory for the readers in this process, so
+    it must not be modified afterwards, and persisted to storage in
+    a background thread unless background is off; flush() waits
+    for the pending writes
+    fmt: 'csv', 'parquet' or 'both', defaults to DEFAULT_FORMAT
+    """
+    global _writer
+    fmt = fmt or DEFAULT_FORMAT
+    if fmt not in ('csv', 'parquet', 'both'):
+        raise ValueError("Unknown dataset format: {}".format(fmt))
+    if name not in DATASETS:
+        raise KeyError("Unknown dataset: {}".format(name))
+    with _lock:
+        previous = _pending.pop(name, None)
+    if previous is not None:
+        # writes of the same dataset must land in order
+        previous.result()
+    with _lock:
+        _memory[name] = df
+        if not background:
+            future = None
+        else:
+            if _writer is None:
+                _writer = ThreadPoolExecutor(max_workers=2)
+            # the write is accounted to the stage that wrote the dataset
+            future = _pending[name] = _writer.submit(instrument.bind(_persist), df, name, fmt)
+    if future is None:
+        _persist(df, name, fmt)
+    return future
+
+
+def flush(names=None):
+    """
+    Function to wait for the pending background writes
+    (of the given datasets, or all of them)
+    Raises RuntimeError listing the datasets that failed to persist
+    """
+    with _lock:
+        names = list(_pending) if names is None else [name for name in names if name in _pending]
+        futures = dict((name, _pending.pop(name)) for name in names)
+    failed = []
+    for name, future in futures.items():
+        try:
+            future.result()
+        except Exception as e:
+            failed.append(name)
+            print("Failed to persist dataset {}: {}".format(name, e))
+    if failed:
+        raise RuntimeError("Datasets failed to persist: {}".format(failed))
+
+
+# pending writes are still reported if nobody flushed them
+atexit.register(flush)
+
+
+def release(names=None):
+    """
+    Function to drop datasets from memory, later
+    reads go back to storage
+    """
+    with _lock:
+        for name in list(_memory) if names is None else names:
+            _memory.pop(name, None)
+
+
+def _filter_dates(df, date_col, dates=None, start=None, end=None):
+    """
+    Function to keep the rows of df within the survey dates
+    """
+    keys = partition_keys(df[date_col]).values
+    mask = pd.Series(True, index=df.index)
+    if dates is not None:
+        mask &= pd.Series(keys, index=df.index).isin(list(partition_keys(dates)))
+    if start is not None:
+        mask &= keys >= partition_keys([start])[0]
+    if end is not None:
+        mask &= keys <= partition_keys([end])[0]
+    return df[mask.values]
+
+
+def read_dataset(name, fmt=None, columns=None, dates=None, start=None, end=None):
+    """
+    Function to read an intermediate dataset
+    columns: optional list of columns to read
+    dates: optional list of survey dates to keep
+    start, end: optional inclusive survey date range to keep
+    A dataset written in this process is served from memory, with
+    its dtypes, instead of being parsed again
+    For parquet the column projection and date filters are pushed
+    down to the reader; for csv they are applied while/after parsing
+    With fmt 'both' the parquet copy is read
+    """
+    fmt = fmt or DEFAULT_FORMAT
+    spec = DATASETS[name]
+    with _lock:
+        df = _memory.get(name)
+    if df is not None:
+        with instrument.io('memory_read', name) as call:
+            if dates is not None or start is not None or end is not None:
+                df = _filter_dates(df, spec['date_col'], dates, start, end)
+            # a copy, so readers can modify it freely
+            df = df[list(columns)] if columns is not None else df.copy()
+            call['rows'] = len(df)
+        return df
+    if fmt in ('parquet', 'both'):
+        _require_pyarrow()
+        filters = []
+        if dates is not None:
+            filters.append((PARTITION_COL, 'in', list(partition_keys(dates))))
+        if start is not None:
+            filters.append((PARTITION_COL, '>=', partition_keys([start])[0]))
+        if end is not None:
+            filters.append((PARTITION_COL, '<=', partition_keys([end])[0]))
+        filesystem, path = get_storage().arrow_filesystem(spec['bucket'], name)
+        with instrument.io('read_parquet', name) as call:
+            if dates is not None and not len(dates):
+                # arrow rejects an empty 'in' filter, only the schema is read
+                table = ds.dataset(path, filesystem=filesystem, format='parquet',
+                                   partitioning='hive').schema.empty_table()
+                table = table.select(list(columns)) if columns is not None else table
+            else:
+                table = pq.read_table(path, filesystem=filesystem, columns=columns,
+                                      filters=filters or None)
+            call['rows'], call['bytes'] = table.num_rows, table.nbytes
+        df = table.to_pandas()
+        return df.drop(columns=[PARTITION_COL], errors='ignore')
+
+    usecols = columns
+    if columns is not None and (dates is not None or start is not None or end is not None) \
+            and spec['date_col'] not in columns:
+        usecols = list(columns) + [spec['date_col']]
+    df = get_storage().read_csv(spec['bucket'], compressed_name(name + '.csv', CSV_COMPRESSION),
+                                usecols=usecols)
+    if dates is not None or start is not None or end is not None:
+        df = _filter_dates(df, spec['date_col'], dates, start, end)
+    if columns is not None:
+        df = df[list(columns)]
+    return df
+
+
+def _resolve_dtypes(chunk_dtypes):
+    """
+    Function to find the columns whose dtype differs between csv
+    chunks and the dtype parsing the whole file would give them:
+    float when the chunks mix integers and floats, object otherwise
+    """
+    resolved = {}
+    for col in chunk_dtypes[0] if chunk_dtypes else []:
+        dtypes = set(dtypes[col] for dtypes in chunk_dtypes)
+        if len(dtypes) == 1:
+            continue
+        numeric = all(pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_float_dtype(dtype)
+                      for dtype in dtypes)
+        resolved[col] = 'float64' if numeric else object
+    return resolved
+
+
+def iter_dataset(name, chunk_rows, fmt=None, columns=None):
+    """
+    Generator over an intermediate dataset in frames of at most
+    chunk_rows rows, in the order read_dataset returns them and
+    with the same dtypes, so memory is bounded by one frame unless
+    the dataset is held in memory (see release)
+    A csv copy is parsed twice: once to settle the dtype of the
+    columns pandas infers differently from chunk to chunk
+    """
+    fmt = fmt or DEFAULT_FORMAT
+    spec = DATASETS[name]
+    with _lock:
+        df = _memory.get(name)
+    if df is not None:
+        for start in range(0, len(df), chunk_rows):
+            with instrument.io('memory_read', name) as call:
+                chunk = df.iloc[start:start + chunk_rows]
+                chunk = chunk[list(columns)] if columns is not None else chunk.copy()
+                call['rows'] = len(chunk)
+            yield chunk
+        return
+    if fmt in ('parquet', 'both'):
+        _require_pyarrow()
+        filesystem, path = get_storage().arrow_filesystem(spec['bucket'], name)
+        dataset = ds.dataset(path, filesystem=filesystem, format='parquet', partitioning='hive')
+        for batch in dataset.to_batches(columns=columns, batch_size=chunk_rows):
+            yield batch.to_pandas().drop(columns=[PARTITION_COL], errors='ignore')
+        return
+
+    csv_name = compressed_name(name + '.csv', CSV_COMPRESSION)
+    storage = get_storage()
+    dtypes = _resolve_dtypes([chunk.dtypes.to_dict() for chunk in
+                              storage.read_csv_chunks(spec['bucket'], csv_name, chunk_rows, usecols=columns)])
+    for chunk in storage.read_csv_chunks(spec['bucket'], csv_name, chunk_rows, usecols=columns,
+                                         dtype=dtypes or None):
+        yield chunk[list(columns)] if columns is not None else chunk
+
+
+class DatasetWriter():
+    """
+    Class to write an intermediate dataset frame by frame, for
+    datasets too large to hold in memory; frames are staged next
+    to the stored dataset, which is only replaced as a whole by close()
+    The next frame is prepared while the previous one uploads
+    """
+    def __init__(self, name, fmt=None):
+        """
+        class initialization
+        fmt: 'csv', 'parquet' or 'both', defaults to DEFAULT_FORMAT
+        """
+        self.name = name
+        self.fmt = fmt or DEFAULT_FORMAT
+        if self.fmt not in ('csv', 'parquet', 'both'):
+            raise ValueError("Unknown dataset format: {}".format(self.fmt))
+        if self.fmt in ('parquet', 'both'):
+            _require_pyarrow()
+        self.spec = DATASETS[name]
+        self.storage = get_storage()
+        self.rows = 0
+        self.token = uuid.uuid4().hex[:8]
+        self.csv_name = compressed_name(name + '.csv', CSV_COMPRESSION)
+        self.staged_csv = '{}.{}.part'.format(self.csv_name, self.token)
+        self.staged_parquet = '{}.{}.staging'.format(name, self.token)
+        self.schema = None
+        self.hashes = {}
+        self._raw = None
+        self._csv = None
+        self._previous = None
+        self._uploader = ThreadPoolExecutor(max_workers=1)
+        # a later read must not see an older copy of the dataset
+        flush([name])
+        release([name])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _append(self, df):
+        merge_date_hashes(self.hashes, date_hashes(df, self.spec['date_col']))
+        if self.fmt in ('csv', 'both'):
+            if self._csv is None:
+                self._raw = self.storage.open_write(self.spec['bucket'], self.staged_csv)
+                self._csv = CsvStream(self._raw, compression=CSV_COMPRESSION)
+            with instrument.io('write_csv_chunk', self.csv_name, direction='write') as call:
+                before = self._csv.counter.bytes_written
+                self._csv.write(df)
+                call['rows'], call['bytes'] = len(df), self._csv.counter.bytes_written - before
+        if self.fmt in ('parquet', 'both') and len(df):
+            df = df.assign(**{PARTITION_COL: partition_keys(df[self.spec['date_col']]).values})
+            if self.schema is None:
+                schema = pa.Schema.from_pandas(df, preserve_index=False)
+                # all missing columns of the first frame are kept as strings
+                self.schema = pa.schema([field.with_type(pa.string()) if field.type == pa.null() else field
+                                         for field in schema], metadata=schema.metadata)
+            table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+            filesystem, path = self.storage.arrow_filesystem(self.spec['bucket'], self.staged_parquet)
+            with instrument.io('write_parquet_chunk', self.name, direction='write') as call:
+                ds.write_dataset(table, path, filesystem=filesystem, format='parquet',
+                                 partitioning=[PARTITION_COL], partitioning_flavor='hive',
+                                 basename_template='part-{}-{}-{{i}}.parquet'.format(self.token, self.rows),
+                                 existing_data_behavior='overwrite_or_ignore')
+                call['rows'], call['bytes'] = table.num_rows, table.nbytes
+
+    def _wait(self):
+        if self._previous is not None:
+            previous, self._previous = self._previous, None
+            previous.result()
+
+    def write(self, df):
+        """
+        Function to append a frame, which must not be modified afterwards
+        """
+        self._wait()
+        self._previous = self._uploader.submit(instrument.bind(self._append), df)
+        self.rows += len(df)
+        return self
+
+    def close(self):
+        """
+        Function to finish the upload and replace the stored dataset
+        """
+        try:
+            self._wait()
+            _drop_index(self.storage, self.name)
+            if self.fmt in ('csv', 'both'):
+                if self._csv is None:
+                    raise ValueError("No frames written to dataset {}".format(self.name))
+                self._csv.close()
+                self._raw.close()
+                self._raw = None
+                self.storage.rename(self.spec['bucket'], self.staged_csv, self.csv_name)
+            if self.fmt in ('parquet', 'both'):
+                _publish_parquet(self.storage, self.spec['bucket'], self.staged_parquet, self.name)
+            _save_index(self.storage, self.name, self.hashes)
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._uploader.shutdown()
+        print("Dataset {} persisted ({} rows, chunked)".format(self.name, self.rows))
+        return self
+
+    def abort(self):
+        """
+        Function to drop what was staged, leaving the stored dataset as it was
+        """
+        try:
+            self._wait()
+        except Exception:
+            pass
+        self._uploader.shutdown()
+        if self._raw is not None:
+            self._raw.close()
+            self._raw = None
+        if self.fmt in ('csv', 'both'):
+            self.storage.delete(self.spec['bucket'], self.staged_csv)
+        if self.fmt in ('parquet', 'both'):
+            filesystem, staged = self.storage.arrow_filesystem(self.spec['bucket'], self.staged_parquet)
+            _delete_dir(filesystem, staged)
+        return self
+
+
+def dataset_version(name, fmt=None):
+    """
+    Function to get the version of a stored dataset, which
+    changes whenever it is rewritten; None if it is missing
+    """
+    fmt = fmt or DEFAULT_FORMAT
+    spec = DATASETS[name]
+    flush([name])
+    storage = get_storage()
+    versions = {}
+    if fmt in ('csv', 'both'):
+        csv_name = compressed_name(name + '.csv', CSV_COMPRESSION)
+        info = storage.info(spec['bucket'], csv_name)
+        if info is None:
+            return None
+        versions[csv_name] = info.generation
+    if fmt in ('parquet', 'both'):
+        objects = dict((obj.name, obj.generation)
+                       for obj in storage.list(spec['bucket'], prefix=name + '/'))
+        if not objects:
+            return None
+        versions.update(objects)
+    return versions
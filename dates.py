@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Module to normalize survey date columns holding a mix
+of formats (e.g. 2019-12-11 and 12/11/19); only the
+distinct values are parsed, each with an explicit format,
+and the result is mapped back onto the rows
+---------------------
+@Author: Gabriel Yin
+"""
+import numpy as np
+import pandas as pd
+
+# known formats, each recognized by a pattern on the whole value
+DATE_FORMATS = [
+    (r'^\d{4}-\d{1,2}-\d{1,2}$', '%Y-%m-%d'),
+    (r'^\d{4}-\d{1,2}-\d{1,2}[ T]\d{1,2}:\d{2}:\d{2}$', '%Y-%m-%d %H:%M:%S'),
+    (r'^\d{1,2}/\d{1,2}/\d{2}$', '%m/%d/%y'),
+    (r'^\d{1,2}/\d{1,2}/\d{4}$', '%m/%d/%Y'),
+]
+# string forms of a missing date
+MISSING_DATES = {'', 'nan', 'NaN', 'NaT', 'None'}
+
+
+def detect_formats(values):
+    """
+    Function to find which known formats occur among values
+    Returns a dict of format to boolean mask over values,
+    and the mask of values no format recognizes
+    """
+    values = pd.Series(values, dtype=object).astype(str).str.strip()
+    unmatched = ~values.isin(MISSING_DATES)
+    found = {}
+    for pattern, fmt in DATE_FORMATS:
+        mask = unmatched & values.str.match(pattern)
+        if mask.any():
+            found[fmt] = mask.values
+            unmatched &= ~mask
+    return found, unmatched.values
+
+
+def parse_dates(values):
+    """
+    Function to parse distinct date strings with
+    the explicit format each one was detected in
+    """
+    values = pd.Series(values, dtype=object).astype(str).str.strip()
+    parsed = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    found, unmatched = detect_formats(values)
+    for fmt, mask in found.items():
+        # T separated timestamps parse as the space separated format
+        parsed[mask] = pd.to_datetime(values[mask].str.replace('T', ' '), format=fmt,
+                                      errors='coerce')
+    if unmatched.any():
+        print("{} date values in no known format, left missing: {}".format(
+            unmatched.sum(), list(values[unmatched][:5])))
+    return parsed.values
+
+
+def normalize_dates(series, as_string=False):
+    """
+    Function to normalize a date column of mixed formats
+    Returns datetimes, or YYYY-MM-DD strings if as_string is set
+    """
+    if pd.api.types.is_datetime64_any_dtype(series):
+        dates = series.dt.normalize()
+        return dates.dt.strftime('%Y-%m-%d') if as_string else dates
+    codes, uniques = pd.factorize(series)
+    parsed = parse_dates(np.asarray(uniques, dtype=object))
+    if as_string:
+        parsed = pd.DatetimeIndex(parsed).strftime('%Y-%m-%d')
+        parsed = np.append(np.asarray(parsed, dtype=object), np.nan)
+    else:
+        parsed = np.append(parsed, np.datetime64('NaT', 'ns'))
+    # code -1 (missing) picks the trailing missing value
+    return pd.Series(parsed[codes], index=series.index, name=series.name)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Module with the ingestion stage for raw survey return files:
+a registry of known file layouts with their column aliases,
+a one-shot concatenation into a unified schema and a report
+of the files that were rejected
+Files can be parsed in worker processes, which hand the
+normalized frames back as arrow ipc streams
+---------------------
+@Author: Gabriel Yin
+"""
+import os
+import time
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+class FileLayout():
+    """
+    Definition of one known raw file layout
+    """
+    def __init__(self, name, n_columns, aliases=None, required=()):
+        """
+        name: label used in the ingestion report
+        n_columns: number of columns a file with this layout has
+        aliases: mapping of (lowercased) raw column names to unified names
+        required: unified column names a file must contain
+        """
+        self.name = name
+        self.n_columns = n_columns
+        self.aliases = aliases or {}
+        self.required = tuple(required)
+
+    def matches(self, columns):
+        """
+        Function to check whether raw columns fit this layout
+        """
+        return len(columns) == self.n_columns
+
+    def normalize(self, frame):
+        """
+        Function to lowercase and rename columns into the unified schema
+        """
+        frame.columns = [col.lower() for col in frame.columns]
+        return frame.rename(columns=self.aliases)
+
+
+class LayoutRegistry():
+    """
+    Registry of known file layouts, checked in order
+    """
+    def __init__(self, layouts):
+        self.layouts = list(layouts)
+
+    def register(self, layout):
+        self.layouts.append(layout)
+        return self
+
+    def match(self, columns):
+        """
+        Function to find the layout for a set of raw columns
+        """
+        for layout in self.layouts:
+            if layout.matches(columns):
+                return layout
+        return None
+
+    def normalize(self, frame):
+        """
+        Function to normalize a raw frame
+        Returns (normalized frame, layout, None) on success
+        or (None, None, reason) when the file is rejected
+        """
+        layout = self.match(frame.columns)
+        if layout is None:
+            return None, None, "unknown layout with {} columns".format(frame.shape[1])
+        frame = layout.normalize(frame)
+        missing = [col for col in layout.required if col not in frame.columns]
+        if missing:
+            return None, layout, "missing required columns: {}".format(', '.join(missing))
+        return frame, layout, None
+
+
+class IngestReport():
+    """
+    Record of accepted and rejected files for one ingestion run
+    """
+    def __init__(self):
+        self.accepted = []
+        self.rejected = []
+
+    def accept(self, file_name, layout, rows):
+        self.accepted.append((file_name, layout.name, rows))
+
+    def reject(self, file_name, reason):
+        self.rejected.append((file_name, reason))
+
+    def summary(self):
+        """
+        Function to print the report
+        """
+        print('-' * 20)
+        print("Ingested {} files ({} rows), rejected {} files".format(
+            len(self.accepted), sum(rows for _, _, rows in self.accepted), len(self.rejected)))
+        for file_name, reason in self.rejected:
+            print("Rejected {}: {}".format(file_name, reason))
+        return self
+
+
+def frame_to_ipc(df):
+    """
+    Function to serialize a frame as an arrow ipc stream, much
+    cheaper to send between processes than a pickled frame
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def frame_from_ipc(data):
+    """
+    Function to read a frame back from an arrow ipc stream
+    """
+    df = pa.ipc.open_stream(data).read_all().to_pandas()
+    # arrow gives None for missing strings where read_csv gives NaN
+    for col in df.columns[(df.dtypes == object).values]:
+        df[col] = df[col].where(df[col].notna(), np.nan)
+    return df
+
+
+def parse_raw_file(path, layouts, serialize=False):
+    """
+    Function to parse and normalize one raw return file, also
+    run in worker processes
+    serialize: set to return the frame as an arrow ipc stream; frames
+               arrow can not hold (mixed type columns) stay frames
+    Returns a dict with the frame (None if rejected), the layout,
+    the reason of a rejection, the raw rows and the read time and size
+    """
+    start = time.perf_counter()
+    frame = pd.read_csv(path)
+    result = {'rows': frame.shape[0], 'seconds': time.perf_counter() - start,
+              'bytes': os.path.getsize(path), 'ipc': False}
+    result['frame'], result['layout'], result['reason'] = layouts.normalize(frame)
+    if serialize and result['frame'] is not None and pa is not None:
+        try:
+            result['frame'], result['ipc'] = frame_to_ipc(result['frame']), True
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass
+    return result
+
+
+def unified_schema(frames):
+    """
+    Function to build the union of all columns,
+    in order of first appearance
+    """
+    schema = []
+    seen = set()
+    for frame in frames:
+        for col in frame.columns:
+            if col not in seen:
+                seen.add(col)
+                schema.append(col)
+    return schema
+
+
+def concat_unified(frames, schema=None):
+    """
+    Function to concatenate frames in a single pass into one
+    unified schema; columns missing from a frame are filled with NaN
+    """
+    frames = list(frames)
+    if not frames:
+        return pd.DataFrame(columns=schema or [])
+    schema = schema or unified_schema(frames)
+    return pd.concat(frames, sort=False).reindex(columns=schema, copy=False)
+
+
+BLUELABS_ALIASES = {
+    'qrate_mbpost': 'qratepost',
+    'qturnout': 'qturnoutprimary',
+    'qpostrate_text': 'qratepost_text'
+}
+
+BLUELABS_LAYOUTS = LayoutRegistry([
+    FileLayout('bluelabs_45', 45, aliases=BLUELABS_ALIASES),
+    FileLayout('bluelabs_46', 46, aliases=BLUELABS_ALIASES),
+    FileLayout('bluelabs_47', 47, aliases=BLUELABS_ALIASES),
+])
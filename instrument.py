@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+"""
+Module to instrument pipeline runs: every stage records its
+wall and cpu time, the process memory while it ran, rows and
+bytes read and written and the timing of each I/O call, and
+a run ends with a json metrics record and a summary table
+cProfile or tracemalloc can be attached to single stages
+---------------------
+@Author: Gabriel Yin
+"""
+import os
+import json
+import time
+import uuid
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+import config
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# stage the current thread is working for, if any
+_local = threading.local()
+_process = None
+
+# tracemalloc traces the whole process: overlapping profiled stages
+# share one trace, started by the first and stopped by the last
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+_tracemalloc_owned = False
+
+
+def current_rss_mb():
+    """
+    Function to get the resident memory of the process,
+    None where it can not be read
+    """
+    global _process
+    if psutil is not None:
+        if _process is None:
+            _process = psutil.Process()
+        return _process.memory_info().rss / 1e6
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def current_stage():
+    """
+    Function to get the StageMetrics the current thread records into
+    """
+    return getattr(_local, 'stage', None)
+
+
+def bind(func):
+    """
+    Function to wrap func so that it records into the current
+    stage when called from another thread, e.g. a pool worker
+    """
+    stage = current_stage()
+
+    @wraps(func)
+    def bound(*args, **kwargs):
+        previous = current_stage()
+        _local.stage = stage
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.stage = previous
+    return bound
+
+
+@contextmanager
+def io(op, target, direction='read'):
+    """
+    Context manager timing one I/O call of the current stage
+    The yielded dict can be given the 'rows' and 'bytes' moved
+    direction: 'read', 'write' or None for metadata calls
+    Does nothing outside of an instrumented stage
+    """
+    stage = current_stage()
+    call = {}
+    if stage is None:
+        yield call
+        return
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield call
+    except Exception:
+        failed = True
+        raise
+    finally:
+        stage.add_io(op, target, direction, time.perf_counter() - start,
+                     rows=call.get('rows'), nbytes=call.get('bytes'), failed=failed)
+
+
+def record_io(op, target, seconds, direction='read', rows=None, nbytes=None):
+    """
+    Function to record an I/O call timed elsewhere, e.g. in a
+    worker process, into the current stage
+    """
+    stage = current_stage()
+    if stage is not None:
+        stage.add_io(op, target, direction, seconds, rows=rows, nbytes=nbytes)
+
+
+class StageMetrics():
+    """
+    Metrics of one stage run
+    Memory is the resident memory of the whole process while the
+    stage ran, which includes the stages that ran concurrently
+    (listed in concurrent)
+    """
+    def __init__(self, name, run_id):
+        self.name = name
+        self.run_id = run_id
+        self.status = 'running'
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.process_rss_start_mb = None
+        self.process_peak_rss_mb = None
+        self.concurrent = set()
+        self.rows_in = 0
+        self.rows_out = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.io = []
+        self.profile = {}
+        # extra fields set by the caller, e.g. the rows of a frame
+        self.fields = {}
+        self._lock = threading.Lock()
+
+    def add_io(self, op, target, direction, seconds, rows=None, nbytes=None, failed=False):
+        """
+        Function to record an I/O call and add its rows and bytes
+        """
+        with self._lock:
+            self.io.append({'op': op, 'target': target, 'direction': direction,
+                            'seconds': seconds, 'rows': rows, 'bytes': nbytes, 'failed': failed})
+            if direction == 'read':
+                self.rows_in += rows or 0
+                self.bytes_read += nbytes or 0
+            elif direction == 'write':
+                self.rows_out += rows or 0
+                self.bytes_written += nbytes or 0
+        return self
+
+    def sample(self, rss):
+        if rss is not None and (self.process_peak_rss_mb is None or rss > self.process_peak_rss_mb):
+            self.process_peak_rss_mb = rss
+
+    def io_seconds(self):
+        return sum(call['seconds'] for call in self.io)
+
+    def as_dict(self):
+        with self._lock:
+            return {'stage': self.name, 'status': self.status, 'wall_seconds': self.wall_seconds,
+                    'cpu_seconds': self.cpu_seconds, 'process_rss_start_mb': self.process_rss_start_mb,
+                    'process_peak_rss_mb': self.process_peak_rss_mb,
+                    'concurrent': sorted(self.concurrent), 'rows_in': self.rows_in,
+                    'rows_out': self.rows_out, 'bytes_read': self.bytes_read,
+                    'bytes_written': self.bytes_written, 'io_seconds': self.io_seconds(),
+                    'io': list(self.io), 'profile': dict(self.profile), 'fields': dict(self.fields)}
+
+
+class CProfileHook():
+    """
+    Stage hook running cProfile on the thread of the stage,
+    dumping the stats and printing the top functions
+    """
+    def __init__(self, directory=None, top=25, sort='cumulative'):
+        self.directory = directory or os.path.join(config.CACHE_DIR, 'metrics')
+        self.top = top
+        self.sort = sort
+        self.profiler = None
+
+    def start(self, stage):
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def stop(self, stage):
+        self.profiler.disable()
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '{}_{}.prof'.format(stage.run_id, stage.name))
+        self.profiler.dump_stats(path)
+        stage.profile['cprofile'] = path
+        print('-' * 20)
+        print("cProfile of stage {} (saved to {}):".format(stage.name, path))
+        pstats.Stats(self.profiler).sort_stats(self.sort).print_stats(self.top)
+
+
+class TracemallocHook():
+    """
+    Stage hook tracing python allocations while the stage runs,
+    recording the peak and the lines that allocated the most
+    Tracing is process wide: allocations of stages running
+    concurrently are traced too, and profiled stages that overlap
+    share one trace, whose peak is then the peak of all of them
+    """
+    def __init__(self, top=15, frames=1):
+        self.top = top
+        self.frames = frames
+
+    def start(self, stage):
+        global _tracemalloc_users, _tracemalloc_owned
+        with _tracemalloc_lock:
+            if _tracemalloc_users == 0:
+                # tracing started elsewhere is left running
+                _tracemalloc_owned = not tracemalloc.is_tracing()
+                if _tracemalloc_owned:
+                    tracemalloc.start(self.frames)
+                tracemalloc.reset_peak()
+            _tracemalloc_users += 1
+
+    def stop(self, stage):
+        global _tracemalloc_users
+        with _tracemalloc_lock:
+            snapshot = tracemalloc.take_snapshot() if self.top else None
+            peak = tracemalloc.get_traced_memory()[1]
+            _tracemalloc_users -= 1
+            if _tracemalloc_users == 0 and _tracemalloc_owned:
+                tracemalloc.stop()
+        top = [{'where': str(stat.traceback), 'size_mb': stat.size / 1e6, 'count': stat.count}
+               for stat in snapshot.statistics('lineno')[:self.top]] if snapshot is not None else []
+        stage.profile['tracemalloc'] = {'peak_mb': peak / 1e6, 'top': top}
+        print('-' * 20)
+        print("tracemalloc of stage {}: peak {:.1f} MB{}".format(
+            stage.name, peak / 1e6, ', largest live allocations:' if top else ''))
+        for line in top:
+            print("  {:8.2f} MB {:>8} blocks  {}".format(line['size_mb'], line['count'], line['where']))
+
+
+# profiling hooks that can be attached to a stage by name
+HOOKS = {
+    'cprofile': CProfileHook,
+    'tracemalloc': TracemallocHook,
+}
+
+
+class RunMetrics():
+    """
+    Class collecting the metrics of the stages of one run
+    """
+    def __init__(self, run_id=None, directory=None, sample_interval=0.2):
+        """
+        class initialization
+        directory: where the json metrics records are written
+        sample_interval: seconds between memory samples of the running stages
+        """
+        self.run_id = run_id or '{}_{}'.format(time.strftime('%Y%m%d_%H%M%S'), uuid.uuid4().hex[:6])
+        self.directory = directory or os.path.join(config.CACHE_DIR, 'metrics')
+        self.sample_interval = sample_interval
+        self.started = time.time()
+        self.finished = None
+        self.stages = OrderedDict()
+        self.hooks = {}
+        self._active = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def profile(self, stage, hook='cprofile'):
+        """
+        Function to attach a profiling hook to a stage
+        hook: a name in HOOKS or an object with start(stage) and stop(stage)
+        """
+        if isinstance(hook, str):
+            if hook not in HOOKS:
+                raise ValueError("Unknown profiler {}, expected one of {}".format(hook, list(HOOKS)))
+            hook = HOOKS[hook]()
+        self.hooks.setdefault(stage, []).append(hook)
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self.sample_interval):
+            rss = current_rss_mb()
+            with self._lock:
+                for stage in self._active:
+                    stage.sample(rss)
+
+    def _start_sampler(self):
+        with self._lock:
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name='metrics-sampler', daemon=True)
+                self._sampler.start()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager recording a stage run in the current thread
+        The yielded StageMetrics can be marked, e.g. status 'cached'
+        """
+        record = StageMetrics(name, self.run_id)
+        hooks = self.hooks.get(name, [])
+        previous = current_stage()
+        _local.stage = record
+        record.process_rss_start_mb = current_rss_mb()
+        record.sample(record.process_rss_start_mb)
+        with self._lock:
+            self.stages[name] = record
+            for other in self._active:
+                other.concurrent.add(name)
+                record.concurrent.add(other.name)
+            self._active.add(record)
+        self._start_sampler()
+        for hook in hooks:
+            hook.start(record)
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield record
+            if record.status == 'running':
+                record.status = 'done'
+        except Exception:
+            record.status = 'failed'
+            raise
+        finally:
+            # cpu time of the stage thread, pool workers are not included
+            record.cpu_seconds = time.thread_time() - cpu
+            record.wall_seconds = time.perf_counter() - wall
+            for hook in reversed(hooks):
+                hook.stop(record)
+            record.sample(current_rss_mb())
+            with self._lock:
+                self._active.discard(record)
+            _local.stage = previous
+
+    def close(self):
+        """
+        Function to stop sampling, once the run and its
+        background writes are done
+        """
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        self.finished = time.time()
+        return self
+
+    def record(self):
+        """
+        Function to build the json metrics record of the run
+        """
+        stages = [stage.as_dict() for stage in self.stages.values()]
+        return {'run_id': self.run_id,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'wall_seconds': (self.finished or time.time()) - self.started,
+                'peak_rss_mb': max([stage['process_peak_rss_mb'] for stage in stages
+                                    if stage['process_peak_rss_mb'] is not None] or [None]),
+                'stages': stages}
+
+    def save(self, path=None):
+        """
+        Function to write the metrics record, by default
+        to <directory>/<run_id>.json
+        """
+        path = path or os.path.join(self.directory, '{}.json'.format(self.run_id))
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.record(), f, indent=2)
+        print("Run metrics saved to {}".format(path))
+        return self
+
+    def summary(self):
+        """
+        Function to print a table of the stage metrics and
+        of the I/O time spent per kind of call
+        """
+        print('-' * 20)
+        print("Run {} metrics:".format(self.run_id))
+        header = "  {:<14} {:>7} {:>8} {:>8} {:>11} {:>10} {:>10} {:>9} {:>9} {:>8}".format(
+            'stage', 'status', 'wall_s', 'cpu_s', 'proc_rss_mb', 'rows_in', 'rows_out',
+            'read_mb', 'write_mb', 'io_s')
+        print(header)
+        ops = OrderedDict()
+        for stage in self.stages.values():
+            rss = '-' if stage.process_peak_rss_mb is None else '{:.0f}{}'.format(
+                stage.process_peak_rss_mb, '*' if stage.concurrent else '')
+            print("  {:<14} {:>7} {:>8.1f} {:>8.1f} {:>11} {:>10} {:>10} {:>9.1f} {:>9.1f} {:>8.1f}".format(
+                stage.name, stage.status, stage.wall_seconds or 0, stage.cpu_seconds or 0, rss,
+                stage.rows_in, stage.rows_out, stage.bytes_read / 1e6, stage.bytes_written / 1e6,
+                stage.io_seconds()))
+            for call in stage.io:
+                totals = ops.setdefault(call['op'], [0, 0.0, 0])
+                totals[0] += 1
+                totals[1] += call['seconds']
+                totals[2] += call['bytes'] or 0
+        print("  proc_rss_mb: peak resident memory of the process while the stage ran, "
+              "* includes concurrent stages")
+        if ops:
+            print("  I/O calls:")
+            for op, (calls, seconds, nbytes) in sorted(ops.items(), key=lambda item: -item[1][1]):
+                print("    {:<18} {:>6} calls {:>8.1f}s {:>9.1f} MB".format(op, calls, seconds, nbytes / 1e6))
+        return self
@@ -1,17 +1,156 @@
 # -*- coding: utf-8 -*-
-import os
-import pandas as pd
-import numpy as np
-from google.cloud import storage, bigquery
+import argparse
+import config
+import datasets
+import compact
+import bluelabs
+import survey_monkey
+import combine_survey_data
+import phone_lookup
+import instrument
 from bluelabs import BluelabsDataLoader, BluelabsDataAggregator
 from survey_monkey import SurveyMonkeyDataLoader
 from combine_survey_data import SurveyDataCombiner
+from pipeline import Stage, Pipeline
+from stage_cache import StageCache, code_version, blob_versions, object_version, table_version
 import warnings
 warnings.filterwarnings("ignore")
 
+
+# dashboard tables written by the misc_graphs stage
+DASHBOARD_TABLES = ['combined_support_test2.csv', 'bluelabs_support2.csv', 'sm_support2.csv']
+
+
+def settings():
+    """
+    Function to get the settings that change what stages write
+    """
+    return {'format': datasets.DEFAULT_FORMAT, 'compression': datasets.CSV_COMPRESSION,
+            'compact': compact.ENABLED}
+
+
+def build_pipeline(workers=4, cache=None):
+    """
+    Function to declare the survey pipeline stages
+    survey monkey and bluelabs branches are independent
+    and only meet at the combine stage
+    Each stage fingerprints its sources, the datasets it reads
+    and its code, so a cache can skip it when none changed
+    Datasets are handed over in memory, dropped once the last
+    stage using them is done; the run ends once they are all
+    persisted
+    """
+    return Pipeline([
+        Stage('sm_load', lambda results, force: SurveyMonkeyDataLoader().run(),
+              datasets=['agg_surveymonkey_data'],
+              description='download and clean survey monkey data from big query',
+              inputs=lambda: {'table': table_version('survey_monkey.survey_monkey_curr'),
+                              'code': code_version(survey_monkey),
+                              'settings': settings()},
+              outputs=lambda: {'agg_surveymonkey_data': datasets.dataset_version('agg_surveymonkey_data')}),
+        Stage('bl_download', lambda results, force: BluelabsDataLoader().download_from_gcs(force),
+              datasets=['agg_bluelabs_data'],
+              description='ingest new bluelabs returns from gcs',
+              inputs=lambda: {'blobs': blob_versions(config.RAW_BUCKET, BluelabsDataLoader.RAW_PREFIXES),
+                              'code': code_version(bluelabs),
+                              'settings': settings()},
+              outputs=lambda: {'agg_bluelabs_data': datasets.dataset_version('agg_bluelabs_data')}),
+        Stage('bl_aggregate', lambda results, force: BluelabsDataAggregator().run(),
+              deps=['bl_download'], datasets=['agg_bluelabs_data', 'bluelabs_superset'],
+              description='clean and decode bluelabs data',
+              inputs=lambda: {'agg_bluelabs_data': datasets.dataset_version('agg_bluelabs_data'),
+                              'voter_file': table_version('civis_national_raw.ts_analytics_trimmed'),
+                              'code': code_version(bluelabs),
+                              'settings': settings()},
+              outputs=lambda: {'bluelabs_superset': datasets.dataset_version('bluelabs_superset')}),
+        Stage('combine', lambda results, force: SurveyDataCombiner(force=force),
+              deps=['sm_load', 'bl_aggregate'],
+              datasets=['bluelabs_superset', 'agg_surveymonkey_data', 'bluelabs_surveymonkey_agg'],
+              description='combine both sources and load to big query',
+              inputs=lambda: {'bluelabs_superset': datasets.dataset_version('bluelabs_superset'),
+                              'agg_surveymonkey_data': datasets.dataset_version('agg_surveymonkey_data'),
+                              'code': code_version(combine_survey_data),
+                              'settings': settings()},
+              outputs=lambda: {'bluelabs_surveymonkey_agg': datasets.dataset_version('bluelabs_surveymonkey_agg'),
+                               'bl_sm_support': table_version(combine_survey_data.COMBINED_TABLE)}),
+        Stage('misc_graphs',
+              lambda results, force: SurveyDataCombiner(combine=False).update_misc_graphs(force),
+              deps=['combine'], datasets=['bluelabs_superset', 'agg_surveymonkey_data'],
+              description='update the dashboard tables',
+              inputs=lambda: {'bluelabs_superset': datasets.dataset_version('bluelabs_superset'),
+                              'agg_surveymonkey_data': datasets.dataset_version('agg_surveymonkey_data'),
+                              'phone_types': phone_lookup.PhoneTypeLookup().versions(),
+                              'template': object_version(config.TEMPLATE_BUCKET,
+                                                         'survey_dashboard/combined_support_test.csv'),
+                              'code': code_version(combine_survey_data),
+                              'settings': settings()},
+              outputs=lambda: dict((name, object_version(config.WORK_BUCKET, name))
+                                   for name in DASHBOARD_TABLES)),
+    ], workers=workers, cache=cache, finalize=datasets.flush, release=datasets.release)
+
+
+def parse_args(stage_names):
+    parser = argparse.ArgumentParser(description='Download and combine the latest survey data')
+    parser.add_argument('stages', nargs='*', metavar='STAGE',
+                        help='stages to run, with everything upstream of them '
+                             '(default: all of {})'.format(', '.join(stage_names)))
+    parser.add_argument('--only', action='store_true',
+                        help='run only the given stages, assuming upstream outputs are in place')
+    parser.add_argument('--force', nargs='*', metavar='STAGE',
+                        help='rerun the given stages (all selected stages if none given) from scratch '
+                             'instead of incrementally')
+    parser.add_argument('--dry-run', action='store_true', help='only print the stages that would run')
+    parser.add_argument('--workers', type=int, default=4, help='maximum number of concurrent stages')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='run every selected stage even if its inputs did not change')
+    parser.add_argument('--chunk-rows', type=int, default=None,
+                        help='stream bluelabs data through bl_aggregate in chunks of this many rows '
+                             'instead of loading it whole (default: SURVEY_CHUNK_ROWS)')
+    parser.add_argument('--parse-workers', type=int, default=None,
+                        help='processes parsing the raw bluelabs files in bl_download '
+                             '(default: SURVEY_PARSE_WORKERS or 1)')
+    parser.add_argument('--agg-backend', choices=sorted(combine_survey_data.AGG_BACKENDS), default=None,
+                        help='engine computing the dashboard aggregations of misc_graphs '
+                             '(default: SURVEY_AGG_BACKEND or pandas)')
+    parser.add_argument('--agg-workers', type=int, default=None,
+                        help='processes computing the misc_graphs statistics, with the rows sharded by date '
+                             '(default: SURVEY_AGG_WORKERS or 1)')
+    parser.add_argument('--agg-parity', action='store_true',
+                        help='check the dashboard tables of a non-pandas backend or of several '
+                             'workers against the single process pandas path')
+    parser.add_argument('--profile', action='append', default=[], metavar='STAGE[:PROFILER]',
+                        help='profile a stage with one of {} (default cprofile); '
+                             'can be repeated'.format(', '.join(instrument.HOOKS)))
+    args = parser.parse_args()
+    args.profile = [tuple(spec.split(':', 1)) if ':' in spec else (spec, 'cprofile') for spec in args.profile]
+    unknown = [name for name in args.stages + (args.force or []) + [stage for stage, _ in args.profile]
+               if name not in stage_names]
+    if unknown:
+        parser.error("unknown stages {}, expected some of {}".format(unknown, stage_names))
+    profilers = [hook for _, hook in args.profile if hook not in instrument.HOOKS]
+    if profilers:
+        parser.error("unknown profilers {}, expected some of {}".format(profilers, list(instrument.HOOKS)))
+    # --force alone forces every selected stage
+    args.force = True if args.force == [] else (args.force or ())
+    return args
+
+
 if __name__ == '__main__':
-    #SurveyMonkeyDataLoader().download_from_big_query()
-    #BluelabsDataLoader().download_from_gcs()
-    #bl = BluelabsDataAggregator().run()
-    sm = SurveyMonkeyDataLoader().run()
-    final = SurveyDataCombiner().update_misc_graphs()
+    pipeline = build_pipeline()
+    args = parse_args(list(pipeline.stages))
+    pipeline.workers = args.workers
+    pipeline.cache = None if args.no_cache else StageCache()
+    if args.chunk_rows:
+        bluelabs.CHUNK_ROWS = args.chunk_rows
+    if args.parse_workers:
+        bluelabs.PARSE_WORKERS = args.parse_workers
+    if args.agg_backend:
+        combine_survey_data.AGG_BACKEND = args.agg_backend
+    if args.agg_workers:
+        combine_survey_data.AGG_WORKERS = args.agg_workers
+    if args.agg_parity:
+        combine_survey_data.AGG_PARITY = True
+    pipeline.metrics = instrument.RunMetrics()
+    for stage, hook in args.profile:
+        pipeline.metrics.profile(stage, hook)
+    pipeline.run(args.stages, with_deps=not args.only, force=args.force, dry_run=args.dry_run)
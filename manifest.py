@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Module to keep track of which raw survey files
+have already been ingested, so that each run only
+touches files that are new or changed
+---------------------
+@Author: Gabriel Yin
+"""
+import os
+import json
+
+
+class IngestManifest():
+    """
+    Local json manifest of ingested objects,
+    keyed by object name and storing the
+    generation, size and row count of each
+    """
+    def __init__(self, path):
+        """
+        class initialization
+        """
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def is_current(self, blob):
+        """
+        Function to check whether a blob has been ingested
+        with the same generation and size
+        """
+        entry = self.entries.get(blob.name)
+        if entry is None:
+            return False
+        return entry['generation'] == blob.generation and entry['size'] == blob.size
+
+    def record(self, blob, rows, rejected=False):
+        """
+        Function to mark a blob as ingested
+        """
+        self.entries[blob.name] = {
+            'generation': blob.generation,
+            'size': blob.size,
+            'rows': rows,
+            'rejected': rejected
+        }
+        return self
+
+    def forget(self, names):
+        """
+        Function to drop entries, e.g. for objects
+        that no longer exist in the bucket
+        """
+        for name in names:
+            self.entries.pop(name, None)
+        return self
+
+    def names(self):
+        """
+        Function to list all ingested object names
+        """
+        return list(self.entries)
+
+    def clear(self):
+        """
+        Function to reset the manifest
+        """
+        self.entries = {}
+        return self
+
+    def save(self):
+        """
+        Function to persist the manifest, writing through a
+        temporary file so a crash never leaves it half written
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+        return self
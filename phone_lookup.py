@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Module with a persistent local lookup of phone types
+keyed by voterbase_id, built from the vendor phone type
+supplements and rebuilt only when they change
+---------------------
+@Author: Gabriel Yin
+"""
+import os
+import pandas as pd
+import config
+from storage_io import get_storage
+
+# vendor supplements with the phone type of the sampled voters
+PHONE_TYPE_SOURCES = [
+    'additional_data/prim_march_20191130_supplement_sample_for_vendor_phonetype.csv',
+    'additional_data/prim_march_20191130_sample_for_vendor_bilingual_phonetype.csv',
+    'additional_data/prim_march_20191130_sample_for_vendor_english_phonetype.csv',
+]
+# changing the labels, so it's more understandable
+PHONE_TYPE_LABELS = {'L': 'Landline', 'C': 'Cell'}
+
+
+class PhoneTypeLookup():
+    """
+    Class for the voterbase_id -> phone_type lookup
+    """
+    def __init__(self, path=None, bucket_name=None, sources=PHONE_TYPE_SOURCES):
+        """
+        class initialization
+        path: pickle file holding the lookup and the source versions
+        """
+        self.path = path or os.path.join(config.CACHE_DIR, 'phone_types.pkl')
+        self.bucket_name = bucket_name or config.RAW_BUCKET
+        self.sources = list(sources)
+        self.storage = get_storage()
+        self.frame = None
+
+    def versions(self):
+        """
+        Function to get the generation of every source file
+        """
+        versions = {}
+        for name in self.sources:
+            info = self.storage.info(self.bucket_name, name)
+            if info is None:
+                raise FileNotFoundError("Phone type source {} not found".format(name))
+            versions[name] = info.generation
+        return versions
+
+    def build(self):
+        """
+        Function to read the sources into a deduplicated lookup
+        with phone_type as a category, indexed by voterbase_id
+        """
+        frames = [self.storage.read_csv(self.bucket_name, name, usecols=['voterbase_id', 'phone_type'],
+                                        dtype={'voterbase_id': str, 'phone_type': str})
+                  for name in self.sources]
+        frame = pd.concat(frames, ignore_index=True)
+        frame = frame.dropna(subset=['voterbase_id'])
+        duplicates = frame['voterbase_id'].duplicated()
+        if duplicates.any():
+            print("{} duplicated voter ids in the phone type sources, keeping the first".format(
+                duplicates.sum()))
+        frame = frame[~duplicates]
+        frame['phone_type'] = frame['phone_type'].replace(PHONE_TYPE_LABELS).astype('category')
+        return frame.set_index('voterbase_id').sort_index()
+
+    def load(self):
+        """
+        Function to get the lookup, rebuilding it only if
+        the source files changed since it was built
+        """
+        if self.frame is not None:
+            return self.frame
+        versions = self.versions()
+        if os.path.exists(self.path):
+            stored = pd.read_pickle(self.path)
+            if stored.get('versions') == versions:
+                self.frame = stored['frame']
+                return self.frame
+        print('-' * 20)
+        print("Phone type sources changed, rebuilding the lookup..")
+        self.frame = self.build()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        pd.to_pickle({'versions': versions, 'frame': self.frame}, self.path)
+        print("{} voter ids in the phone type lookup".format(len(self.frame)))
+        return self.frame
+
+    def attach(self, df, on='respondents_id'):
+        """
+        Function to add the phone_type of each row of df
+        through an indexed join on the id column
+        """
+        return df.join(self.load(), on=on)
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Module with a small pipeline runner: stages declare the
+stages they depend on, and stages whose dependencies are
+done run concurrently, so independent branches overlap
+---------------------
+@Author: Gabriel Yin
+"""
+import time
+import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Stage():
+    """
+    A named pipeline step
+    func is called as func(results, force) where results maps the
+    names of the finished stages to what their func returned, kept
+    until every stage depending on them is done
+    inputs and outputs, when given, are called without arguments and
+    return the current versions of what the stage reads and writes,
+    which lets a StageCache skip it when nothing changed
+    datasets are the names of the datasets the stage reads or writes,
+    released once no stage left to run uses them
+    """
+    def __init__(self, name, func, deps=(), description='', inputs=None, outputs=None, datasets=()):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.description = description
+        self.inputs = inputs
+        self.outputs = outputs
+        self.datasets = tuple(datasets)
+
+
+class Pipeline():
+    """
+    Class to run a set of stages in dependency order
+    """
+    def __init__(self, stages, workers=4, cache=None, finalize=None, metrics=None, release=None):
+        """
+        class initialization
+        stages: list of Stage
+        workers: maximum number of stages running at once
+        cache: StageCache used to skip stages whose inputs did not change
+        finalize: called once all stages are done, e.g. to wait for
+                  outputs persisted in the background
+        metrics: instrument.RunMetrics recording every stage run
+        release: called with the names of the datasets no stage left
+                 to run uses, e.g. to drop them from memory
+        """
+        self.stages = OrderedDict((stage.name, stage) for stage in stages)
+        self.workers = workers
+        self.cache = cache
+        self.finalize = finalize
+        self.metrics = metrics
+        self.release = release
+        for stage in stages:
+            unknown = [dep for dep in stage.deps if dep not in self.stages]
+            if unknown:
+                raise ValueError("Stage {} depends on unknown stages {}".format(stage.name, unknown))
+        self.levels(self.stages)
+        self.results = {}
+        self.timings = OrderedDict()
+        self.cached = set()
+        self.fingerprints = {}
+
+    def select(self, targets=None, with_deps=True):
+        """
+        Function to get the stages to run for the target stages,
+        including everything upstream of them unless with_deps is off
+        """
+        targets = list(self.stages) if not targets else list(targets)
+        unknown = [name for name in targets if name not in self.stages]
+        if unknown:
+            raise ValueError("Unknown stages {}, expected some of {}".format(unknown, list(self.stages)))
+        selected = set(targets)
+        if with_deps:
+            pending = list(targets)
+            while pending:
+                for dep in self.stages[pending.pop()].deps:
+                    if dep not in selected:
+                        selected.add(dep)
+                        pending.append(dep)
+        return [name for name in self.stages if name in selected]
+
+    def levels(self, names):
+        """
+        Function to group stages into levels, each level only
+        depending on the previous ones; deps outside names are
+        taken as already done
+        """
+        names = list(names)
+        done, levels = set(), []
+        while len(done) < len(names):
+            level = [name for name in names if name not in done and
+                     all(dep in done or dep not in names for dep in self.stages[name].deps)]
+            if not level:
+                raise ValueError("Stage dependencies form a cycle: {}".format(
+                    [name for name in names if name not in done]))
+            levels.append(level)
+            done.update(level)
+        return levels
+
+    def plan(self, names):
+        """
+        Function to print the stages that would run, level by level
+        """
+        print('-' * 20)
+        print("Pipeline plan ({} workers):".format(self.workers))
+        for i, level in enumerate(self.levels(names)):
+            for name in level:
+                stage = self.stages[name]
+                deps = [dep for dep in stage.deps if dep in names]
+                print("  {}. {}{}{}".format(i + 1, name,
+                                           ' <- ' + ', '.join(deps) if deps else '',
+                                           ' : ' + stage.description if stage.description else ''))
+        return self
+
+    def _use_cache(self, name):
+        stage = self.stages[name]
+        return self.cache is not None and stage.inputs is not None and stage.outputs is not None
+
+    @contextmanager
+    def _measure(self, name):
+        if self.metrics is None:
+            yield None
+        else:
+            with self.metrics.stage(name) as record:
+                yield record
+
+    def _run_stage(self, name, force, upstream_ran):
+        with self._measure(name) as record:
+            result, elapsed = self._call_stage(name, force, upstream_ran)
+            if record is not None and name in self.cached:
+                record.status = 'cached'
+        return result, elapsed
+
+    def _call_stage(self, name, force, upstream_ran):
+        start = time.time()
+        stage = self.stages[name]
+        if self._use_cache(name):
+            if upstream_ran:
+                # an upstream stage rewrote its outputs, which are inputs here;
+                # they may still be persisting, so fingerprint after the run
+                self.cache.miss(name)
+                self.fingerprints[name] = None
+            else:
+                self.fingerprints[name] = self.cache.fingerprint(name, stage.inputs())
+                if not force and self.cache.lookup(name, self.fingerprints[name], stage.outputs()):
+                    self.cached.add(name)
+                    print('-' * 20)
+                    print("Stage {} skipped, inputs unchanged since the last run".format(name))
+                    return None, time.time() - start
+        print('-' * 20)
+        print("Stage {} started..".format(name))
+        result = stage.func(self.results, force)
+        elapsed = time.time() - start
+        print('-' * 20)
+        print("Stage {} finished in {:.1f}s".format(name, elapsed))
+        return result, elapsed
+
+    def _release(self, users, dependents, status):
+        """
+        Function to release the datasets whose stages are all finished,
+        and the results of stages whose dependents are all finished
+        (results of stages nothing depends on are kept)
+        users: dict of dataset name to the stages using it, updated
+        dependents: dict of stage name to the stages depending on it, updated
+        """
+        for name, stages in list(dependents.items()):
+            if name in status and all(stage in status for stage in stages):
+                dependents.pop(name)
+                self.results.pop(name, None)
+        names = [name for name, stages in users.items() if all(stage in status for stage in stages)]
+        for name in names:
+            users.pop(name)
+        if names and self.release is not None:
+            self.release(names)
+
+    def run(self, targets=None, with_deps=True, force=(), dry_run=False):
+        """
+        Function to run the target stages, starting every stage as
+        soon as its dependencies are done
+        force: stage names (or True for all) to rerun from scratch
+        dry_run: only print the plan
+        Raises RuntimeError listing the stages that failed
+        """
+        names = self.select(targets, with_deps)
+        self.plan(names)
+        if dry_run:
+            return self
+        forced = set(names) if force is True else set(force or ())
+        self.timings = OrderedDict()
+        self.cached = set()
+        self.fingerprints = {}
+
+        status = {}
+        running = {}
+        users = {}
+        for name in names:
+            for dataset in self.stages[name].datasets:
+                users.setdefault(dataset, set()).add(name)
+        dependents = dict((name, [other for other in names if name in self.stages[other].deps])
+                          for name in names)
+        dependents = dict((name, stages) for name, stages in dependents.items() if stages)
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while len(status) < len(names):
+                for name in names:
+                    if name in status or name in running.values():
+                        continue
+                    deps = [dep for dep in self.stages[name].deps if dep in names]
+                    if any(status.get(dep) in ('failed', 'skipped') for dep in deps):
+                        status[name] = 'skipped'
+                        print("Stage {} skipped, an upstream stage failed".format(name))
+                    elif all(status.get(dep) == 'done' for dep in deps):
+                        upstream_ran = any(dep not in self.cached for dep in deps)
+                        running[pool.submit(self._run_stage, name, name in forced, upstream_ran)] = name
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        self.results[name], self.timings[name] = future.result()
+                        status[name] = 'done'
+                    except Exception:
+                        status[name] = 'failed'
+                        print("Stage {} failed:".format(name))
+                        traceback.print_exc()
+                self._release(users, dependents, status)
+        # datasets of stages skipped after the last one finished
+        self._release(users, dependents, status)
+
+        finalized = True
+        if self.finalize is not None:
+            try:
+                self.finalize()
+            except Exception:
+                finalized = False
+                print("Pipeline finalize failed:")
+                traceback.print_exc()
+        if self.cache is not None and finalized:
+            self._record([name for name in names if status[name] == 'done' and name not in self.cached])
+        if self.metrics is not None:
+            self.metrics.close().summary().save()
+
+        print('-' * 20)
+        print("Pipeline finished in {:.1f}s (stages: {:.1f}s)".format(
+            time.time() - start, sum(self.timings.values())))
+        for name in names:
+            print("  {}: {}{}".format(name, 'cached' if name in self.cached else status[name],
+                                     ' ({:.1f}s)'.format(self.timings[name]) if name in self.timings else ''))
+        if self.cache is not None:
+            self.cache.report()
+        failed = [name for name in names if status[name] == 'failed']
+        if failed:
+            raise RuntimeError("Pipeline stages failed: {}".format(failed))
+        if not finalized:
+            raise RuntimeError("Pipeline outputs failed to persist")
+        return self
+
+    def _record(self, names):
+        """
+        Function to record the outputs of the stages that ran,
+        once they are persisted
+        """
+        for name in names:
+            if not self._use_cache(name):
+                continue
+            stage = self.stages[name]
+            fingerprint = self.fingerprints.get(name) or self.cache.fingerprint(name, stage.inputs())
+            self.cache.record(name, fingerprint, stage.outputs())
+        self.cache.save()
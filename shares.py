@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Module to compute normalized shares of a category
+column within groups, used for the dashboard tables
+---------------------
+@Author: Gabriel Yin
+"""
+import numpy as np
+import pandas as pd
+
+# value used for missing categories in pre-aggregated counts
+MISSING = '__missing__'
+
+
+def count_table(df, keys, category):
+    """
+    Function to count every value of a category column within
+    each group of keys, in a single grouped pass
+    Returns the wide table of counts (one row per group, one column
+    per observed value, NaN where a value does not occur) and the
+    number of non-missing values per group
+    """
+    codes, uniques = pd.factorize(df[category])
+    counts = df.groupby(list(keys) + [codes]).size().unstack()
+    # code -1 holds the missing values, which only keep their group alive
+    counts = counts.drop(columns=[-1], errors='ignore')
+    denominators = counts.sum(axis=1)
+    counts.columns = np.asarray(uniques)[counts.columns.values.astype(int)]
+    return counts, denominators
+
+
+def aggregate_counts(counts, keys, category, weight='count'):
+    """
+    Function to build the same wide table of counts and denominators
+    as count_table, but from pre-aggregated long counts (one row per
+    group and category value, missing values stored as MISSING)
+    """
+    counts = counts.groupby(list(keys) + [category])[weight].sum().unstack()
+    counts = counts.drop(columns=[MISSING], errors='ignore')
+    denominators = counts.sum(axis=1)
+    return counts, denominators
+
+
+def normalize(counts, denominators, categories=None):
+    """
+    Function to turn a wide table of counts into shares
+    categories: columns of the result in order, defaults to the
+                values observed in counts
+    Returns a frame with the keys followed by one column per category
+    """
+    if categories is not None:
+        counts = counts.reindex(columns=categories)
+    shares = counts.div(denominators, axis=0)
+    shares.columns.name = None
+    return shares.reset_index()
+
+
+def share_table(df, keys, category, categories=None):
+    """
+    Function to compute the share of every category value within
+    each group of keys
+    """
+    counts, denominators = count_table(df, keys, category)
+    return normalize(counts, denominators, categories)
+
+
+def shares_from_counts(counts, keys, category, categories=None, weight='count'):
+    """
+    Function to compute the same shares as share_table
+    from pre-aggregated long counts
+    """
+    counts, denominators = aggregate_counts(counts, keys, category, weight)
+    return normalize(counts, denominators, categories)
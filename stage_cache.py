@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Module to skip pipeline stages whose inputs have not
+changed: each stage fingerprints its inputs (source object
+generations, big query table modification times, the code
+that runs it) and a stage is a hit when the outputs recorded
+for that fingerprint are still the ones in storage
+---------------------
+@Author: Gabriel Yin
+"""
+import os
+import ast
+import json
+import time
+import hashlib
+import threading
+from google.api_core import exceptions as api_exceptions
+import config
+from storage_io import get_storage, get_bigquery_client
+
+CACHE_VERSION = 1
+
+# directory of the pipeline modules; imports of anything else
+# (libraries) are not fingerprinted
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def digest(obj):
+    """
+    Function to hash any json serializable object
+    """
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def project_imports(path):
+    """
+    Function to get the source files of the project modules
+    a source file imports, at module level or in functions
+    """
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read(), filename=path)
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names.add(node.module.split('.')[0])
+    paths = (os.path.join(PROJECT_DIR, name + '.py') for name in names)
+    return set(path for path in paths if os.path.isfile(path))
+
+
+def module_files(*modules):
+    """
+    Function to list the source files of modules and of
+    every project module they import, transitively
+    """
+    pending = [os.path.abspath(module.__file__) for module in modules]
+    files = set()
+    while pending:
+        path = pending.pop()
+        if path not in files:
+            files.add(path)
+            pending.extend(project_imports(path) - files)
+    return sorted(files)
+
+
+def code_version(*modules):
+    """
+    Function to fingerprint the source of the modules a stage
+    runs and of everything they import from the project, which
+    also covers the codebooks defined in them
+    """
+    sha = hashlib.sha1()
+    for path in module_files(*modules):
+        sha.update(os.path.relpath(path, PROJECT_DIR).encode('utf-8'))
+        with open(path, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def blob_versions(bucket_name, prefixes):
+    """
+    Function to get the generation of every object under prefixes
+    """
+    storage = get_storage()
+    return dict((obj.name, obj.generation) for prefix in prefixes
+                for obj in storage.list(bucket_name, prefix=prefix))
+
+
+def object_version(bucket_name, name):
+    """
+    Function to get the generation of one object, None if missing
+    """
+    info = get_storage().info(bucket_name, name)
+    return None if info is None else info.generation
+
+
+def table_version(table):
+    """
+    Function to get the last modification time of a big query table,
+    None if it does not exist
+    """
+    try:
+        return get_bigquery_client().get_table(table).modified.isoformat()
+    except api_exceptions.NotFound:
+        return None
+
+
+class StageCache():
+    """
+    Local json index of stage runs, keyed by stage and input
+    fingerprint and storing the versions of the outputs written
+    """
+    def __init__(self, path=None, max_entries=5, max_age_days=30):
+        """
+        class initialization
+        max_entries: entries kept per stage, least recently used go first
+        max_age_days: entries not used for longer are evicted
+        """
+        self.path = path or os.path.join(config.CACHE_DIR, 'stage_cache.json')
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.entries = {}
+        self.stats = {}
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                stored = json.load(f)
+            if stored.get('version') == CACHE_VERSION:
+                self.entries = stored['entries']
+
+    def _count(self, stage, outcome):
+        self.stats.setdefault(stage, {'hit': 0, 'miss': 0})[outcome] += 1
+
+    def fingerprint(self, stage, inputs):
+        """
+        Function to fingerprint the input versions of a stage
+        """
+        return digest({'stage': stage, 'inputs': inputs})
+
+    def lookup(self, stage, fingerprint, outputs):
+        """
+        Function to check whether a stage already ran on these inputs
+        and its outputs are still the ones it wrote
+        outputs: current versions of the stage outputs
+        """
+        with self._lock:
+            entry = self.entries.get(stage, {}).get(fingerprint)
+            hit = entry is not None and None not in outputs.values() \
+                and entry['outputs'] == json.loads(json.dumps(outputs, default=str))
+            if hit:
+                entry['last_used'] = time.time()
+            elif entry is not None:
+                # outputs were rewritten since, the entry can never hit again
+                del self.entries[stage][fingerprint]
+            self._count(stage, 'hit' if hit else 'miss')
+            return hit
+
+    def miss(self, stage):
+        """
+        Function to count a miss known without a lookup
+        """
+        with self._lock:
+            self._count(stage, 'miss')
+        return self
+
+    def record(self, stage, fingerprint, outputs):
+        """
+        Function to record the outputs a stage wrote for a fingerprint
+        """
+        now = time.time()
+        with self._lock:
+            self.entries.setdefault(stage, {})[fingerprint] = {
+                'outputs': json.loads(json.dumps(outputs, default=str)),
+                'created': now,
+                'last_used': now
+            }
+        return self
+
+    def evict(self, now=None):
+        """
+        Function to drop entries older than max_age_days and
+        all but the max_entries most recently used of each stage
+        """
+        now = now or time.time()
+        with self._lock:
+            for stage, entries in self.entries.items():
+                recent = sorted(entries.items(), key=lambda item: item[1]['last_used'], reverse=True)
+                self.entries[stage] = dict(
+                    (fingerprint, entry) for fingerprint, entry in recent[:self.max_entries]
+                    if now - entry['last_used'] <= self.max_age_days * 86400)
+        return self
+
+    def report(self):
+        """
+        Function to print the hits and misses of this run
+        """
+        print('-' * 20)
+        print("Stage cache:")
+        for stage, counts in self.stats.items():
+            print("  {}: {} hit, {} miss".format(stage, counts['hit'], counts['miss']))
+        return self
+
+    def save(self):
+        """
+        Function to evict old entries and persist the index,
+        writing through a temporary file
+        """
+        self.evict()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'version': CACHE_VERSION, 'entries': self.entries}, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        return self
@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+"""
+Module with the storage layer used by every stage to
+read, write and list objects, either in gcs through
+pooled clients with retries or in a local directory
+---------------------
+@Author: Gabriel Yin
+"""
+import os
+import time
+import base64
+import shutil
+import hashlib
+import threading
+import pandas as pd
+from google.cloud import storage, bigquery
+from google.api_core import exceptions as api_exceptions
+import config
+import instrument
+from upload import upload_csv, write_csv
+
+try:
+    import pyarrow.fs as pafs
+except ImportError:
+    pafs = None
+
+# errors worth retrying with backoff
+TRANSIENT_ERRORS = (api_exceptions.TooManyRequests, api_exceptions.InternalServerError,
+                    api_exceptions.BadGateway, api_exceptions.ServiceUnavailable,
+                    api_exceptions.GatewayTimeout, ConnectionError, TimeoutError)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _pooled(key, factory):
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = factory()
+        return _clients[key]
+
+
+def get_storage_client(project=None):
+    """
+    Function to get the shared storage client of a project
+    """
+    project = project or config.PROJECT_ID
+    return _pooled(('storage', project), lambda: storage.Client(project=project))
+
+
+def get_bigquery_client(project=None, location=None):
+    """
+    Function to get the shared big query client of a project
+    """
+    project = project or config.PROJECT_ID
+    location = location or config.LOCATION
+    return _pooled(('bigquery', project, location),
+                   lambda: bigquery.Client(project=project, location=location))
+
+
+def set_bigquery_client(client, project=None, location=None):
+    """
+    Function to replace the shared big query client, e.g.
+    with a LocalQueryClient to run without big query
+    """
+    project = project or config.PROJECT_ID
+    location = location or config.LOCATION
+    with _clients_lock:
+        _clients[('bigquery', project, location)] = client
+    return client
+
+
+def retry_call(func, *args, attempts=5, delay=1.0, max_delay=30.0, **kwargs):
+    """
+    Function to call func, retrying transient errors
+    with exponential backoff
+    """
+    for attempt in range(attempts):
+        try:
+            return func(*args, **kwargs)
+        except TRANSIENT_ERRORS as e:
+            if attempt == attempts - 1:
+                raise
+            wait = min(delay * 2 ** attempt, max_delay)
+            print("Transient error ({}), retrying in {:.0f}s..".format(e, wait))
+            time.sleep(wait)
+
+
+def _read_compression(name):
+    if name.endswith('.gz'):
+        return 'gzip'
+    if name.endswith('.zst'):
+        return 'zstd'
+    return None
+
+
+def _iter_csv(f, op, target, chunksize, **kwargs):
+    """
+    Generator over the frames of chunksize rows of an open csv file,
+    each read timed as an I/O call
+    """
+    with pd.read_csv(f, chunksize=chunksize, **kwargs) as reader:
+        while True:
+            with instrument.io(op, target) as call:
+                position = f.tell()
+                chunk = next(reader, None)
+                call['rows'], call['bytes'] = 0 if chunk is None else len(chunk), f.tell() - position
+            if chunk is None:
+                return
+            yield chunk
+
+
+class GCSBackend():
+    """
+    Storage backend on gcs
+    """
+    def __init__(self, project=None):
+        self.project = project or config.PROJECT_ID
+        self._buckets = {}
+
+    @property
+    def client(self):
+        return get_storage_client(self.project)
+
+    def bucket(self, bucket_name):
+        # client.bucket does not cost a round trip, unlike get_bucket
+        if bucket_name not in self._buckets:
+            self._buckets[bucket_name] = self.client.bucket(bucket_name)
+        return self._buckets[bucket_name]
+
+    def list(self, bucket_name, prefix=None, page_size=None):
+        """
+        Generator over the objects under a prefix, fetched page by page
+        Objects expose name, generation, size and md5_hash
+        """
+        return self.client.list_blobs(bucket_name, prefix=prefix, page_size=page_size)
+
+    def info(self, bucket_name, name):
+        """
+        Function to get an object's metadata, None if it does not exist
+        """
+        with instrument.io('gcs_info', 'gs://{}/{}'.format(bucket_name, name), direction=None):
+            return retry_call(self.bucket(bucket_name).get_blob, name)
+
+    def download(self, bucket_name, name, local_path):
+        with instrument.io('gcs_download', 'gs://{}/{}'.format(bucket_name, name)) as call:
+            retry_call(self.bucket(bucket_name).blob(name).download_to_filename, local_path)
+            call['bytes'] = os.path.getsize(local_path)
+
+    def read_bytes(self, bucket_name, name):
+        with instrument.io('gcs_read', 'gs://{}/{}'.format(bucket_name, name)) as call:
+            data = retry_call(self.bucket(bucket_name).blob(name).download_as_bytes)
+            call['bytes'] = len(data)
+        return data
+
+    def write_bytes(self, data, bucket_name, name, content_type=None):
+        with instrument.io('gcs_write', 'gs://{}/{}'.format(bucket_name, name), direction='write') as call:
+            retry_call(self.bucket(bucket_name).blob(name).upload_from_string, data,
+                       content_type=content_type)
+            call['bytes'] = len(data)
+
+    def read_csv(self, bucket_name, name, **kwargs):
+        """
+        Function to read a csv object into a dataframe,
+        streaming it rather than downloading it first
+        """
+        kwargs.setdefault('compression', _read_compression(name))
+
+        def read():
+            with self.bucket(bucket_name).blob(name).open('rb') as f:
+                df = pd.read_csv(f, **kwargs)
+                return df, f.tell()
+        with instrument.io('gcs_read_csv', 'gs://{}/{}'.format(bucket_name, name)) as call:
+            df, call['bytes'] = retry_call(read)
+            call['rows'] = len(df)
+        return df
+
+    def read_csv_chunks(self, bucket_name, name, chunksize, **kwargs):
+        """
+        Generator over a csv object in frames of chunksize rows,
+        streamed; an interrupted stream is not retried
+        """
+        kwargs.setdefault('compression', _read_compression(name))
+        with self.bucket(bucket_name).blob(name).open('rb') as f:
+            for chunk in _iter_csv(f, 'gcs_read_csv', 'gs://{}/{}'.format(bucket_name, name), chunksize, **kwargs):
+                yield chunk
+
+    def open_write(self, bucket_name, name, content_type=None, chunk_size=8 * 1024 * 1024):
+        """
+        Function to open an object for writing through a resumable
+        upload; the object is created when the file is closed
+        """
+        return self.bucket(bucket_name).blob(name).open('wb', chunk_size=chunk_size,
+                                                        content_type=content_type)
+
+    def rename(self, bucket_name, name, new_name):
+        bucket = self.bucket(bucket_name)
+        retry_call(bucket.rename_blob, bucket.blob(name), new_name)
+
+    def delete(self, bucket_name, name):
+        try:
+            retry_call(self.bucket(bucket_name).blob(name).delete)
+        except api_exceptions.NotFound:
+            pass
+
+    def write_csv(self, df, bucket_name, name, compression=None, **kwargs):
+        """
+        Function to stream a dataframe as csv into an object
+        Returns the number of bytes written
+        """
+        with instrument.io('gcs_write_csv', 'gs://{}/{}'.format(bucket_name, name), direction='write') as call:
+            call['bytes'] = retry_call(upload_csv, df, self.bucket(bucket_name).blob(name),
+                                       compression=compression, **kwargs)
+            call['rows'] = len(df)
+        return call['bytes']
+
+    def arrow_filesystem(self, bucket_name, name):
+        """
+        Function to get the pyarrow filesystem and path of an object prefix
+        """
+        return pafs.FileSystem.from_uri("gs://{}/{}".format(bucket_name, name))
+
+
+class LocalObject():
+    """
+    Metadata of a local object, mirroring the blob attributes
+    """
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        stat = os.stat(path)
+        self.size = stat.st_size
+        self.generation = stat.st_mtime_ns
+        self._md5_hash = None
+
+    @property
+    def md5_hash(self):
+        if self._md5_hash is None:
+            digest = hashlib.md5()
+            with open(self.path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(block)
+            self._md5_hash = base64.b64encode(digest.digest()).decode('utf-8')
+        return self._md5_hash
+
+
+class LocalBackend():
+    """
+    Storage backend on a local directory, <root>/<bucket>/<name>
+    standing in for gs://<bucket>/<name>
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, bucket_name, name):
+        return os.path.join(self.root, bucket_name, name)
+
+    def _makedirs(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def list(self, bucket_name, prefix=None, page_size=None):
+        base = os.path.join(self.root, bucket_name)
+        names = []
+        for directory, _, files in os.walk(base):
+            for file_name in files:
+                name = os.path.relpath(os.path.join(directory, file_name), base).replace(os.sep, '/')
+                if prefix is None or name.startswith(prefix):
+                    names.append(name)
+        for name in sorted(names):
+            yield LocalObject(name, self.path(bucket_name, name))
+
+    def info(self, bucket_name, name):
+        path = self.path(bucket_name, name)
+        with instrument.io('local_info', path, direction=None):
+            return LocalObject(name, path) if os.path.isfile(path) else None
+
+    def download(self, bucket_name, name, local_path):
+        with instrument.io('local_download', self.path(bucket_name, name)) as call:
+            shutil.copyfile(self.path(bucket_name, name), local_path)
+            call['bytes'] = os.path.getsize(local_path)
+
+    def read_bytes(self, bucket_name, name):
+        with instrument.io('local_read', self.path(bucket_name, name)) as call:
+            with open(self.path(bucket_name, name), 'rb') as f:
+                data = f.read()
+            call['bytes'] = len(data)
+        return data
+
+    def write_bytes(self, data, bucket_name, name, content_type=None):
+        path = self.path(bucket_name, name)
+        self._makedirs(path)
+        with instrument.io('local_write', path, direction='write') as call:
+            with open(path, 'wb') as f:
+                f.write(data)
+            call['bytes'] = len(data)
+
+    def read_csv(self, bucket_name, name, **kwargs):
+        kwargs.setdefault('compression', _read_compression(name))
+        path = self.path(bucket_name, name)
+        with instrument.io('local_read_csv', path) as call:
+            df = pd.read_csv(path, **kwargs)
+            call['rows'], call['bytes'] = len(df), os.path.getsize(path)
+        return df
+
+    def read_csv_chunks(self, bucket_name, name, chunksize, **kwargs):
+        kwargs.setdefault('compression', _read_compression(name))
+        path = self.path(bucket_name, name)
+        with open(path, 'rb') as f:
+            for chunk in _iter_csv(f, 'local_read_csv', path, chunksize, **kwargs):
+                yield chunk
+
+    def open_write(self, bucket_name, name, content_type=None):
+        path = self.path(bucket_name, name)
+        self._makedirs(path)
+        return open(path, 'wb')
+
+    def rename(self, bucket_name, name, new_name):
+        new_path = self.path(bucket_name, new_name)
+        self._makedirs(new_path)
+        os.replace(self.path(bucket_name, name), new_path)
+
+    def delete(self, bucket_name, name):
+        path = self.path(bucket_name, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def write_csv(self, df, bucket_name, name, compression=None, **kwargs):
+        path = self.path(bucket_name, name)
+        self._makedirs(path)
+        with instrument.io('local_write_csv', path, direction='write') as call:
+            with open(path, 'wb') as f:
+                call['bytes'] = write_csv(df, f, compression=compression, **kwargs)
+            call['rows'] = len(df)
+        return call['bytes']
+
+    def arrow_filesystem(self, bucket_name, name):
+        path = self.path(bucket_name, name)
+        os.makedirs(path, exist_ok=True)
+        return pafs.LocalFileSystem(), os.path.abspath(path)
+
+
+_backend = None
+
+
+def get_storage():
+    """
+    Function to get the storage backend configured by SURVEY_STORAGE
+    """
+    global _backend
+    if _backend is None:
+        if config.STORAGE.startswith('local:'):
+            _backend = LocalBackend(config.STORAGE[len('local:'):])
+        else:
+            _backend = GCSBackend()
+    return _backend
+
+
+def set_storage(backend):
+    """
+    Function to swap the storage backend, e.g. for a local run
+    """
+    global _backend
+    _backend = backend
+    return backend
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Module to generate synthetic survey data with the layouts
+and code distributions of the real sources: bluelabs raw
+return files, the survey monkey table, the voter file and
+the phone type supplements, written to a local storage
+backend and a local big query stand-in
+---------------------
+@Author: Gabriel Yin
+"""
+import numpy as np
+import pandas as pd
+import config
+from bluelabs import BluelabsDataLoader, BLUELABS_RATE_COLUMNS, BLUELABS_CANDIDATES
+from survey_monkey import SM_COLUMNS, SM_STATES, SM_CANDIDATES
+from phone_lookup import PHONE_TYPE_SOURCES
+from storage_io import LocalBackend
+from bq_reader import LocalQueryClient
+
+STATE_CODES = ['AL', 'AZ', 'CA', 'CO', 'FL', 'GA', 'IA', 'IL', 'MA', 'MI', 'MN', 'NC', 'NH',
+               'NV', 'NY', 'OH', 'PA', 'SC', 'TX', 'VA', 'WA', 'WI']
+
+# code -> relative frequency of the survey answers
+BLUELABS_CODES = {
+    'qsupport': {1: 27, 2: 20, 3: 15, 4: 6, 6: 2, 7: 8, 10: 1, 11: 2, 13: 1, 14: 4, 15: 3,
+                 16: 2, 20: 2, 21: 5, 22: 2, 23: 1},
+    'qrace': {1: 60, 2: 18, 3: 12, 4: 4, 5: 1, 6: 1, 7: 1, 8: 1, 9: 2},
+    'qeducation': {1: 6, 2: 25, 3: 20, 4: 10, 5: 24, 6: 13, 7: 1, 8: 1},
+    'qturnoutprimary': {1: 60, 2: 15, 3: 8, 4: 4, 5: 3, 6: 6, 7: 4},
+    'qpastvote': {1: 35, 2: 45, 3: 4, 4: 10, 5: 4, 6: 2},
+    'qemployed': {1: 45, 2: 10, 3: 7, 4: 22, 5: 4, 6: 4, 7: 5, 8: 2, 9: 1},
+    'qreligion': dict((code, 1) for code in range(1, 16)),
+    'qincome': {1: 22, 2: 12, 3: 11, 4: 17, 5: 12, 6: 12, 7: 8, 8: 5, 12: 1},
+    'qracehisp': {1: 12, 2: 85, 3: 3},
+    'disp': {1: 80, 2: 12, 3: 8},
+}
+BLUELABS_RATE_CODES = dict((code, 9) for code in range(1, 11))
+BLUELABS_RATE_CODES.update({98: 6, 99: 4})
+
+SURVEY_MONKEY_CODES = {
+    'candidate_first_choice': {1: 1, 2: 27, 3: 6, 4: 2, 5: 8, 6: 1, 7: 2, 8: 4, 9: 20, 10: 2,
+                               11: 15, 12: 3, 13: 5, 14: 4},
+    'candidate_second_choice': dict((code, 1) for code in range(1, 15)),
+    'partyid': {1: 5, 2: 70, 3: 20, 4: 3, 5: 2},
+    'gender': {1: 45, 2: 53, 3: 1, 4: 1},
+    'education': {1: 5, 2: 25, 3: 22, 4: 10, 5: 24, 6: 13, 7: 1},
+    'state': dict((code, 1) for code in range(len(SM_STATES))),
+    'race': {1: 62, 2: 16, 3: 12, 4: 5, 5: 1, 6: 1, 7: 1, 8: 2},
+    'likely_vote_primary_dem': {1: 75, 2: 15, 3: 7, 4: 3},
+    'religion': dict((code, 1) for code in range(1, 12)),
+    'income': {1: 10, 2: 14, 3: 18, 4: 18, 5: 14, 6: 14, 7: 8, 8: 4},
+    'employment_status': {1: 45, 2: 10, 3: 7, 4: 22, 5: 5, 6: 4, 7: 5, 8: 2},
+    'evangelical': {1: 20, 2: 77, 3: 3},
+    'hispanic': {1: 12, 2: 86, 3: 2},
+}
+SURVEY_MONKEY_RATE_CODES = {1: 20, 2: 25, 3: 20, 4: 15, 5: 12, 6: 8}
+
+# raw bluelabs columns besides the answers, and the filler
+# columns that bring a file to its layout's width
+BLUELABS_BASE = ['voterbase_id', 'date_called', 'duration_call']
+BLUELABS_LAYOUT_EXTRAS = {
+    45: [],
+    46: ['qpostrate_text'],
+    47: ['qpostrate_text', 'qsupport_text'],
+}
+RAW_PREFIX = BluelabsDataLoader.RAW_PREFIXES[0]
+
+
+def sample_codes(rng, codes, n):
+    """
+    Function to draw n codes with the given relative frequencies
+    """
+    values = np.array(list(codes), dtype='int64')
+    weights = np.array(list(codes.values()), dtype=float)
+    return rng.choice(values, size=n, p=weights / weights.sum())
+
+
+def survey_dates(start='2019-12-01', days=60):
+    """
+    Function to list the survey days
+    """
+    return pd.date_range(start, periods=days, freq='D')
+
+
+def voter_ids(rng, n):
+    """
+    Function to draw n distinct voterbase ids, STATE-NUMBER
+    """
+    numbers = rng.choice(10 ** 9, size=n, replace=False)
+    states = np.array(STATE_CODES, dtype=object)[rng.integers(0, len(STATE_CODES), n)]
+    return pd.Series(states).str.cat(pd.Series(numbers).astype(str), sep='-').values
+
+
+def bluelabs_columns(n_columns):
+    """
+    Function to list the raw columns of a bluelabs file with
+    45, 46 or 47 columns; the 45 column layout uses the older
+    qturnout/qrate_mbpost names
+    """
+    answers = [col for col in BLUELABS_CODES if col != 'qturnoutprimary']
+    if n_columns == 45:
+        answers.append('qturnout')
+        rates = [col if col != 'qratepost' else 'qrate_mbpost' for col in BLUELABS_RATE_COLUMNS]
+    else:
+        answers.append('qturnoutprimary')
+        rates = list(BLUELABS_RATE_COLUMNS)
+    columns = BLUELABS_BASE + answers + rates + BLUELABS_LAYOUT_EXTRAS[n_columns]
+    fillers = ['q_extra_{}'.format(i) for i in range(n_columns - len(columns))]
+    return columns + fillers
+
+
+def bluelabs_returns(rng, ids, dates, n_columns=46):
+    """
+    Function to generate one raw bluelabs return file for the
+    respondents ids, with date_called as MM/DD/YY
+    """
+    n = len(ids)
+    days = dates[rng.integers(0, len(dates), n)]
+    frame = {
+        'voterbase_id': ids,
+        'date_called': days.strftime('%m/%d/%y'),
+        # a few calls never connected
+        'duration_call': np.where(rng.random(n) < 0.03, 0, rng.integers(60, 1200, n)),
+    }
+    for col, codes in BLUELABS_CODES.items():
+        frame[col] = sample_codes(rng, codes, n)
+    for col in BLUELABS_RATE_COLUMNS:
+        frame[col] = sample_codes(rng, BLUELABS_RATE_CODES, n)
+    df = pd.DataFrame(frame)
+    # a few respondents broke off before the turnout question
+    df['qturnoutprimary'] = df['qturnoutprimary'].where(rng.random(n) >= 0.02)
+    df = df.rename(columns={'qturnoutprimary': 'qturnout', 'qratepost': 'qrate_mbpost'}) \
+        if n_columns == 45 else df
+    for col in bluelabs_columns(n_columns):
+        if col not in df.columns:
+            df[col] = np.nan if not col.endswith('_text') else ''
+    return df[bluelabs_columns(n_columns)]
+
+
+def voter_file(rng, ids, missing=0.02):
+    """
+    Function to generate the voter file rows of the ids,
+    leaving a share of them out as unmatched respondents
+    """
+    ids = ids[rng.random(len(ids)) >= missing]
+    n = len(ids)
+    years = rng.integers(1925, 2001, n)
+    return pd.DataFrame({
+        'vb_voterbase_id': ids,
+        'vb_voterbase_gender': np.array(['Male', 'Female', 'Unknown'], dtype=object)[
+            sample_codes(rng, {0: 47, 1: 51, 2: 2}, n)],
+        'vb_voterbase_dob': pd.Series(years).astype(str).str.cat(
+            pd.Series(rng.integers(101, 1229, n)).astype(str).str.zfill(4)).values,
+        'vb_vf_reg_zip': pd.Series(rng.integers(1000, 99951, n)).astype(str).str.zfill(5).values,
+    })
+
+
+def phone_types(rng, ids, duplicates=0.01):
+    """
+    Function to generate the phone type supplements of the ids,
+    split over the source files with a few ids listed twice
+    """
+    frame = pd.DataFrame({'voterbase_id': ids,
+                          'phone_type': np.where(rng.random(len(ids)) < 0.7, 'C', 'L'),
+                          'vendor_id': rng.integers(0, 10 ** 6, len(ids))})
+    frame = pd.concat([frame, frame.sample(frac=duplicates, random_state=0)], ignore_index=True)
+    parts = rng.integers(0, len(PHONE_TYPE_SOURCES), len(frame))
+    return [frame[parts == i] for i in range(len(PHONE_TYPE_SOURCES))]
+
+
+def survey_monkey(rng, n, dates, slash_share=0.05):
+    """
+    Function to generate the survey monkey table, with a share
+    of end_time values in the MM/DD/YY format
+    """
+    days = dates[rng.integers(0, len(dates), n)] + pd.to_timedelta(rng.integers(0, 86400, n), unit='s')
+    iso = pd.Series(days.strftime('%Y-%m-%d %H:%M:%S'))
+    slash = pd.Series(days.strftime('%m/%d/%y %H:%M'))
+    frame = {
+        'response_id': pd.Series(rng.choice(10 ** 11, size=n, replace=False)).astype(str).values,
+        'end_time': iso.where(rng.random(n) >= slash_share, slash).values,
+        'age': rng.integers(16, 90, n).astype(float),
+        'response_status': np.where(rng.random(n) < 0.9, 'completed', 'partial'),
+        'zipcode': pd.Series(rng.integers(1000, 99951, n)).astype(str).str.zfill(5).values,
+    }
+    for col, codes in SURVEY_MONKEY_CODES.items():
+        frame[col] = sample_codes(rng, codes, n)
+    for col in SM_COLUMNS:
+        if col.startswith('rate_') or col == 'bloomberg_support':
+            frame[col] = sample_codes(rng, SURVEY_MONKEY_RATE_CODES, n)
+    return pd.DataFrame(frame)[SM_COLUMNS]
+
+
+def dashboard_template():
+    """
+    Function to build the dashboard column template
+    the final combined support table is cut to
+    """
+    sm_labels = {'None of the above': 'Other'}
+    candidates = set(BLUELABS_CANDIDATES[code - 1] for code in BLUELABS_CODES['qsupport']) | \
+        set(sm_labels.get(label, label) for label in SM_CANDIDATES)
+    return pd.DataFrame(columns=['date', 'source_id'] + sorted(candidates) +
+                        ['completed_counts', 'answered_counts', 'turnout', 'turnout_percentage',
+                         'test', 'qturnout'])
+
+
+def build_environment(root, rows=100000, sm_rows=None, rows_per_file=50000, days=60, seed=0):
+    """
+    Function to write a full synthetic environment
+    root: directory of the local storage backend
+    rows: number of bluelabs respondents, spread over raw files
+          of rows_per_file rows cycling through the 45/46/47 layouts
+    sm_rows: number of survey monkey responses, defaults to rows
+    Returns the LocalBackend and the LocalQueryClient to run against
+    """
+    rng = np.random.default_rng(seed)
+    sm_rows = rows if sm_rows is None else sm_rows
+    dates = survey_dates(days=days)
+    storage = LocalBackend(root)
+
+    ids = voter_ids(rng, rows)
+    for i, start in enumerate(range(0, rows, rows_per_file)):
+        n_columns = (45, 46, 47)[i % 3]
+        df = bluelabs_returns(rng, ids[start:start + rows_per_file], dates, n_columns)
+        storage.write_csv(df, config.RAW_BUCKET, '{}_{:05d}.csv'.format(RAW_PREFIX, i))
+
+    for name, df in zip(PHONE_TYPE_SOURCES, phone_types(rng, ids)):
+        storage.write_csv(df, config.RAW_BUCKET, name)
+    storage.write_csv(dashboard_template(), config.TEMPLATE_BUCKET,
+                      'survey_dashboard/combined_support_test.csv')
+
+    client = LocalQueryClient({
+        'survey_monkey.survey_monkey_curr': survey_monkey(rng, sm_rows, dates),
+        'civis_national_raw.ts_analytics_trimmed': voter_file(rng, ids),
+    })
+    return storage, client
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+Fixtures running the pipeline stages on a tiny synthetic
+environment, a local storage directory and a local big
+query stand-in
+---------------------
+@Author: Gabriel Yin
+"""
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import datasets
+import synthetic
+from storage_io import set_storage, set_bigquery_client
+
+
+@pytest.fixture
+def environment(tmp_path, monkeypatch):
+    """
+    Fixture writing a synthetic environment under tmp_path and
+    pointing storage, big query and the local caches at it
+    Returns the LocalBackend
+    """
+    monkeypatch.setattr(config, 'RAW_DATA_DIR', str(tmp_path / 'raw_data'))
+    monkeypatch.setattr(config, 'CACHE_DIR', str(tmp_path / 'cache'))
+    # datasets and date indexes of earlier tests are not served
+    monkeypatch.setattr(datasets, '_memory', {})
+    monkeypatch.setattr(datasets, '_indexes', {})
+    storage, client = synthetic.build_environment(str(tmp_path / 'storage'), rows=3000,
+                                                  rows_per_file=700, days=8)
+    set_storage(storage)
+    set_bigquery_client(client)
+    yield storage
+    datasets.flush()
+    datasets.release()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Tests that the alternative execution paths of the pipeline
+(chunked, multi-process, duckdb, incremental) give the same
+outputs as the plain in-memory pandas run
+---------------------
+@Author: Gabriel Yin
+"""
+import pandas as pd
+import pytest
+import config
+import datasets
+import bluelabs
+import combine_survey_data
+import instrument
+import synthetic
+from main import build_pipeline, DASHBOARD_TABLES
+
+
+def run(targets=None, only=False, force=()):
+    build_pipeline(workers=2).run(targets, with_deps=not only, force=force)
+
+
+def stored(storage, name):
+    with open(storage.path(config.WORK_BUCKET, name), 'rb') as f:
+        return f.read()
+
+
+def dashboard(storage):
+    return dict((name, stored(storage, name)) for name in DASHBOARD_TABLES)
+
+
+def assert_tables_close(tables, expected):
+    for name in expected:
+        pd.testing.assert_frame_equal(pd.read_csv(pd.io.common.BytesIO(tables[name])),
+                                      pd.read_csv(pd.io.common.BytesIO(expected[name])),
+                                      check_exact=False, rtol=1e-9)
+
+
+@pytest.mark.parametrize('fmt', ['csv', 'parquet'])
+def test_chunked_matches_in_memory(environment, monkeypatch, fmt):
+    monkeypatch.setattr(datasets, 'DEFAULT_FORMAT', fmt)
+    run(['bl_aggregate'])
+    datasets.release()
+    expected = datasets.read_dataset('bluelabs_superset')
+
+    monkeypatch.setattr(bluelabs, 'CHUNK_ROWS', 500)
+    run(['bl_aggregate'], only=True)
+    datasets.release()
+    chunked = datasets.read_dataset('bluelabs_superset')
+    if fmt == 'parquet':
+        # partitions are read back by date, not in the written order
+        expected = expected.sort_values(['date', 'respondents_id']).reset_index(drop=True)
+        chunked = chunked.sort_values(['date', 'respondents_id']).reset_index(drop=True)
+    pd.testing.assert_frame_equal(chunked, expected)
+
+
+def test_chunked_streams_from_storage(environment, monkeypatch):
+    monkeypatch.setattr(bluelabs, 'CHUNK_ROWS', 500)
+    pipeline = build_pipeline(workers=2)
+    pipeline.metrics = instrument.RunMetrics()
+    pipeline.run(['bl_aggregate'])
+    ops = [call['op'] for call in pipeline.metrics.stages['bl_aggregate'].io
+           if 'agg_bluelabs_data' in call['target']]
+    assert ops and 'memory_read' not in ops
+
+
+def test_datasets_released_after_their_stages(environment):
+    run()
+    assert not datasets._memory
+
+
+def test_parse_workers_match_one_process(environment, monkeypatch):
+    run(['bl_download'])
+    expected = stored(environment, 'agg_bluelabs_data.csv')
+
+    monkeypatch.setattr(bluelabs, 'PARSE_WORKERS', 2)
+    run(['bl_download'], force=True)
+    assert stored(environment, 'agg_bluelabs_data.csv') == expected
+
+
+@pytest.mark.parametrize('backend, workers', [('pandas', 2), ('duckdb', 1), ('duckdb', 2)])
+def test_aggregation_backends_match_pandas(environment, monkeypatch, backend, workers):
+    if backend == 'duckdb':
+        pytest.importorskip('duckdb')
+    run()
+    expected = dashboard(environment)
+
+    monkeypatch.setattr(combine_survey_data, 'AGG_BACKEND', backend)
+    monkeypatch.setattr(combine_survey_data, 'AGG_WORKERS', workers)
+    # the stage also fails if the tables differ from the pandas path
+    monkeypatch.setattr(combine_survey_data, 'AGG_PARITY', True)
+    run(['misc_graphs'], only=True, force=True)
+    assert_tables_close(dashboard(environment), expected)
+
+
+def test_incremental_matches_forced_recompute(environment, capsys):
+    run()
+    # a new return file repeating some calls of the first dates
+    raw = environment.read_csv(config.RAW_BUCKET, '{}_{:05d}.csv'.format(synthetic.RAW_PREFIX, 0))
+    dates = sorted(raw['date_called'].unique())[:2]
+    environment.write_csv(raw[raw['date_called'].isin(dates)], config.RAW_BUCKET,
+                          '{}_{:05d}.csv'.format(synthetic.RAW_PREFIX, 99))
+    capsys.readouterr()
+
+    run()
+    assert "Folding {} changed survey dates".format(len(dates)) in capsys.readouterr().out
+    incremental = dashboard(environment)
+
+    run(['misc_graphs'], only=True, force=True)
+    assert dashboard(environment) == incremental
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Module to stream dataframes as csv into gcs through a
+chunked resumable upload, optionally compressed, instead
+of materializing the whole csv as one string
+---------------------
+@Author: Gabriel Yin
+"""
+import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# blob name suffix for each compression
+SUFFIXES = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+def compressed_name(name, compression=None):
+    """
+    Function to get the blob name of a csv for a compression
+    """
+    if compression not in SUFFIXES:
+        raise ValueError("Unknown compression: {}".format(compression))
+    return name + SUFFIXES[compression]
+
+
+class _CountingWriter():
+    """
+    File-like wrapper counting the bytes written through it
+    """
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return self.raw.write(data)
+
+    def flush(self):
+        pass
+
+
+def _compressor(raw, compression):
+    if compression is None:
+        return raw
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6)
+    if zstandard is None:
+        raise ImportError("zstandard is required for zstd compression")
+    return zstandard.ZstdCompressor(level=3).stream_writer(raw, closefd=False)
+
+
+class CsvStream():
+    """
+    Class to append frames as csv to a binary file object, with
+    the header of the first frame only, through one compressor
+    """
+    def __init__(self, raw, chunk_rows=100000, compression=None, **to_csv_kwargs):
+        self.counter = _CountingWriter(raw)
+        self.stream = _compressor(self.counter, compression)
+        self.chunk_rows = chunk_rows
+        self.to_csv_kwargs = to_csv_kwargs
+        self.to_csv_kwargs.setdefault('index', False)
+        self.columns = None
+
+    def write(self, df):
+        """
+        Function to append df, serializing chunk_rows rows at a time;
+        its columns are put in the order of the first frame
+        """
+        header = self.columns is None
+        if header:
+            self.columns = list(df.columns)
+        else:
+            df = df[self.columns]
+        # an empty first frame still writes the header
+        for start in range(0, max(len(df), 1 if header else 0), self.chunk_rows):
+            chunk = df.iloc[start:start + self.chunk_rows]
+            self.stream.write(chunk.to_csv(header=header and start == 0, **self.to_csv_kwargs).encode('utf-8'))
+        return self
+
+    def close(self):
+        """
+        Function to finish the csv, returns the number of (compressed)
+        bytes written; the underlying file stays open
+        """
+        if self.stream is not self.counter:
+            self.stream.close()
+        return self.counter.bytes_written
+
+
+def write_csv(df, raw, chunk_rows=100000, compression=None, **to_csv_kwargs):
+    """
+    Function to write df as csv into a binary file object,
+    serializing chunk_rows rows at a time
+    Returns the number of (compressed) bytes written
+    """
+    return CsvStream(raw, chunk_rows=chunk_rows, compression=compression, **to_csv_kwargs).write(df).close()
+
+
+def upload_csv(df, blob, chunk_rows=100000, compression=None, chunk_size=8 * 1024 * 1024,
+               **to_csv_kwargs):
+    """
+    Function to stream df as csv into a blob through a resumable
+    upload sent in chunk_size pieces, so memory at write time is
+    bounded by one chunk of rows and one upload chunk
+    Returns the number of bytes sent
+    """
+    content_type = 'text/csv' if compression is None else 'application/octet-stream'
+    with blob.open('wb', chunk_size=chunk_size, content_type=content_type) as raw:
+        sent = write_csv(df, raw, chunk_rows=chunk_rows, compression=compression, **to_csv_kwargs)
+    print("Uploaded {} ({:.2f} MB)".format(blob.name, sent / 1e6))
+    return sent
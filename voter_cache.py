@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Module with a persistent local cache of voter file
+attributes (gender, birth year and zipcode) keyed by
+voterbase_id, so that only new respondents are looked
+up in big query
+---------------------
+@Author: Gabriel Yin
+"""
+import os
+import pandas as pd
+from google.cloud import bigquery
+import config
+from bq_reader import BigQueryReader
+
+VOTER_ATTRIBUTES = ['vb_voterbase_gender', 'year', 'zipcode']
+
+
+def birth_year(dob):
+    """
+    Function to extract the birth year (as a string) from the
+    voter file date of birth, vectorized over the whole column
+    """
+    if pd.api.types.is_datetime64_any_dtype(dob):
+        return dob.dt.year.astype('Int64').astype(str).where(dob.notna(), 'nan')
+    return dob.astype(str).str[:4]
+
+
+class VoterAttributeCache():
+    """
+    Class for the local voter attribute lookup
+    """
+    query = """
+        SELECT
+         vb_voterbase_id AS voterbase_id,
+         vb_voterbase_gender,
+         vb_voterbase_dob,
+         vb_vf_reg_zip AS zipcode
+        FROM civis_national_raw.ts_analytics_trimmed
+        WHERE vb_voterbase_id IN UNNEST(@ids);
+    """
+
+    def __init__(self, path=None, reader=None, batch_size=10000):
+        """
+        path: pickle file holding the cached attributes
+        reader: BigQueryReader used for the lookups
+        batch_size: number of ids per lookup query
+        """
+        self.path = path or os.path.join(config.CACHE_DIR, 'voter_attributes.pkl')
+        self.reader = reader or BigQueryReader()
+        self.batch_size = batch_size
+        if os.path.exists(self.path):
+            self.frame = pd.read_pickle(self.path)
+        else:
+            self.frame = pd.DataFrame(columns=VOTER_ATTRIBUTES,
+                                      index=pd.Index([], name='voterbase_id'))
+
+    def missing(self, ids):
+        """
+        Function to list the ids that are not cached yet
+        """
+        ids = pd.Index(pd.Series(ids).dropna().unique())
+        return ids.difference(self.frame.index)
+
+    def fetch(self, ids):
+        """
+        Function to look up ids in the voter file in batches
+        and add them to the cache; ids that are not found are
+        cached with missing attributes so they are not queried again
+        """
+        fetched = []
+        for start in range(0, len(ids), self.batch_size):
+            batch = list(ids[start:start + self.batch_size])
+            job_config = bigquery.QueryJobConfig(query_parameters=[
+                bigquery.ArrayQueryParameter('ids', 'STRING', batch)])
+            df = self.reader.query_dataframe(self.query, job_config=job_config)
+            fetched.append(df)
+            print("Looked up {} of {} new voter ids".format(min(start + self.batch_size, len(ids)),
+                                                         len(ids)))
+        if fetched:
+            df = pd.concat(fetched, ignore_index=True)
+            df['year'] = birth_year(df['vb_voterbase_dob'])
+            df = df.drop_duplicates(subset=['voterbase_id']).set_index('voterbase_id')
+            df = df.reindex(ids)[VOTER_ATTRIBUTES]
+            df.index.name = 'voterbase_id'
+            self.frame = pd.concat([self.frame, df])
+        return self
+
+    def lookup(self, ids):
+        """
+        Function to get the attributes of ids, querying only
+        the ids that are not cached yet
+        """
+        missing = self.missing(ids)
+        print('-' * 20)
+        print("{} voter ids not cached yet".format(len(missing)))
+        if len(missing):
+            self.fetch(missing).save()
+        return self.frame
+
+    def save(self):
+        """
+        Function to persist the cache
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.frame.to_pickle(self.path)
+        return self